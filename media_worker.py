@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Media worker processes: image thumbnails, video posters and media probing.
+
+MediaProcessor in server.py runs render_media_preview() in a process pool
+started with forkserver/spawn. Those workers import only this module, so it
+must stay free of import-time side effects - no database, storage backend,
+logging handlers or threads.
+"""
+
+import os, json, shutil, subprocess
+
+try:
+    from PIL import Image, ImageOps  # Optional: image thumbnails
+except ImportError:
+    Image = None
+
+MEDIA_TOOL_TIMEOUT = 120  # ffprobe/ffmpeg runs are killed after this many seconds
+MEDIA_THUMBNAIL_SIZE = 480  # Longest side of thumbnails and video posters, in pixels
+
+# Video posters and audio/video durations need ffmpeg/ffprobe; without them
+# those uploads simply get no preview
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH') or shutil.which('ffmpeg')
+FFPROBE_PATH = os.environ.get('FFPROBE_PATH') or shutil.which('ffprobe')
+
+def save_thumbnail(image, path):
+    image.draft('RGB', (MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_SIZE))  # JPEGs decode at a reduced scale
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_SIZE))
+    if image.mode in ('RGBA', 'LA', 'P', 'PA'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(path, 'JPEG', quality=80, optimize=True, progressive=True)
+
+def probe_media(source):
+    """(duration, width, height) from ffprobe; width/height are None without a video stream"""
+    output = subprocess.run([
+        FFPROBE_PATH, '-v', 'error', '-of', 'json',
+        '-show_entries', 'format=duration:stream=codec_type,width,height', source
+    ], capture_output=True, timeout=MEDIA_TOOL_TIMEOUT, check=True).stdout
+    info = json.loads(output or b'{}')
+    
+    duration = info.get('format', {}).get('duration')
+    video = next((stream for stream in info.get('streams', []) if stream.get('codec_type') == 'video'), {})
+    return (float(duration) if duration not in (None, 'N/A') else None), video.get('width'), video.get('height')
+
+def save_video_poster(source, path, seek):
+    """One frame (or an audio file's cover art) scaled down to a JPEG; False if there is none"""
+    scale = (f"scale='min({MEDIA_THUMBNAIL_SIZE},iw)':'min({MEDIA_THUMBNAIL_SIZE},ih)'"
+             f":force_original_aspect_ratio=decrease")
+    subprocess.run([
+        FFMPEG_PATH, '-v', 'error', '-y', '-ss', f'{seek:.3f}', '-i', source,
+        '-map', '0:v:0', '-frames:v', '1', '-vf', scale, '-q:v', '4', path
+    ], capture_output=True, timeout=MEDIA_TOOL_TIMEOUT, check=True)
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+def render_media_preview(kind, source, preview_path):
+    """Runs in a media worker process: probe `source` (a path, or a URL ffmpeg
+    can read) and write a JPEG preview to preview_path when there is one.
+
+    Returns {'preview', 'width', 'height', 'duration', 'error'}. Content that
+    cannot be decoded is an error in the result, not an exception, so it is
+    recorded once instead of being retried.
+    """
+    result = {'preview': False, 'width': None, 'height': None, 'duration': None, 'error': None}
+    try:
+        if kind == 'image':
+            if Image is None:
+                result['error'] = 'Pillow is not installed'
+                return result
+            with Image.open(source) as image:
+                result['width'], result['height'] = image.size
+                save_thumbnail(image, preview_path)
+            result['preview'] = True
+            return result
+        
+        has_video = kind == 'video'
+        if FFPROBE_PATH:
+            result['duration'], result['width'], result['height'] = probe_media(source)
+            has_video = result['width'] is not None
+        if has_video and FFMPEG_PATH:
+            # A second in (or a tenth of short clips) skips black lead-in frames
+            seek = min(1.0, result['duration'] / 10) if kind == 'video' and result['duration'] else 0
+            result['preview'] = (save_video_poster(source, preview_path, seek)
+                                 or (seek > 0 and save_video_poster(source, preview_path, 0)))
+    except subprocess.TimeoutExpired:
+        result['error'] = 'timed out'
+    except subprocess.CalledProcessError as e:
+        result['error'] = (e.stderr or b'').decode('utf-8', 'replace').strip()[-500:] or f'exit status {e.returncode}'
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"[:500]
+    return result
@@ -8,20 +8,50 @@ Admin controlled storage duration, 15GB max size
 from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session, abort
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-import sqlite3, os, uuid, hashlib, time, threading, secrets, mimetypes, qrcode, io, base64
+from werkzeug.wsgi import FileWrapper, ClosingIterator
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.serving import BaseWSGIServer
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NEED_DATA
+from werkzeug.http import parse_range_header, parse_if_range_header, parse_options_header, http_date, parse_date, quote_etag, unquote_etag
+from urllib.parse import quote, unquote
+import sqlite3, os, sys, uuid, hashlib, time, threading, secrets, mimetypes, qrcode, io, queue, atexit, heapq, socket
+import asyncio, tempfile, json, shutil, subprocess, multiprocessing, array
+import qrcode.image.svg
 from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, namedtuple
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
+from media_worker import Image, FFMPEG_PATH, FFPROBE_PATH, render_media_preview
+
+try:
+    import boto3  # Optional: only needed for STORAGE_BACKEND=s3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+try:
+    import zstandard  # Optional: compression at rest (compression_enabled setting)
+except ImportError:
+    zstandard = None
+
+# Media workers import only media_worker - except when the server was started
+# as `python server.py`: multiprocessing then re-runs this script in each worker
+# as __mp_main__. There it skips the setup below (log file, database, storage).
+MEDIA_WORKER_PROCESS = __name__ == '__mp_main__'
 
 # ===== LOGGING SETUP =====
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
-)
+if not MEDIA_WORKER_PROCESS:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('app.log'),
+            logging.StreamHandler()
+        ]
+    )
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -30,18 +60,657 @@ app.secret_key = secrets.token_hex(32)
 # ===== CONFIGURATION =====
 UPLOAD_FOLDER = os.path.join('static', 'uploads', 'banners')
 STORAGE_FOLDER = os.path.join('storage', 'files')
+QR_CACHE_FOLDER = os.path.join('storage', 'qr')
 MAX_CONTENT_LENGTH = 15 * 1024 * 1024 * 1024  # 15GB - Tăng từ 1GB
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 BANNER_MAX_SIZE = 16 * 1024 * 1024  # 16MB for banners
 ALLOWED_BANNER_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+DATABASE_PATH = 'file_storage.db'
+DB_POOL_SIZE = 16  # Idle connections kept open for reuse
+DB_BUSY_TIMEOUT_MS = 5000  # Wait this long for a write lock before "database is locked"
+DB_STATEMENT_CACHE_SIZE = 256  # Prepared statements cached per connection
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB default chunk for resumable uploads
+MAX_UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024  # Largest chunk a client may negotiate
+UPLOAD_SESSION_TTL_HOURS = 24  # Partial uploads untouched this long are removed
+UPLOAD_COMPLETE_WORKERS = 2  # Threads assembling and hashing chunked uploads once all chunks arrived
+UPLOAD_COMPLETE_LEASE = 3600  # A completion still running after this (its worker died) may be restarted
+STREAM_BUFFER_SIZE = 1024 * 1024  # 1MB read buffer for streamed request bodies
+MIME_SNIFF_BYTES = 8192  # Leading bytes kept for content-type sniffing
+COMPRESSION_LEVEL = 3  # zstd level for compression at rest - fast enough to keep up with uploads
+COMPRESSION_FRAME_SIZE = 1024 * 1024  # Upload bytes per independent zstd frame; a Range only decompresses the frames it covers
+COMPRESSION_MIN_SAVINGS = 0.1  # Uploads whose first frame shrinks by less than this are stored as is
+COMPRESSION_MIN_BYTES = 4096  # Smaller uploads are stored as is (nothing to gain on 4KB disk blocks)
+COMPRESSION_INDEX_CACHE_ITEMS = 1024  # Frame indexes of compressed blobs kept in memory for downloads
+COMPRESSION_BENCHMARK_LEVELS = (1, 3, 6, 9, 19)  # Levels compared by `python server.py benchmark-compression`
+COMPRESSION_BENCHMARK_BYTES = 256 * 1024 * 1024  # Content read for a benchmark run, at most
+REQUEST_BENCHMARK_THREADS = 8  # Concurrent clients of `python server.py benchmark-requests`
+REQUEST_BENCHMARK_SECONDS = 5  # How long each page is requested, per connection setup
+SLOW_CLIENT_BENCHMARK_CLIENTS = 200  # Clients opened at once by `python server.py benchmark-slow-clients`
+SLOW_CLIENT_BENCHMARK_RATE = 128 * 1024  # Bytes/second each of them reads
+SLOW_CLIENT_BENCHMARK_BYTES = 1024 * 1024  # Size of the file they all download
+SLOW_CLIENT_BENCHMARK_WSGI_THREADS = 32  # Request threads of the WSGI server compared (like gunicorn --threads)
+DELIVERY_BENCHMARK_BYTES = 2 * 1024 * 1024 * 1024  # File sent by `python server.py benchmark-delivery`
+BENCHMARK_SOCKET_BUFFER = 64 * 1024  # Socket buffers in network benchmarks, so a slow reader holds up the sender
+MAX_FORM_FIELD_SIZE = 64 * 1024  # Largest non-file form field accepted on /upload
+VISITOR_QUEUE_SIZE = 10000  # Pending visitor events kept in memory; extra events are dropped
+VISITOR_FLUSH_INTERVAL_MS = 500  # Flush visitor events at least this often
+VISITOR_FLUSH_BATCH = 500  # ... or as soon as this many are queued
+DOWNLOAD_FLUSH_INTERVAL_MS = 1000  # Buffered download events are rolled up into SQLite this often
+DOWNLOAD_LEASE_MAX = 64  # Most downloads of one file a worker claims from download_limit in one write
+DOWNLOAD_LEASE_IDLE_SECONDS = 10  # Claimed downloads still unused after this long without one are handed back
+DOWNLOAD_SESSION_SECONDS = 3600  # A client's requests for a file within this long are billed together, by bytes served
+DOWNLOAD_SESSION_SLACK = 64 * 1024  # Bytes (at most a tenth of the file) a session may fetch past a whole copy before it is charged again
+DOWNLOAD_HOURLY_ROLLUP_DAYS = 14  # Per-hour download aggregates kept this many days
+DOWNLOAD_DAILY_ROLLUP_DAYS = 400  # Per-day download aggregates kept this many days
+DOWNLOAD_RETENTION_INTERVAL = 3600  # Prune old download events and aggregates hourly
+DOWNLOAD_RETENTION_BATCH = 1000  # Raw download rows deleted per (short) write transaction
+STATS_RESYNC_SECONDS = 300  # Homepage counters are re-read from SQLite at least this often
+ADMIN_STREAM_HEARTBEAT = 15  # Seconds between keep-alive comments on an idle admin event stream
+ADMIN_STREAM_QUEUE_SIZE = 256  # Events buffered per admin stream before it is resynced from a snapshot
+ADMIN_STREAM_WSGI_MAX = 4  # Admin streams held open at once under WSGI (each pins a request thread); more get a snapshot and reconnect
+ADMIN_STREAM_POLL_RETRY_MS = 30000  # Reconnect delay sent with such a one-shot snapshot
+HOMEPAGE_CACHE_TTL = 10  # Seconds the recent-files list and banners are served from memory
+QR_MEMORY_CACHE_ITEMS = 512  # Share codes whose rendered QR images stay in memory
+QR_MAX_AGE = 86400  # Cache-Control max-age for /qr images
+# Public address of the site, e.g. https://files.example.com/ - share links and QR
+# codes are built from it. Unset, they follow the request's Host header and QR
+# images are rendered per request instead of cached (the header is client-controlled).
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL')
+HOT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Popular small files kept in memory, per worker
+HOT_FILE_MAX_BYTES = 4 * 1024 * 1024  # Larger hot files get a readahead hint instead
+HOT_FILE_MIN_REQUESTS = 3  # Recent requests before a file counts as hot
+HOT_SKETCH_WIDTH = 16384  # Counters per row of the request-frequency sketch (power of two)
+HOT_PREFETCH_INTERVAL = 60  # Seconds between readahead hints for the same large file
+SHARE_CODE_CACHE_ITEMS = 10000  # Share codes whose file record stays in memory
+SHARE_CODE_CACHE_TTL = 60  # Longest a record is reused (other workers' changes show up after this)
+SHARE_CODE_NEGATIVE_ITEMS = 10000  # Unknown share codes remembered, kept apart from real records
+SHARE_CODE_NEGATIVE_TTL = 60  # Seconds an unknown share code is answered without a query
+MEDIA_WORKERS = 2  # Processes per server process making previews and probing media
+MEDIA_POLL_INTERVAL = 5  # Seconds between checks for media jobs queued by other processes
+MEDIA_JOB_LEASE = 600  # A claimed media job is handed out again if not finished by then
+MEDIA_JOB_MAX_ATTEMPTS = 3  # Media jobs failing this often are recorded without a preview
+MEDIA_RETRY_DELAY = 60  # Seconds before a failed media job is retried, times the attempt number
+MEDIA_IMAGE_MAX_BYTES = 64 * 1024 * 1024  # Larger images get no thumbnail
+MEDIA_PENDING_CACHE_TTL = 2  # Share-code cache TTL of a file whose preview is still being made
+PREVIEW_MAX_BYTES = 4 * 1024 * 1024  # Largest preview image read back for /preview
+PREVIEW_MAX_AGE = 30 * 86400  # Cache-Control max-age for /preview images
+SETTINGS_VERSION_CHECK_SECONDS = 2  # How often a worker checks whether another one changed settings
+CLEANUP_BATCH_SIZE = 200  # Expired files deleted per (short) write transaction
+CLEANUP_MAX_FILES_PER_SECOND = 500  # Expiry rate limit, 0 = unlimited
+CLEANUP_UNLINK_WORKERS = 4  # Threads unlinking expired files outside the transaction
+JOB_STARTUP_DELAY = 60  # Seconds after start before a process first considers its jobs
+JOB_DISABLED_RECHECK_SECONDS = 300  # Disabled jobs re-read their settings this often
+VISITOR_CLEANUP_INTERVAL = 300  # Mark visitors inactive every 5 minutes
+STALE_UPLOAD_CLEANUP_INTERVAL = 900  # Reclaim abandoned chunked uploads every 15 minutes
+RECONCILE_ORPHAN_GRACE = 3600  # Unreferenced objects younger than this may be uploads in flight
+RECONCILE_REPORT_LIMIT = 20  # Orphan/missing keys listed in the reconciliation result
+RATE_LIMIT_SYNC_MS = 1000  # Workers exchange rate-limit usage through SQLite this often
+RATE_LIMIT_STATE_TTL = 600  # Shared usage rows not updated for this long are dropped
+RATE_LIMIT_TRANSFER_STALE = 30  # Transfer counts of a worker that stopped syncing are ignored after this
+
+# Download delivery mode - auth, password, expiry and limit checks always stay in Python:
+#   'stream'     - Python reads the file and writes every byte
+#   'sendfile'   - hand the open file to the server's wsgi.file_wrapper (gunicorn uses sendfile())
+#   'x-accel'    - nginx serves it: location X_ACCEL_LOCATION { internal; alias <STORAGE_FOLDER>/; }
+#   'x-sendfile' - Apache mod_xsendfile / lighttpd serve the absolute path
+DOWNLOAD_DELIVERY_MODE = os.environ.get('DOWNLOAD_DELIVERY_MODE', 'sendfile')
+X_ACCEL_LOCATION = os.environ.get('X_ACCEL_LOCATION', '/protected-files/')
+
+# Reverse proxies in front of the app (nginx, a load balancer...). Their
+# X-Forwarded-For/-Proto/-Host headers are trusted for this many hops, so rate
+# limits, visitor tracking and uploader IPs see the client rather than the
+# proxy. Leave at 0 when clients connect directly - the headers are forgeable.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+
+# Where file content lives: 'local' (STORAGE_FOLDER) or 's3' (any S3-compatible
+# service - AWS, MinIO, Ceph...). With s3 and presigned downloads the web nodes
+# keep no file state and can be scaled out behind a load balancer.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+STORAGE_SHARD_MIGRATION_BATCH = 500  # Files moved per transaction by `python server.py migrate-storage`
+STORAGE_SHARD_MIGRATION_GRACE = 60  # Seconds an old path stays linked for requests already resolving it
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. http://localhost:9000 for MinIO, unset for AWS
+S3_PUBLIC_ENDPOINT_URL = os.environ.get('S3_PUBLIC_ENDPOINT_URL')  # Host clients reach, if different
+S3_BUCKET = os.environ.get('S3_BUCKET', 'file-storage')
+S3_PREFIX = os.environ.get('S3_PREFIX', 'files/')
+S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
+S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')  # Falls back to boto3's usual credential chain
+S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+S3_PART_SIZE = 8 * 1024 * 1024  # Multipart part size for streamed uploads (S3 minimum is 5MB)
+S3_PRESIGNED_DOWNLOADS = os.environ.get('S3_PRESIGNED_DOWNLOADS', 'true') == 'true'  # Redirect instead of proxying
+S3_PRESIGN_EXPIRES = 300  # Seconds a presigned download URL stays valid
+
+# ASGI serving mode (uvicorn server:asgi_app) - threads only do disk and DB work,
+# slow clients wait on the event loop instead of holding a thread each
+ASGI_IO_THREADS = 32  # Thread pool for Flask views, DB access and file reads/writes
+ASGI_BODY_SPOOL_SIZE = 1024 * 1024  # Non-upload request bodies above this spool to disk
 
 # Create directories
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(STORAGE_FOLDER, exist_ok=True)
+if not MEDIA_WORKER_PROCESS:
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(STORAGE_FOLDER, exist_ok=True)
+    os.makedirs(QR_CACHE_FOLDER, exist_ok=True)
+
+# ===== DATABASE CONNECTION POOL =====
+class PooledConnection:
+    """Connection borrowed from the pool - close() returns it instead of closing.
+    As a context manager it commits (or rolls back on error) and releases itself."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a released connection')
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._conn is not None:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        # A borrower that forgot close() on an error path still gives the connection back
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Shared SQLite connections (WAL, synchronous=NORMAL, busy timeout, statement cache).
+    A borrower owns its connection until close(), so no two threads share one."""
+
+    def __init__(self, database, max_idle=DB_POOL_SIZE):
+        self.database = database
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def connect(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.reused += 1
+        except queue.Empty:
+            conn = self._open()
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        try:
+            # Never hand out a connection with a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+db_pool = ConnectionPool(DATABASE_PATH)
+
+def get_db_connection():
+    """Borrow a pooled connection; call close() (or use `with`) to return it"""
+    return db_pool.connect()
 
 # ===== DATABASE SETUP =====
+def add_column_if_missing(cursor, table, column, definition):
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def migrate_files_checksum(cursor):
+    add_column_if_missing(cursor, 'files', 'checksum', 'TEXT')  # SHA-256 of stored content
+
+def migrate_download_rollups(cursor):
+    # User agents are stored once and referenced by id from download_stats
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_agents (
+            id INTEGER PRIMARY KEY,
+            user_agent TEXT NOT NULL UNIQUE
+        )
+    ''')
+    add_column_if_missing(cursor, 'download_stats', 'user_agent_id', 'INTEGER')
+    add_column_if_missing(cursor, 'download_stats', 'bytes_sent', 'INTEGER')
+    
+    # Per-file download counts by hour and by day, maintained as events are rolled up
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS download_rollups (
+            period TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            downloads INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            unique_ips INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket_start, file_id)
+        ) WITHOUT ROWID
+    ''')
+    # IPs already counted in a bucket; only needed while the bucket is still open
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS download_rollup_ips (
+            period TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            PRIMARY KEY (period, bucket_start, file_id, ip)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_rollups_file ON download_rollups (file_id, period, bucket_start)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_stats_time ON download_stats (download_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_stats_user_agent ON download_stats (user_agent_id)')
+    
+    # Move existing rows over: dictionary-encode user agents, drop the copied names
+    cursor.execute('''
+        INSERT OR IGNORE INTO user_agents (user_agent)
+        SELECT DISTINCT user_agent FROM download_stats WHERE user_agent IS NOT NULL
+    ''')
+    cursor.execute('''
+        UPDATE download_stats SET
+            user_agent_id = (SELECT id FROM user_agents WHERE user_agent = download_stats.user_agent),
+            user_agent = NULL,
+            file_name = NULL
+        WHERE user_agent IS NOT NULL OR file_name IS NOT NULL
+    ''')
+    
+    for period, bucket_format in DOWNLOAD_ROLLUP_PERIODS.items():
+        cursor.execute('''
+            INSERT OR IGNORE INTO download_rollup_ips (period, bucket_start, file_id, ip)
+            SELECT DISTINCT ?, strftime(?, download_time), file_id, download_ip
+            FROM download_stats WHERE file_id IS NOT NULL AND download_ip IS NOT NULL
+        ''', (period, bucket_format))
+        cursor.execute('''
+            INSERT OR IGNORE INTO download_rollups (period, bucket_start, file_id, downloads, bytes, unique_ips)
+            SELECT ?, strftime(?, d.download_time), d.file_id, COUNT(*),
+                   COALESCE(SUM(f.file_size), 0), COUNT(DISTINCT d.download_ip)
+            FROM download_stats d LEFT JOIN files f ON f.id = d.file_id
+            WHERE d.file_id IS NOT NULL
+            GROUP BY 2, d.file_id
+        ''', (period, bucket_format))
+
+def migrate_storage_upload_ids(cursor):
+    # Backend handle of a chunked upload (S3 UploadId) and the ETag of each part
+    add_column_if_missing(cursor, 'upload_sessions', 'storage_upload_id', 'TEXT')
+    add_column_if_missing(cursor, 'upload_chunks', 'etag', 'TEXT')
+
+def migrate_upload_completion(cursor):
+    # Chunked uploads complete in the background: the claim of the worker doing
+    # it, the blob reference the session holds once its content is stored (a
+    # retry then only creates the file record) and why the last attempt failed
+    add_column_if_missing(cursor, 'upload_sessions', 'completion_owner', 'TEXT')
+    add_column_if_missing(cursor, 'upload_sessions', 'checksum', 'TEXT')
+    add_column_if_missing(cursor, 'upload_sessions', 'blob_name', 'TEXT')
+    add_column_if_missing(cursor, 'upload_sessions', 'last_error', 'TEXT')
+    # Stale upload cleanup must not delete a staging object that became a blob (S3)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_blobs_stored_name ON blobs (stored_name)')
+
+def migrate_download_total(cursor):
+    # Homepage download total, kept like the other ledger totals instead of a
+    # SUM over every files row on each stats reload
+    add_column_if_missing(cursor, 'storage_totals', 'download_total', 'INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS download_total_file_insert AFTER INSERT ON files BEGIN
+        UPDATE storage_totals SET download_total = download_total + COALESCE(NEW.download_count, 0) WHERE id = 1;
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS download_total_file_delete AFTER DELETE ON files BEGIN
+        UPDATE storage_totals SET download_total = download_total - COALESCE(OLD.download_count, 0) WHERE id = 1;
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS download_total_file_update AFTER UPDATE OF download_count ON files BEGIN
+        UPDATE storage_totals SET
+            download_total = download_total - COALESCE(OLD.download_count, 0) + COALESCE(NEW.download_count, 0)
+        WHERE id = 1;
+    END''')
+    cursor.execute(DOWNLOAD_TOTAL_RECOUNT)
+
+def migrate_blob_compression(cursor):
+    # How each blob is stored: codec (NULL = as is), bytes on disk, and the
+    # compressed length of each frame so downloads can seek by frame
+    add_column_if_missing(cursor, 'blobs', 'codec', 'TEXT')
+    add_column_if_missing(cursor, 'blobs', 'stored_size', 'INTEGER')
+    add_column_if_missing(cursor, 'blobs', 'frame_size', 'INTEGER')
+    add_column_if_missing(cursor, 'blobs', 'frame_index', 'BLOB')
+    add_column_if_missing(cursor, 'blobs', 'compress_seconds', 'REAL')
+    for column, definition in (('compressed_count', 'INTEGER NOT NULL DEFAULT 0'),
+                               ('compressed_bytes', 'INTEGER NOT NULL DEFAULT 0'),
+                               ('compressed_stored_bytes', 'INTEGER NOT NULL DEFAULT 0'),
+                               ('compress_seconds', 'REAL NOT NULL DEFAULT 0')):
+        add_column_if_missing(cursor, 'storage_totals', column, definition)
+    
+    # The blob triggers now also keep the compression totals
+    cursor.execute('DROP TRIGGER IF EXISTS storage_totals_blob_insert')
+    cursor.execute('DROP TRIGGER IF EXISTS storage_totals_blob_delete')
+    cursor.execute('''
+        CREATE TRIGGER storage_totals_blob_insert AFTER INSERT ON blobs BEGIN
+            UPDATE storage_totals SET
+                blob_count = blob_count + 1,
+                blob_bytes = blob_bytes + NEW.size,
+                shared_bytes = shared_bytes + NEW.size * (NEW.refcount - 1),
+                compressed_count = compressed_count + (NEW.codec IS NOT NULL),
+                compressed_bytes = compressed_bytes + (NEW.codec IS NOT NULL) * NEW.size,
+                compressed_stored_bytes = compressed_stored_bytes + COALESCE(NEW.stored_size, 0),
+                compress_seconds = compress_seconds + COALESCE(NEW.compress_seconds, 0)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER storage_totals_blob_delete AFTER DELETE ON blobs BEGIN
+            UPDATE storage_totals SET
+                blob_count = blob_count - 1,
+                blob_bytes = blob_bytes - OLD.size,
+                shared_bytes = shared_bytes - OLD.size * (OLD.refcount - 1),
+                compressed_count = compressed_count - (OLD.codec IS NOT NULL),
+                compressed_bytes = compressed_bytes - (OLD.codec IS NOT NULL) * OLD.size,
+                compressed_stored_bytes = compressed_stored_bytes - COALESCE(OLD.stored_size, 0),
+                compress_seconds = compress_seconds - COALESCE(OLD.compress_seconds, 0)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute(COMPRESSION_TOTALS_RECOUNT)
+
+# Physical storage totals recomputed from scratch (ledger backfill and reconciliation)
+STORAGE_TOTALS_RECOUNT = '''
+    UPDATE storage_totals SET
+        blob_count = (SELECT COUNT(*) FROM blobs),
+        blob_bytes = (SELECT COALESCE(SUM(size), 0) FROM blobs),
+        shared_bytes = (SELECT COALESCE(SUM(size * (refcount - 1)), 0) FROM blobs),
+        unblobbed_count = (SELECT COUNT(*) FROM files WHERE checksum IS NULL),
+        unblobbed_bytes = (SELECT COALESCE(SUM(file_size), 0) FROM files WHERE checksum IS NULL)
+    WHERE id = 1
+'''
+
+LEDGER_TOTALS_QUERY = '''
+    SELECT blob_count, blob_bytes, shared_bytes, unblobbed_count, unblobbed_bytes,
+           compressed_count, compressed_bytes, compressed_stored_bytes, download_total
+    FROM storage_totals
+'''
+
+DOWNLOAD_TOTAL_RECOUNT = '''
+    UPDATE storage_totals SET download_total = (SELECT COALESCE(SUM(download_count), 0) FROM files) WHERE id = 1
+'''
+
+COMPRESSION_TOTALS_RECOUNT = '''
+    UPDATE storage_totals SET
+        compressed_count = (SELECT COUNT(*) FROM blobs WHERE codec IS NOT NULL),
+        compressed_bytes = (SELECT COALESCE(SUM(size), 0) FROM blobs WHERE codec IS NOT NULL),
+        compressed_stored_bytes = (SELECT COALESCE(SUM(stored_size), 0) FROM blobs WHERE codec IS NOT NULL),
+        compress_seconds = (SELECT COALESCE(SUM(compress_seconds), 0) FROM blobs WHERE codec IS NOT NULL)
+    WHERE id = 1
+'''
+
+# Download aggregate granularity -> strftime format of the bucket start
+DOWNLOAD_ROLLUP_PERIODS = {
+    'hour': '%Y-%m-%d %H:00:00',
+    'day': '%Y-%m-%d 00:00:00'
+}
+
+# Versioned schema changes, applied in order on top of the base tables.
+# The applied version is kept in PRAGMA user_version; never edit a released entry,
+# append a new one. Each entry is a callable or a list of SQL statements.
+SCHEMA_MIGRATIONS = [
+    (1, 'files.checksum column', migrate_files_checksum),
+    (2, 'indexes for hot queries', [
+        # Homepage stats and expiry cleanup: COUNT/SUM over live files, expired lookups
+        'CREATE INDEX IF NOT EXISTS idx_files_expires_size ON files (expires_at, file_size)',
+        # Homepage recent public files
+        'CREATE INDEX IF NOT EXISTS idx_files_public_uploaded ON files (is_public, uploaded_at)',
+        # Admin file list
+        'CREATE INDEX IF NOT EXISTS idx_files_uploaded ON files (uploaded_at)',
+        # Active visitor count only ever looks at active rows
+        'CREATE INDEX IF NOT EXISTS idx_visitors_active_last_activity ON visitors (last_activity) WHERE is_active = 1',
+        # Admin visitor list
+        'CREATE INDEX IF NOT EXISTS idx_visitors_last_activity ON visitors (last_activity)',
+        'CREATE INDEX IF NOT EXISTS idx_download_stats_file_id ON download_stats (file_id)',
+        'CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at)',
+    ]),
+    (3, 'settings version counter', [
+        # Single-row counter bumped by triggers on any settings change, so every
+        # worker can tell its in-memory copy is stale without reading settings
+        '''CREATE TABLE IF NOT EXISTS settings_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )''',
+        'INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)',
+        '''CREATE TRIGGER IF NOT EXISTS settings_version_insert AFTER INSERT ON settings
+           BEGIN UPDATE settings_version SET version = version + 1 WHERE id = 1; END''',
+        '''CREATE TRIGGER IF NOT EXISTS settings_version_update AFTER UPDATE ON settings
+           BEGIN UPDATE settings_version SET version = version + 1 WHERE id = 1; END''',
+        '''CREATE TRIGGER IF NOT EXISTS settings_version_delete AFTER DELETE ON settings
+           BEGIN UPDATE settings_version SET version = version + 1 WHERE id = 1; END''',
+    ]),
+    (4, 'scheduler job leases', [
+        # One row per background job: who holds it and when it last ran cluster-wide
+        '''CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            lease_until REAL DEFAULT 0,
+            last_run_at REAL DEFAULT 0
+        )''',
+    ]),
+    (5, 'download rollups and user agent dictionary', migrate_download_rollups),
+    (6, 'storage multipart upload ids', migrate_storage_upload_ids),
+    (7, 'storage usage ledger', [
+        # Logical usage per file type and physical totals, kept current by triggers
+        # inside whatever transaction inserts or deletes files/blobs rows
+        '''CREATE TABLE IF NOT EXISTS storage_usage (
+            file_type TEXT PRIMARY KEY,
+            file_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS storage_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            blob_count INTEGER NOT NULL DEFAULT 0,
+            blob_bytes INTEGER NOT NULL DEFAULT 0,
+            shared_bytes INTEGER NOT NULL DEFAULT 0,
+            unblobbed_count INTEGER NOT NULL DEFAULT 0,
+            unblobbed_bytes INTEGER NOT NULL DEFAULT 0
+        )''',
+        'INSERT OR IGNORE INTO storage_totals (id) VALUES (1)',
+        '''CREATE TRIGGER IF NOT EXISTS storage_usage_file_insert AFTER INSERT ON files BEGIN
+            INSERT INTO storage_usage (file_type, file_count, total_bytes)
+            VALUES (COALESCE(NEW.file_type, 'other'), 1, COALESCE(NEW.file_size, 0))
+            ON CONFLICT(file_type) DO UPDATE SET
+                file_count = file_count + 1, total_bytes = total_bytes + excluded.total_bytes;
+            UPDATE storage_totals SET
+                unblobbed_count = unblobbed_count + (NEW.checksum IS NULL),
+                unblobbed_bytes = unblobbed_bytes + (NEW.checksum IS NULL) * COALESCE(NEW.file_size, 0)
+            WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS storage_usage_file_delete AFTER DELETE ON files BEGIN
+            UPDATE storage_usage SET
+                file_count = file_count - 1, total_bytes = total_bytes - COALESCE(OLD.file_size, 0)
+            WHERE file_type = COALESCE(OLD.file_type, 'other');
+            UPDATE storage_totals SET
+                unblobbed_count = unblobbed_count - (OLD.checksum IS NULL),
+                unblobbed_bytes = unblobbed_bytes - (OLD.checksum IS NULL) * COALESCE(OLD.file_size, 0)
+            WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS storage_usage_file_update AFTER UPDATE OF file_type, file_size, checksum ON files BEGIN
+            UPDATE storage_usage SET
+                file_count = file_count - 1, total_bytes = total_bytes - COALESCE(OLD.file_size, 0)
+            WHERE file_type = COALESCE(OLD.file_type, 'other');
+            INSERT INTO storage_usage (file_type, file_count, total_bytes)
+            VALUES (COALESCE(NEW.file_type, 'other'), 1, COALESCE(NEW.file_size, 0))
+            ON CONFLICT(file_type) DO UPDATE SET
+                file_count = file_count + 1, total_bytes = total_bytes + excluded.total_bytes;
+            UPDATE storage_totals SET
+                unblobbed_count = unblobbed_count - (OLD.checksum IS NULL) + (NEW.checksum IS NULL),
+                unblobbed_bytes = unblobbed_bytes - (OLD.checksum IS NULL) * COALESCE(OLD.file_size, 0)
+                                                  + (NEW.checksum IS NULL) * COALESCE(NEW.file_size, 0)
+            WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS storage_totals_blob_insert AFTER INSERT ON blobs BEGIN
+            UPDATE storage_totals SET
+                blob_count = blob_count + 1,
+                blob_bytes = blob_bytes + NEW.size,
+                shared_bytes = shared_bytes + NEW.size * (NEW.refcount - 1)
+            WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS storage_totals_blob_delete AFTER DELETE ON blobs BEGIN
+            UPDATE storage_totals SET
+                blob_count = blob_count - 1,
+                blob_bytes = blob_bytes - OLD.size,
+                shared_bytes = shared_bytes - OLD.size * (OLD.refcount - 1)
+            WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS storage_totals_blob_update AFTER UPDATE OF size, refcount ON blobs BEGIN
+            UPDATE storage_totals SET
+                blob_bytes = blob_bytes - OLD.size + NEW.size,
+                shared_bytes = shared_bytes - OLD.size * (OLD.refcount - 1) + NEW.size * (NEW.refcount - 1)
+            WHERE id = 1;
+        END''',
+        # Start from the current contents
+        '''INSERT OR REPLACE INTO storage_usage (file_type, file_count, total_bytes)
+           SELECT COALESCE(file_type, 'other'), COUNT(*), COALESCE(SUM(file_size), 0) FROM files
+           GROUP BY COALESCE(file_type, 'other')''',
+        STORAGE_TOTALS_RECOUNT,
+    ]),
+    (8, 'shared rate limiter state', [
+        # Tokens each worker took per bucket ('scope:client'), as a running total
+        '''CREATE TABLE IF NOT EXISTS rate_limit_usage (
+            bucket_key TEXT NOT NULL,
+            worker_id TEXT NOT NULL,
+            consumed REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (bucket_key, worker_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_rate_limit_usage_updated ON rate_limit_usage (updated_at)',
+        # Downloads each worker is currently sending, per share code
+        '''CREATE TABLE IF NOT EXISTS active_transfers (
+            share_code TEXT NOT NULL,
+            worker_id TEXT NOT NULL,
+            active INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (share_code, worker_id)
+        ) WITHOUT ROWID''',
+    ]),
+    (9, 'media processing queue', [
+        # Post-upload work per stored object, so deduplicated uploads share it. A
+        # claimed job's run_after moves out by the lease: if its worker dies it comes back.
+        '''CREATE TABLE IF NOT EXISTS media_jobs (
+            stored_name TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            owner TEXT,
+            last_error TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_media_jobs_run_after ON media_jobs (run_after)',
+        # Results per stored object - the preview is stored next to it
+        '''CREATE TABLE IF NOT EXISTS media_info (
+            stored_name TEXT PRIMARY KEY,
+            preview_key TEXT,
+            width INTEGER,
+            height INTEGER,
+            duration REAL,
+            error TEXT,
+            processed_at REAL
+        )''',
+        # Queue what is already stored
+        '''INSERT OR IGNORE INTO media_jobs (stored_name, kind, file_size, run_after)
+           SELECT stored_name, substr(mime_type, 1, instr(mime_type, '/') - 1), MAX(file_size), 0 FROM files
+           WHERE (mime_type LIKE 'image/%' AND mime_type != 'image/svg+xml')
+              OR mime_type LIKE 'video/%' OR mime_type LIKE 'audio/%'
+           GROUP BY stored_name''',
+    ]),
+    (10, 'blob compression at rest', migrate_blob_compression),
+    (11, 'background chunked upload completion', migrate_upload_completion),
+    (12, 'download total in the storage ledger', migrate_download_total),
+]
+
+def run_migrations(cursor):
+    cursor.execute('PRAGMA user_version')
+    current_version = cursor.fetchone()[0]
+    
+    for version, description, migration in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        
+        if callable(migration):
+            migration(cursor)
+        else:
+            for statement in migration:
+                cursor.execute(statement)
+        
+        cursor.execute(f'PRAGMA user_version = {version}')
+        logger.info(f"Applied schema migration {version}: {description}")
+
+# Hot queries that must stay index-driven, with representative parameters -
+# tests/test_query_plans.py fails when one of them plans a full table scan
+HOT_QUERIES = [
+    ('SELECT id, stored_name, checksum FROM files WHERE expires_at < ?', ('',)),
+    ('SELECT COUNT(*) FROM files WHERE expires_at > ?', ('',)),
+    ('SELECT download_total FROM storage_totals WHERE id = 1', ()),
+    ('SELECT SUM(file_size) FROM files WHERE expires_at > ?', ('',)),
+    ('''SELECT id, original_name, file_type, file_size, share_code, download_count, uploaded_at
+       FROM files WHERE is_public = 1 AND expires_at > ? ORDER BY uploaded_at DESC LIMIT 10''', ('',)),
+    ('''SELECT f.id, m.preview_key, j.stored_name FROM files f
+       LEFT JOIN media_info m ON m.stored_name = f.stored_name
+       LEFT JOIN media_jobs j ON j.stored_name = f.stored_name
+       LEFT JOIN blobs b ON b.hash = f.checksum
+       WHERE f.share_code = ?''', ('',)),
+    ('SELECT COUNT(*) FROM visitors WHERE is_active = 1 AND last_activity > ?', ('',)),
+    ('UPDATE visitors SET is_active = 0 WHERE is_active = 1 AND last_activity < ?', ('',)),
+    ('DELETE FROM download_stats WHERE file_id = ?', ('',)),
+    ('SELECT id, stored_name FROM upload_sessions WHERE updated_at < ?', ('',)),
+    ('SELECT 1 FROM blobs WHERE stored_name = ?', ('',)),
+    ('SELECT id FROM download_stats WHERE download_time < ? LIMIT 1', ('',)),
+    ('''SELECT bucket_start, SUM(downloads), SUM(bytes), SUM(unique_ips) FROM download_rollups
+       WHERE period = ? AND bucket_start >= ? GROUP BY bucket_start''', ('day', '')),
+    ('SELECT bucket_key, worker_id, consumed FROM rate_limit_usage WHERE updated_at > ? AND worker_id != ?', (0, '')),
+    ('SELECT stored_name, kind, file_size, attempts FROM media_jobs WHERE run_after <= ? ORDER BY run_after LIMIT 1', (0,)),
+]
+
+def find_table_scans(cursor):
+    """EXPLAIN QUERY PLAN every hot query; returns [(sql, plan detail)] for any
+    that fall back to a full table scan"""
+    scans = []
+    for sql, params in HOT_QUERIES:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        for row in cursor.fetchall():
+            detail = row[-1]
+            if detail.startswith('SCAN') and 'INDEX' not in detail:
+                scans.append((' '.join(sql.split()), detail))
+    return scans
+
 def init_db():
-    conn = sqlite3.connect('file_storage.db')
+    conn = get_db_connection()
+    # One write transaction, so workers starting together migrate exactly once
+    conn.execute('BEGIN IMMEDIATE')
     cursor = conn.cursor()
     
     # Files table
@@ -117,6 +786,45 @@ def init_db():
         )
     ''')
     
+    # Content-addressed blobs - `files` rows point at a blob through checksum/stored_name
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            stored_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Resumable upload sessions - a `files` row is only created on completion
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            original_name TEXT NOT NULL,
+            stored_name TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            mime_type TEXT,
+            password TEXT,
+            description TEXT,
+            is_public BOOLEAN DEFAULT 1,
+            uploader_ip TEXT,
+            status TEXT DEFAULT 'uploading',
+            created_at DATETIME,
+            updated_at DATETIME
+        )
+    ''')
+    
+    # Chunks received per upload session
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, chunk_index)
+        )
+    ''')
+    
     # Insert default settings
     default_settings = [
         ('admin_username', 'admin', 'Admin username'),
@@ -127,171 +835,2977 @@ def init_db():
         ('cleanup_interval_minutes', '60', 'Cleanup interval in minutes'),
         ('default_expire_days', '30', 'Default file expiration days - ADMIN CONTROLLED'),
         ('max_file_size_gb', '15', 'Maximum file size in GB'),
-        ('max_download_limit', '100', 'Default max downloads per file')
+        ('max_download_limit', '100', 'Default max downloads per file'),
+        ('download_stats_retention_days', '30', 'Days raw download events are kept (0 = forever)'),
+        ('storage_reconcile_interval_hours', '0', 'Storage ledger reconciliation interval in hours (0 = off)'),
+        # Behind a reverse proxy, set TRUSTED_PROXY_HOPS before enabling these
+        ('rate_limit_download_per_minute', '0', 'Download requests per minute per IP (0 = unlimited)'),
+        ('rate_limit_upload_per_minute', '0', 'Upload requests per minute per IP (0 = unlimited)'),
+        ('rate_limit_login_per_minute', '0', 'Admin login attempts per minute per IP (0 = unlimited)'),
+        ('download_max_concurrent_per_share', '0', 'Simultaneous downloads per share code (0 = unlimited)'),
+        ('download_bandwidth_kb_per_second', '0', 'Bandwidth per download connection in KB/s (0 = unlimited)'),
+        ('upload_bandwidth_kb_per_second', '0', 'Bandwidth per upload connection in KB/s (0 = unlimited)'),
+        ('compression_enabled', 'false', 'Compress compressible uploads at rest with zstd (needs zstandard)')
     ]
     
     for key, value, desc in default_settings:
         cursor.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', 
                       (key, value, desc))
     
+    run_migrations(cursor)
     conn.commit()
     conn.close()
 
 # Initialize database
-init_db()
+if not MEDIA_WORKER_PROCESS:
+    init_db()
 
-# ===== VISITOR TRACKING =====
-class VisitorTracker:
+# ===== SETTINGS CACHE =====
+# Type and default of each setting read on hot paths
+SETTING_TYPES = {
+    'admin_username': (str, 'admin'),
+    'admin_password_hash': (str, ''),
+    'site_title': (str, 'File Storage & Sharing'),
+    'maintenance_mode': (bool, False),
+    'auto_cleanup_enabled': (bool, False),
+    'cleanup_interval_minutes': (int, 60),
+    'default_expire_days': (int, 30),
+    'max_file_size_gb': (int, 15),
+    'max_download_limit': (int, 100),
+    'download_stats_retention_days': (int, 30),
+    'storage_reconcile_interval_hours': (int, 0),
+    'rate_limit_download_per_minute': (int, 0),
+    'rate_limit_upload_per_minute': (int, 0),
+    'rate_limit_login_per_minute': (int, 0),
+    'download_max_concurrent_per_share': (int, 0),
+    'download_bandwidth_kb_per_second': (int, 0),
+    'upload_bandwidth_kb_per_second': (int, 0),
+    'compression_enabled': (bool, False),
+}
+
+def parse_setting(key, value):
+    value_type, default = SETTING_TYPES.get(key, (str, None))
+    if value is None:
+        return default
+    if value_type is bool:
+        return value == 'true'
+    try:
+        return value_type(value)
+    except (TypeError, ValueError):
+        return default
+
+class SettingsCache:
+    """Settings loaded once and kept in memory. Any write to the settings table
+    bumps settings_version (via triggers); workers compare it at most every
+    SETTINGS_VERSION_CHECK_SECONDS and reload only when it moved."""
+    
     def __init__(self):
-        self.active_visitors = {}
-        self.cleanup_thread = threading.Thread(target=self.cleanup_inactive_visitors, daemon=True)
-        self.cleanup_thread.start()
+        self.lock = threading.Lock()
+        self.values = {}
+        self.version = None
+        self.checked_at = 0
     
-    def track_visitor(self, request):
-        session_id = session.get('session_id')
-        if not session_id:
-            session_id = str(uuid.uuid4())
-            session['session_id'] = session_id
-        
-        ip_address = request.remote_addr
-        user_agent = request.headers.get('User-Agent', '')
-        current_time = datetime.now(timezone.utc)
-        
-        self.active_visitors[session_id] = current_time
-        
-        conn = sqlite3.connect('file_storage.db')
+    def reload(self):
+        conn = get_db_connection()
         cursor = conn.cursor()
+        cursor.execute('SELECT version FROM settings_version WHERE id = 1')
+        version = cursor.fetchone()[0]
+        cursor.execute('SELECT key, value FROM settings')
+        values = {key: parse_setting(key, value) for key, value in cursor.fetchall()}
+        conn.close()
         
-        cursor.execute('SELECT id, page_views FROM visitors WHERE session_id = ?', (session_id,))
-        visitor = cursor.fetchone()
-        
-        if visitor:
-            cursor.execute('''
-                UPDATE visitors 
-                SET last_activity = ?, page_views = page_views + 1, is_active = 1
-                WHERE session_id = ?
-            ''', (current_time, session_id))
-        else:
-            cursor.execute('''
-                INSERT INTO visitors (session_id, ip_address, user_agent, first_visit, last_activity)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (session_id, ip_address, user_agent, current_time, current_time))
+        with self.lock:
+            self.values = values
+            self.version = version
+            self.checked_at = time.monotonic()
+    
+    def refresh_if_stale(self):
+        if self.version is not None and time.monotonic() - self.checked_at < SETTINGS_VERSION_CHECK_SECONDS:
+            return
         
-        conn.commit()
-        conn.close()
+        if self.version is not None:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT version FROM settings_version WHERE id = 1')
+            version = cursor.fetchone()[0]
+            conn.close()
+            
+            if version == self.version:
+                self.checked_at = time.monotonic()
+                return
         
-        return session_id
+        self.reload()
     
-    def get_active_count(self):
-        current_time = datetime.now(timezone.utc)
-        cutoff_time = current_time - timedelta(minutes=5)
+    def get(self, key):
+        self.refresh_if_stale()
+        with self.lock:
+            if key in self.values:
+                return self.values[key]
+        return parse_setting(key, None)
+
+settings_cache = SettingsCache()
+
+# ===== STORAGE BACKENDS =====
+# File content is addressed by key (the stored_name); every read, write and
+# delete of stored content goes through `storage`, never through paths.
+class LocalFileWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+    
+    def write(self, data):
+        self.file.write(data)
+    
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+    
+    def abort(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class LocalStorage:
+    """Files in a directory on this machine.
+
+    Stored objects live in a two-level shard layout (ab/cd/<name>) so no
+    directory grows past a few thousand entries; the shard is part of the key.
+    Staging objects and files from before the layout existed sit flat in root.
+    """
+    
+    is_local = True
+    presigns_downloads = False
+    min_part_size = 1
+    max_parts = None
+    
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+    
+    @staticmethod
+    def shard_key(name):
+        digest = hashlib.md5(name.encode()).hexdigest()
+        return f"{digest[:2]}/{digest[2:4]}/{name}"
+    
+    def path(self, key):
+        """The one place a storage key becomes a filesystem path"""
+        path = os.path.join(self.root, *key.split('/'))
+        if '/' not in key and not os.path.exists(path):
+            # A flat key read just before migrate-storage rewrote it
+            sharded_path = os.path.join(self.root, *self.shard_key(key).split('/'))
+            if os.path.exists(sharded_path):
+                return sharded_path
+        return path
+    
+    def key_for_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+    
+    def staging_key(self, name):
+        return name + '.part'
+    
+    def stat(self, key):
+        """(size, mtime) of a stored object, or None if it does not exist"""
+        try:
+            stat = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime
+    
+    def open_writer(self, key):
+        return LocalFileWriter(self.path(key))
+    
+    def iter_range(self, key, start, stop):
+        with open(self.path(key), 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                buffer = f.read(min(STREAM_BUFFER_SIZE, remaining))
+                if not buffer:
+                    break
+                remaining -= len(buffer)
+                yield buffer
+    
+    def begin_parts(self, key, total_size):
+        # Preallocate so parallel chunks can be written in place at their offsets
+        with open(self.path(key), 'wb') as f:
+            if total_size:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, total_size)
+                except (AttributeError, OSError):
+                    f.truncate(total_size)
+        return None
+    
+    def write_part(self, key, upload_token, part_number, offset, stream, size):
+        """Copy `size` bytes of stream into the object at offset; returns (written, etag)"""
+        written = 0
+        with open(self.path(key), 'r+b') as f:
+            f.seek(offset)
+            while written < size:
+                buffer = stream.read(min(STREAM_BUFFER_SIZE, size - written))
+                if not buffer:
+                    break
+                f.write(buffer)
+                written += len(buffer)
+        return written, None
+    
+    def finish_parts(self, key, upload_token, parts):
+        pass
+    
+    def abort_parts(self, key, upload_token):
+        self.delete(key)
+    
+    def promote(self, staging_key, key):
+        """Make a fully written staging object permanent; returns its final key"""
+        final_key = self.shard_key(key)
+        final_path = self.path(final_key)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(self.path(staging_key), final_path)
+        return final_key
+    
+    def retire(self, key, pending_deletes=None):
+        """Delete an object, or with pending_deletes only move it out of the way and
+        queue it, so the caller can delete after committing. False if it is missing."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
         
-        self.active_visitors = {
-            sid: last_activity for sid, last_activity in self.active_visitors.items()
-            if last_activity > cutoff_time
-        }
+        if pending_deletes is None:
+            os.remove(path)
+        else:
+            # A new upload of the same content may recreate the key right after commit
+            tombstone_path = f"{path}.deleted-{uuid.uuid4().hex}"
+            os.rename(path, tombstone_path)
+            pending_deletes.append(self.key_for_path(tombstone_path))
+        return True
+    
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+    
+    def download_url(self, key, download_name, mime_type):
+        return None
+    
+    def media_source(self, key):
+        """Where ffprobe/ffmpeg read the object from - a path here, a URL for S3"""
+        return self.path(key)
+    
+    def iter_objects(self):
+        """Every stored object as (key, size, mtime) - a full walk, for reconciliation only"""
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield self.key_for_path(path), stat.st_size, stat.st_mtime
+
+class S3MultipartWriter:
+    """Streams an upload to S3: buffers one part, sends it, and so on. Small
+    uploads that never fill a part are sent with a single PUT on close()."""
+    
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+    
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= S3_PART_SIZE:
+            self.send_part(bytes(self.buffer[:S3_PART_SIZE]))
+            del self.buffer[:S3_PART_SIZE]
+    
+    def send_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.storage.begin_parts(self.key, None)
+        part_number = len(self.parts) + 1
+        response = self.storage.client.upload_part(
+            Bucket=self.storage.bucket, Key=self.storage.object_key(self.key),
+            UploadId=self.upload_id, PartNumber=part_number, Body=data)
+        self.parts.append((part_number, response['ETag']))
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.storage.client.put_object(Bucket=self.storage.bucket, Key=self.storage.object_key(self.key),
+                                           Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.send_part(bytes(self.buffer))
+            self.storage.finish_parts(self.key, self.upload_id, self.parts)
+        self.buffer = bytearray()
+    
+    def abort(self):
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            self.storage.abort_parts(self.key, self.upload_id)
+        self.storage.delete(self.key)
+
+class S3Storage:
+    """Objects in an S3-compatible bucket (AWS S3, MinIO, Ceph RGW...).
+
+    Keys are unique per upload, so a staged object is made permanent as is
+    and a released one can be deleted after the transaction commits.
+    """
+    
+    is_local = False
+    min_part_size = 5 * 1024 * 1024
+    max_parts = 10000
+    
+    def __init__(self):
+        credentials = {}
+        if S3_ACCESS_KEY:
+            credentials = {'aws_access_key_id': S3_ACCESS_KEY, 'aws_secret_access_key': S3_SECRET_KEY}
+        config = BotoConfig(signature_version='s3v4', retries={'max_attempts': 5, 'mode': 'standard'},
+                            max_pool_connections=ASGI_IO_THREADS)
+        self.client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION,
+                                   config=config, **credentials)
+        # Presigned URLs are signed for the host the client will actually contact
+        self.presign_client = self.client
+        if S3_PUBLIC_ENDPOINT_URL:
+            self.presign_client = boto3.client('s3', endpoint_url=S3_PUBLIC_ENDPOINT_URL, region_name=S3_REGION,
+                                               config=config, **credentials)
+        self.bucket = S3_BUCKET
+        self.prefix = S3_PREFIX
+        self.presigns_downloads = S3_PRESIGNED_DOWNLOADS
         
-        return len(self.active_visitors)
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchBucket'):
+                raise
+            self.client.create_bucket(Bucket=self.bucket)
     
-    def cleanup_inactive_visitors(self):
-        while True:
+    def object_key(self, key):
+        return self.prefix + key
+    
+    def staging_key(self, name):
+        return name
+    
+    def stat(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response['ContentLength'], response['LastModified'].timestamp()
+    
+    def open_writer(self, key):
+        return S3MultipartWriter(self, key)
+    
+    def iter_range(self, key, start, stop):
+        if stop <= start:
+            return
+        response = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key),
+                                          Range=f'bytes={start}-{stop - 1}')
+        body = response['Body']
+        try:
+            yield from body.iter_chunks(STREAM_BUFFER_SIZE)
+        finally:
+            body.close()
+    
+    def begin_parts(self, key, total_size):
+        if total_size == 0:
+            # S3 multipart uploads need at least one part
+            self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=b'')
+            return None
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.object_key(key))
+        return response['UploadId']
+    
+    def write_part(self, key, upload_token, part_number, offset, stream, size):
+        # upload_part needs a seekable body of known length for retries
+        with tempfile.SpooledTemporaryFile(max_size=S3_PART_SIZE) as body:
+            written = 0
+            while written < size:
+                buffer = stream.read(min(STREAM_BUFFER_SIZE, size - written))
+                if not buffer:
+                    break
+                body.write(buffer)
+                written += len(buffer)
+            if written != size:
+                return written, None
+            
+            body.seek(0)
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.object_key(key),
+                                               UploadId=upload_token, PartNumber=part_number,
+                                               Body=body, ContentLength=size)
+        return written, response['ETag']
+    
+    def finish_parts(self, key, upload_token, parts):
+        if upload_token is None:
+            return
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.object_key(key), UploadId=upload_token,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag} for number, etag in sorted(parts)]})
+    
+    def abort_parts(self, key, upload_token):
+        if upload_token is not None:
             try:
-                time.sleep(300)  # Clean up every 5 minutes
-                current_time = datetime.now(timezone.utc)
-                cutoff_time = current_time - timedelta(minutes=10)
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_key(key),
+                                                   UploadId=upload_token)
+            except ClientError as e:
+                logger.error(f"Abort multipart upload {key} error: {e}")
+        self.delete(key)
+    
+    def promote(self, staging_key, key):
+        return staging_key
+    
+    def retire(self, key, pending_deletes=None):
+        # Deleting a missing object is not an error in S3, no need to check first
+        if pending_deletes is None:
+            self.delete(key)
+        else:
+            pending_deletes.append(key)
+        return True
+    
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+        return True
+    
+    def download_url(self, key, download_name, mime_type):
+        if not self.presigns_downloads:
+            return None
+        return self.presign_client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.object_key(key),
+            'ResponseContentDisposition': content_disposition(download_name),
+            'ResponseContentType': mime_type
+        }, ExpiresIn=S3_PRESIGN_EXPIRES)
+    
+    def media_source(self, key):
+        # ffmpeg reads over HTTP with range requests instead of fetching a whole video
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.object_key(key)
+        }, ExpiresIn=S3_PRESIGN_EXPIRES)
+    
+    def iter_objects(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):], obj['Size'], obj['LastModified'].timestamp()
+
+def create_storage_backend():
+    if STORAGE_BACKEND == 's3':
+        if boto3 is None:
+            raise RuntimeError('STORAGE_BACKEND=s3 requires boto3 (pip install boto3)')
+        return S3Storage()
+    return LocalStorage(STORAGE_FOLDER)
+
+storage = None if MEDIA_WORKER_PROCESS else create_storage_backend()
+
+def migrate_storage_layout(batch_size=STORAGE_SHARD_MIGRATION_BATCH, grace_seconds=STORAGE_SHARD_MIGRATION_GRACE):
+    """Move flat files in STORAGE_FOLDER into the shard layout while the service
+    keeps running. Each file is hard-linked at its new path, every row naming it
+    is rewritten in one short transaction, and the old link is removed after
+    grace_seconds so requests that already read the old stored_name still work."""
+    if not storage.is_local:
+        return {'moved': 0, 'missing': 0, 'skipped': 0}
+    
+    moved = missing = skipped = 0
+    old_links = []  # (unlink after, path)
+    
+    def unlink_old(path):
+        # Not storage.delete(): for a flat key that resolves to the new shard path
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    
+    for table in ('files', 'blobs'):
+        last_rowid = 0
+        while True:
+            while old_links and old_links[0][0] <= time.monotonic():
+                unlink_old(old_links.pop(0)[1])
+            
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT rowid, stored_name FROM {table}
+                WHERE rowid > ? AND stored_name NOT LIKE '%/%'
+                ORDER BY rowid LIMIT ?
+            ''', (last_rowid, batch_size))
+            rows = cursor.fetchall()
+            conn.close()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            
+            # Rows sharing content name the same file - one rewrite covers them all
+            for name in dict.fromkeys(name for _, name in rows):
+                old_path = os.path.join(storage.root, name)
+                new_key = storage.shard_key(name)
+                new_path = os.path.join(storage.root, *new_key.split('/'))
+                if not os.path.exists(old_path):
+                    # Rewritten by an earlier row sharing this content, or really missing
+                    if not os.path.exists(new_path):
+                        missing += 1
+                    continue
                 
-                conn = sqlite3.connect('file_storage.db')
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                if not os.path.exists(new_path):
+                    os.link(old_path, new_path)
+                
+                conn = get_db_connection()
                 cursor = conn.cursor()
-                cursor.execute('UPDATE visitors SET is_active = 0 WHERE last_activity < ?', (cutoff_time,))
+                conn.execute('BEGIN IMMEDIATE')
+                cursor.execute('UPDATE files SET stored_name = ? WHERE stored_name = ?', (new_key, name))
+                updated = cursor.rowcount
+                cursor.execute('UPDATE blobs SET stored_name = ? WHERE stored_name = ?', (new_key, name))
+                updated += cursor.rowcount
+                # Previews keep their old key, only the rows naming the content move
+                cursor.execute('UPDATE media_jobs SET stored_name = ? WHERE stored_name = ?', (new_key, name))
+                cursor.execute('UPDATE media_info SET stored_name = ? WHERE stored_name = ?', (new_key, name))
                 conn.commit()
                 conn.close()
                 
-            except Exception as e:
-                logger.error(f"Visitor cleanup error: {e}")
+                if updated:
+                    old_links.append((time.monotonic() + grace_seconds, old_path))
+                    moved += 1
+                else:
+                    # Deleted by cleanup in the meantime - drop the new link again
+                    os.remove(new_path)
+                    skipped += 1
+    
+    for unlink_at, path in old_links:
+        time.sleep(max(0, unlink_at - time.monotonic()))
+        unlink_old(path)
+    
+    return {'moved': moved, 'missing': missing, 'skipped': skipped}
+
+# ===== COMPRESSION AT REST =====
+# Stored objects of compressible uploads are a series of independent zstd
+# frames, each holding COMPRESSION_FRAME_SIZE bytes of the upload. Checksums,
+# file sizes and the usage ledger always refer to the original content.
+
+# Types that are compressed already (or are media) - another pass only costs CPU
+INCOMPRESSIBLE_MIME_TYPES = {
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/vnd.rar',
+    'application/x-7z-compressed', 'application/x-bzip2', 'application/x-xz', 'application/zstd',
+    'application/x-rar-compressed', 'application/java-archive', 'application/vnd.android.package-archive',
+    'application/epub+zip', 'application/pdf',
+}
+INCOMPRESSIBLE_MIME_PREFIXES = ('image/', 'video/', 'audio/', 'application/vnd.openxmlformats-',
+                                'application/vnd.oasis.opendocument.')
+
+def compression_enabled():
+    return zstandard is not None and settings_cache.get('compression_enabled')
+
+def is_compressible(mime_type, file_type):
+    """Worth sampling: documents and unknown types that are not a compressed format"""
+    if file_type not in ('document', 'other'):
+        return False
+    mime_type = mime_type or ''
+    return mime_type not in INCOMPRESSIBLE_MIME_TYPES and not mime_type.startswith(INCOMPRESSIBLE_MIME_PREFIXES)
+
+def pack_frame_index(frame_sizes):
+    frames = array.array('I', frame_sizes)
+    if sys.byteorder == 'big':
+        frames.byteswap()
+    return frames.tobytes()
+
+def unpack_frame_index(data):
+    frames = array.array('I')
+    frames.frombytes(data)
+    if sys.byteorder == 'big':
+        frames.byteswap()
+    return frames
+
+# What store_blob records about an object that is not stored as is
+BlobEncoding = namedtuple('BlobEncoding', ['codec', 'stored_size', 'frame_size', 'frame_index', 'compress_seconds'])
+
+class ZstdFrameWriter:
+    """Compresses what is written to it into a storage writer, one zstd frame
+    per COMPRESSION_FRAME_SIZE input bytes, noting each frame's length and the
+    CPU time spent."""
+    
+    def __init__(self, file):
+        self.file = file
+        self.compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, write_content_size=True)
+        self.buffer = bytearray()
+        self.frame_sizes = []
+        self.cpu_seconds = 0.0
+    
+    def compress(self, data):
+        started = time.thread_time()
+        frame = self.compressor.compress(data)
+        self.cpu_seconds += time.thread_time() - started
+        return frame
+    
+    def append(self, frame):
+        self.file.write(frame)
+        self.frame_sizes.append(len(frame))
+    
+    def start(self, first):
+        """Compress the first frame; False, with nothing written, when it does
+        not save COMPRESSION_MIN_SAVINGS and the content is better stored as is"""
+        frame = self.compress(first)
+        if len(frame) > len(first) * (1 - COMPRESSION_MIN_SAVINGS):
+            return False
+        self.append(frame)
+        return True
+    
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= COMPRESSION_FRAME_SIZE:
+            self.append(self.compress(bytes(self.buffer[:COMPRESSION_FRAME_SIZE])))
+            del self.buffer[:COMPRESSION_FRAME_SIZE]
+    
+    def close(self):
+        if self.buffer:
+            self.append(self.compress(bytes(self.buffer)))
+            self.buffer = bytearray()
+        self.file.close()
+    
+    def abort(self):
+        self.buffer = bytearray()
+        self.file.abort()
+    
+    @property
+    def encoding(self):
+        return BlobEncoding('zstd', sum(self.frame_sizes), COMPRESSION_FRAME_SIZE,
+                            pack_frame_index(self.frame_sizes), round(self.cpu_seconds, 6))
+
+def compress_staged_object(staging_key, size, mime_type, filename):
+    """Write a compressed copy of a fully staged object under a new staging
+    key, for uploads that could not be compressed as they streamed in (chunks
+    arrive out of order). Returns (key, BlobEncoding), or None when the
+    content is stored as is."""
+    if not compression_enabled() or size < COMPRESSION_MIN_BYTES or not is_compressible(mime_type, get_file_type(filename)):
+        return None
+    
+    first = b''.join(storage.iter_range(staging_key, 0, min(COMPRESSION_FRAME_SIZE, size)))
+    compressed_key = storage.staging_key(f'{uuid.uuid4().hex}.zst')
+    encoder = ZstdFrameWriter(storage.open_writer(compressed_key))
+    try:
+        if not encoder.start(first):
+            encoder.abort()
+            return None
+        for buffer in storage.iter_range(staging_key, len(first), size):
+            encoder.write(buffer)
+        encoder.close()
+    except Exception:
+        encoder.abort()
+        raise
+    return compressed_key, encoder.encoding
+
+def get_compression_stats(cursor):
+    cursor.execute('''
+        SELECT compressed_count, compressed_bytes, compressed_stored_bytes, compress_seconds
+        FROM storage_totals WHERE id = 1
+    ''')
+    count, original_bytes, stored_bytes, cpu_seconds = cursor.fetchone()
+    
+    return {
+        'enabled': bool(compression_enabled()),
+        'available': zstandard is not None,
+        'compressed_blobs': count,
+        'original_bytes': original_bytes,
+        'stored_bytes': stored_bytes,
+        'bytes_saved': original_bytes - stored_bytes,
+        'ratio': round(original_bytes / stored_bytes, 2) if stored_bytes else 1.0,
+        'cpu_seconds': round(cpu_seconds, 2),
+        'mb_per_cpu_second': round(original_bytes / (1024 * 1024) / cpu_seconds, 1) if cpu_seconds else None
+    }
+
+def benchmark_compression(paths=None, levels=COMPRESSION_BENCHMARK_LEVELS, max_bytes=COMPRESSION_BENCHMARK_BYTES):
+    """Disk savings against CPU cost of each zstd level, framed like stored
+    objects. Runs over the given files, or else over stored uploads that would
+    be compressed but were stored as is (newest first). Returns one row per level."""
+    if zstandard is None:
+        raise RuntimeError('benchmark-compression requires zstandard (pip install zstandard)')
+    
+    def read_path(path):
+        with open(path, 'rb') as f:
+            while True:
+                buffer = f.read(STREAM_BUFFER_SIZE)
+                if not buffer:
+                    return
+                yield buffer
+    
+    sources = []
+    if paths:
+        sources = [lambda path=path: read_path(path) for path in paths]
+    else:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT DISTINCT f.stored_name, f.file_size, f.mime_type, f.file_type
+            FROM files f LEFT JOIN blobs b ON b.hash = f.checksum
+            WHERE b.codec IS NULL ORDER BY f.uploaded_at DESC
+        ''')
+        for stored_name, file_size, mime_type, file_type in cursor.fetchall():
+            if is_compressible(mime_type, file_type):
+                sources.append(lambda key=stored_name, size=file_size: storage.iter_range(key, 0, size))
+        conn.close()
+    
+    # The sample, cut into frames the way uploads are
+    frames = []
+    total = files = 0
+    for read_source in sources:
+        if total >= max_bytes:
+            break
+        files += 1
+        pending = bytearray()
+        for buffer in read_source():
+            pending += buffer[:max_bytes - total - len(pending)]
+            while len(pending) >= COMPRESSION_FRAME_SIZE:
+                frames.append(bytes(pending[:COMPRESSION_FRAME_SIZE]))
+                del pending[:COMPRESSION_FRAME_SIZE]
+                total += COMPRESSION_FRAME_SIZE
+            if total + len(pending) >= max_bytes:
+                break
+        if pending:
+            frames.append(bytes(pending))
+            total += len(pending)
+    
+    results = []
+    for level in levels:
+        compressor = zstandard.ZstdCompressor(level=level, write_content_size=True)
+        decompressor = zstandard.ZstdDecompressor()
+        started = time.thread_time()
+        compressed = [compressor.compress(frame) for frame in frames]
+        compress_seconds = time.thread_time() - started
+        started = time.thread_time()
+        for frame in compressed:
+            decompressor.decompress(frame)
+        decompress_seconds = time.thread_time() - started
+        
+        stored = sum(len(frame) for frame in compressed)
+        megabytes = total / (1024 * 1024)
+        results.append({
+            'level': level,
+            'files': files,
+            'original_bytes': total,
+            'stored_bytes': stored,
+            'ratio': round(total / stored, 2) if stored else 1.0,
+            'saved_percent': round(100 * (total - stored) / total, 1) if total else 0.0,
+            'compress_mb_per_second': round(megabytes / compress_seconds, 1) if compress_seconds else None,
+            'decompress_mb_per_second': round(megabytes / decompress_seconds, 1) if decompress_seconds else None
+        })
+    return results
+
+# ===== BLOB STORE =====
+def hash_stored_file(key, size):
+    sha256 = hashlib.sha256()
+    for buffer in storage.iter_range(key, 0, size):
+        sha256.update(buffer)
+    return sha256.hexdigest()
+
+# Leading-byte signatures for common upload types: (offset, magic, mime type)
+MIME_SIGNATURES = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (0, b"7z\xbc\xaf\x27\x1c", 'application/x-7z-compressed'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'\x1a\x45\xdf\xa3', 'video/webm'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (4, b'ftyp', 'video/mp4'),
+    (257, b'ustar', 'application/x-tar'),
+]
+
+def sniff_mime_type(head, filename, declared=None):
+    """Content type from the upload's leading bytes, falling back to the
+    extension and then to what the client declared"""
+    guessed = mimetypes.guess_type(filename)[0]
+    
+    for offset, magic, mime_type in MIME_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            # Office documents, jars, apks... are zip containers - keep the specific type
+            if mime_type == 'application/zip' and guessed:
+                return guessed
+            return mime_type
+    
+    if head.startswith(b'RIFF') and len(head) >= 12:
+        return {b'WAVE': 'audio/wav', b'WEBP': 'image/webp', b'AVI ': 'video/x-msvideo'}.get(
+            head[8:12], guessed or 'application/octet-stream')
+    
+    if guessed:
+        return guessed
+    if head and b'\x00' not in head:
+        try:
+            head.decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError:
+            pass
+    return declared or 'application/octet-stream'
+
+class UploadTooLarge(ValueError):
+    """An upload went past max_file_size_gb while it was being written"""
+
+class IngestWriter:
+    """Writes upload data straight to its storage location, computing size,
+    SHA-256 and the leading bytes for MIME sniffing in the same pass.
+
+    With compression enabled the first frame's worth of data is held back:
+    if the type is compressible and that sample shrinks enough, the upload
+    is stored through a ZstdFrameWriter, otherwise as is.
+
+    max_size is enforced on the bytes actually written, so a body without a
+    Content-Length (chunked transfer-encoding) cannot go past it either.
+    """
+    
+    def __init__(self, staging_key, filename=None, declared_mime_type=None, max_size=None):
+        self.staging_key = staging_key
+        self.filename = filename
+        self.declared_mime_type = declared_mime_type
+        self.max_size = max_size
+        self.file = storage.open_writer(staging_key)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.encoder = None
+        self.sample = bytearray() if filename and compression_enabled() else None
+    
+    def write(self, data):
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            raise UploadTooLarge(f'Upload is larger than {self.max_size} bytes')
+        if len(self.head) < MIME_SNIFF_BYTES:
+            self.head += data[:MIME_SNIFF_BYTES - len(self.head)]
+        self.sha256.update(data)
+        self.size += len(data)
+        if self.sample is None:
+            self.file.write(data)
+            return
+        self.sample += data
+        if len(self.sample) >= COMPRESSION_FRAME_SIZE:
+            self.choose_encoding()
+    
+    def choose_encoding(self):
+        sample, self.sample = bytes(self.sample), None
+        mime_type = sniff_mime_type(self.head, self.filename, self.declared_mime_type)
+        if len(sample) >= COMPRESSION_MIN_BYTES and is_compressible(mime_type, get_file_type(self.filename)):
+            encoder = ZstdFrameWriter(self.file)
+            first = sample[:COMPRESSION_FRAME_SIZE]
+            if encoder.start(first):
+                encoder.write(sample[len(first):])
+                self.file = self.encoder = encoder
+                return
+        self.file.write(sample)
+    
+    def close(self):
+        if self.sample is not None:
+            self.choose_encoding()
+        self.file.close()
+    
+    @property
+    def encoding(self):
+        """BlobEncoding of the stored object, None when it is stored as is"""
+        return self.encoder.encoding if self.encoder else None
+    
+    def discard(self):
+        self.file.abort()
+    
+    @property
+    def checksum(self):
+        return self.sha256.hexdigest()
+
+class MultipartIngest:
+    """Incremental multipart/form-data parser: feed() it body buffers as they
+    arrive and the `file_field` part is written through an IngestWriter, other
+    fields are collected in `form`. Used by both the WSGI and ASGI paths."""
+    
+    def __init__(self, boundary, staging_key, file_field='file', max_size=None):
+        self.decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self.staging_key = staging_key
+        self.file_field = file_field
+        self.max_size = max_size
+        self.form = {}
+        self.writer = self.filename = self.declared_mime_type = None
+        self.field_name = self.field_value = None
+        self.writing_file = False
+        self.finished = False
+    
+    def feed(self, buffer):
+        """Process the next body buffer; pass b'' or None at end of body"""
+        self.decoder.receive_data(buffer or None)
+        
+        event = self.decoder.next_event()
+        while event is not NEED_DATA and not isinstance(event, Epilogue):
+            if isinstance(event, File) and event.name == self.file_field and self.writer is None:
+                self.filename = event.filename
+                self.declared_mime_type = event.headers.get('Content-Type')
+                self.writer = IngestWriter(self.staging_key, self.filename, self.declared_mime_type, self.max_size)
+                self.writing_file, self.field_name = True, None
+            elif isinstance(event, Field):
+                self.writing_file, self.field_name, self.field_value = False, event.name, bytearray()
+            elif isinstance(event, File):
+                # Extra file parts are drained and ignored
+                self.writing_file, self.field_name = False, None
+            elif isinstance(event, Data):
+                if self.writing_file:
+                    self.writer.write(event.data)
+                elif self.field_name is not None:
+                    self.field_value += event.data
+                    if len(self.field_value) > MAX_FORM_FIELD_SIZE:
+                        raise ValueError(f'Form field {self.field_name} is too large')
+                if not event.more_data:
+                    if self.field_name is not None:
+                        # First value wins, like request.form.get()
+                        self.form.setdefault(self.field_name, self.field_value.decode('utf-8', 'replace'))
+                    self.writing_file, self.field_name = False, None
+            event = self.decoder.next_event()
+        
+        if not buffer or isinstance(event, Epilogue):
+            self.finished = True
+            if self.writer:
+                self.writer.close()
+    
+    def discard(self):
+        if self.writer:
+            self.writer.discard()
+    
+    def result(self):
+        return self.writer, self.filename, self.declared_mime_type, self.form
+
+def ingest_multipart_upload(staging_key, file_field='file', max_size=None):
+    """Parse a multipart/form-data request body as it arrives, writing the
+    `file_field` part through an IngestWriter instead of letting werkzeug spool
+    it to a temporary file first.
+
+    Returns (writer, filename, declared_mime_type, form) - writer is None when
+    the request carried no file part. Raises UploadTooLarge, with the staged
+    data removed, once the file part passes max_size.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return None, None, None, {}
+    
+    ingest = MultipartIngest(boundary, staging_key, file_field, max_size)
+    stream = get_upload_stream()
+    try:
+        while not ingest.finished:
+            ingest.feed(stream.read(STREAM_BUFFER_SIZE))
+    except Exception:
+        ingest.discard()
+        raise
+    
+    return ingest.result()
+
+def store_blob(staging_key, checksum, size, encoding=None):
+    """Move a fully written upload into the blob store, or drop it if the same
+    content is already stored. Returns the blob's stored_name.
+
+    encoding is the BlobEncoding of a compressed staging object; an existing
+    blob of the same content is kept however it is stored."""
+    conn = get_db_connection()
+    try:
+        # IMMEDIATE takes the write lock up front so a concurrent release cannot
+        # unlink the blob between our refcount check and the rename
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.cursor()
+        cursor.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (checksum,))
+        
+        if cursor.rowcount:
+            cursor.execute('SELECT stored_name FROM blobs WHERE hash = ?', (checksum,))
+            stored_name = cursor.fetchone()[0]
+            storage.delete(staging_key)
+        else:
+            stored_name = storage.promote(staging_key, checksum)
+            codec, stored_size, frame_size, frame_index, compress_seconds = encoding or (None,) * 5
+            cursor.execute('''
+                INSERT INTO blobs (hash, stored_name, size, codec, stored_size, frame_size, frame_index, compress_seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (checksum, stored_name, size, codec, stored_size, frame_size, frame_index, compress_seconds))
+        
+        conn.commit()
+        return stored_name
+    finally:
+        conn.close()
+
+def release_stored_file(cursor, stored_name, checksum, pending_deletes=None):
+    """Drop one reference to a file's content; the stored object is only
+    deleted when its last reference goes away. Returns True if it was released.
+
+    Must run inside the caller's write transaction so the delete and the blob
+    row removal are atomic with respect to store_blob(). With pending_deletes
+    the object is only retired (renamed aside on local disk) and its key
+    appended, so the caller can delete it after committing."""
+    released = False
+    for key in release_stored_rows(cursor, stored_name, checksum):
+        released = storage.retire(key, pending_deletes)
+    return released
+
+def release_stored_rows(cursor, stored_name, checksum):
+    """The database half of release_stored_file(): drop the reference and
+    return the keys to retire, the stored object last - none while other
+    references remain. The caller retires them in the same transaction."""
+    if checksum:
+        cursor.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?', (checksum,))
+        if cursor.rowcount:
+            cursor.execute('SELECT refcount FROM blobs WHERE hash = ?', (checksum,))
+            if cursor.fetchone()[0] > 0:
+                return []
+            cursor.execute('DELETE FROM blobs WHERE hash = ?', (checksum,))
+            frame_index_cache.invalidate(checksum)
+    
+    # Last reference, or a file stored before the blob store existed
+    hot_files.discard(stored_name)
+    preview_key = release_media(cursor, stored_name)
+    return [preview_key, stored_name] if preview_key else [stored_name]
+
+def get_storage_usage(cursor):
+    """Storage totals from the ledger - a few rows, however many files are stored"""
+    cursor.execute('SELECT blob_count + unblobbed_count, blob_bytes + unblobbed_bytes FROM storage_totals WHERE id = 1')
+    stored_files, stored_bytes = cursor.fetchone()
+    cursor.execute('SELECT file_type, file_count, total_bytes FROM storage_usage WHERE file_count > 0 ORDER BY total_bytes DESC')
+    by_type = {file_type: {'files': count, 'bytes': total_bytes} for file_type, count, total_bytes in cursor.fetchall()}
+    
+    return {'stored_files': stored_files, 'stored_bytes': stored_bytes, 'by_type': by_type}
+
+def get_dedup_stats(cursor):
+    cursor.execute('SELECT blob_count, blob_bytes, shared_bytes FROM storage_totals WHERE id = 1')
+    blob_count, blob_bytes, bytes_saved = cursor.fetchone()
+    
+    return {
+        'blob_count': blob_count,
+        'stored_bytes': blob_bytes,
+        'logical_bytes': blob_bytes + bytes_saved,
+        'bytes_saved': bytes_saved,
+        'dedup_ratio': round((blob_bytes + bytes_saved) / blob_bytes, 2) if blob_bytes else 1.0
+    }
+
+# ===== EVENT BUS =====
+class EventBus:
+    """Fans dashboard events out to open admin streams.
+
+    Every subscriber gets its own bounded queue and publishing never blocks:
+    a subscriber that falls behind is flagged and resynced from a snapshot
+    instead. The bus is per process - with several workers a stream only
+    sees its own worker's deltas, and its periodic snapshot covers the rest."""
+    
+    def __init__(self, queue_size):
+        self.lock = threading.Lock()
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.overflowed = set()
+    
+    def subscribe(self, subscriber=None):
+        """Register a subscriber: a new bounded queue.Queue, or anything with
+        its put_nowait/get_nowait interface (see AsyncSubscriber)"""
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            self.overflowed.discard(subscriber)
+    
+    def has_subscribers(self):
+        return bool(self.subscribers)
+    
+    def publish(self, event, data):
+        if not self.subscribers:
+            return
+        with self.lock:
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.put_nowait((event, data))
+                except queue.Full:
+                    self.overflowed.add(subscriber)
+    
+    def take_overflow(self, subscriber):
+        """True (and the stale backlog is dropped) if the subscriber missed events"""
+        with self.lock:
+            if subscriber not in self.overflowed:
+                return False
+            self.overflowed.discard(subscriber)
+            while True:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    return True
+    
+    def get_stats(self):
+        return {'subscribers': len(self.subscribers)}
+
+event_bus = EventBus(ADMIN_STREAM_QUEUE_SIZE)
+
+class AsyncSubscriber:
+    """event_bus subscriber for a stream served on the event loop: publishers
+    on any thread hand events over with call_soon_threadsafe, and the stream
+    awaits them without holding a thread. Bounded like queue.Queue."""
+    
+    def __init__(self, maxsize):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.size = 0
+    
+    def put_nowait(self, item):
+        with self.lock:
+            if self.size >= self.maxsize:
+                raise queue.Full
+            self.size += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+    
+    def get_nowait(self):
+        """Only called on the event loop (take_overflow() from the stream)"""
+        try:
+            item = self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            raise queue.Empty
+        with self.lock:
+            self.size -= 1
+        return item
+    
+    async def get(self):
+        item = await self.queue.get()
+        with self.lock:
+            self.size -= 1
+        return item
+
+# ===== HOMEPAGE CACHE =====
+class SiteStats:
+    """Homepage totals kept in memory. Uploads and downloads adjust them in
+    place; cleanup invalidates them, and they are re-read from SQLite every
+    STATS_RESYNC_SECONDS so files expiring (and other workers) are picked up."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.totals = {'total_files': 0, 'total_size': 0, 'total_downloads': 0}
+    
+    def load(self):
+        current_time = datetime.now(timezone.utc)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*), SUM(file_size) FROM files WHERE expires_at > ?', (current_time,))
+        total_files, total_size = cursor.fetchone()
+        cursor.execute('SELECT download_total FROM storage_totals WHERE id = 1')
+        total_downloads = cursor.fetchone()[0]
+        conn.close()
+        
+        with self.lock:
+            self.totals = {
+                'total_files': total_files,
+                'total_size': total_size or 0,
+                'total_downloads': total_downloads
+            }
+            self.loaded_at = time.monotonic()
+    
+    def get(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > STATS_RESYNC_SECONDS:
+            self.load()
+        with self.lock:
+            return dict(self.totals)
+    
+    def record_upload(self, file_size):
+        with self.lock:
+            self.totals['total_files'] += 1
+            self.totals['total_size'] += file_size
+        event_bus.publish('upload', {'files': 1, 'bytes': file_size})
+    
+    def record_download(self, count=1):
+        with self.lock:
+            self.totals['total_downloads'] += count
+        event_bus.publish('download', {'downloads': count})
+    
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+class TTLCache:
+    """Small keyed cache for values that may be a few seconds stale"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+    
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+        
+        value = loader()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+        return value
+    
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+class LRUCache:
+    """Bounded keyed cache that evicts the least recently used entry"""
+    
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+    
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+site_stats = SiteStats()
+homepage_cache = TTLCache(HOMEPAGE_CACHE_TTL)
+
+def invalidate_file_caches():
+    """Call after files are deleted outside the normal upload/download paths"""
+    site_stats.invalidate()
+    homepage_cache.invalidate('recent_files')
+
+def publish_cleanup(deleted_count, bytes_freed):
+    """Deleted files take their downloads with them, so ship fresh totals too"""
+    if not event_bus.has_subscribers():
+        return
+    totals = site_stats.get()
+    event_bus.publish('cleanup', {
+        'deleted': deleted_count,
+        'bytes_freed': bytes_freed,
+        'total_files': totals['total_files'],
+        'total_downloads': totals['total_downloads']
+    })
+
+# ===== HOT FILE CACHE =====
+# Halves every counter of a FrequencySketch row
+SKETCH_HALVE = bytes(value >> 1 for value in range(256))
+
+class FrequencySketch:
+    """TinyLFU frequency sketch: approximate request counts for any number of
+    keys in fixed memory. Counters saturate at 15 and are all halved every
+    10 x width requests, so popularity fades once the requests stop."""
+    
+    DEPTH = 4
+    
+    def __init__(self, width):
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in range(self.DEPTH)]
+        self.additions = 0
+        self.sample_size = 10 * width
+    
+    def slots(self, key):
+        return [hash((row, key)) & self.mask for row in range(self.DEPTH)]
+    
+    def estimate(self, key):
+        return min(row[slot] for row, slot in zip(self.rows, self.slots(key)))
+    
+    def increment(self, key):
+        slots = self.slots(key)
+        current = min(row[slot] for row, slot in zip(self.rows, slots))
+        if current < 15:
+            # Conservative update: only the counters holding the minimum move
+            for row, slot in zip(self.rows, slots):
+                if row[slot] == current:
+                    row[slot] += 1
+        
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                row[:] = row.translate(SKETCH_HALVE)
+            self.additions //= 2
+
+class HotFileCache:
+    """Keeps popular files off the storage path.
+
+    Every download request is counted in a FrequencySketch, keyed by stored
+    object so deduplicated uploads share their popularity. Small files that
+    become hot are held in a bounded in-memory LRU. When it is full a file is
+    only admitted if it is requested more often than everything it would
+    evict (TinyLFU), so a burst of one-off downloads cannot flush the popular
+    set. Large hot files on local disk get a readahead hint instead, so their
+    pages are in the page cache before sendfile or the front server read them.
+    """
+    
+    def __init__(self, max_bytes, max_file_bytes):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.sketch = FrequencySketch(HOT_SKETCH_WIDTH)
+        self.entries = OrderedDict()  # stored_name -> (content, stat)
+        self.size = 0
+        self.prefetched = {}  # stored_name -> when its last readahead hint was given
+        self.stats = dict.fromkeys(['hits', 'misses', 'admitted', 'rejected', 'evicted', 'prefetched'], 0)
+    
+    def lookup(self, stored_name):
+        """Count a request; returns (content, stat) when the file is in memory"""
+        with self.lock:
+            self.sketch.increment(stored_name)
+            entry = self.entries.get(stored_name)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(stored_name)
+            self.stats['hits'] += 1
+            return entry
+    
+    def admit(self, stored_name, stat, in_memory=True):
+        """After a miss: load a hot file into memory (returns (content, stat)),
+        or hint readahead when it is too large or served by the front server"""
+        size = stat[0]
+        with self.lock:
+            frequency = self.sketch.estimate(stored_name)
+            if frequency < HOT_FILE_MIN_REQUESTS:
+                return None
+            
+            load = in_memory and size <= self.max_file_bytes
+            if load and not self.has_room(size, frequency):
+                self.stats['rejected'] += 1
+                return None
+            if not load:
+                now = time.monotonic()
+                if not storage.is_local or now - self.prefetched.get(stored_name, 0) < HOT_PREFETCH_INTERVAL:
+                    return None
+                self.prefetched[stored_name] = now
+                if len(self.prefetched) > HOT_SKETCH_WIDTH:
+                    self.prefetched = {k: t for k, t in self.prefetched.items() if now - t < HOT_PREFETCH_INTERVAL}
+        
+        if not load:
+            self.prefetch(stored_name, size)
+            return None
+        
+        content = b''.join(storage.iter_range(stored_name, 0, size))
+        if len(content) != size:
+            return None
+        
+        with self.lock:
+            if stored_name not in self.entries:
+                while self.entries and self.size + size > self.max_bytes:
+                    _, (evicted, _) = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+                    self.stats['evicted'] += 1
+                self.entries[stored_name] = (content, stat)
+                self.size += size
+                self.stats['admitted'] += 1
+            return self.entries[stored_name]
+    
+    def has_room(self, size, frequency):
+        """Whether evicting colder entries (least recently used first) frees enough space (lock held)"""
+        room = self.max_bytes - self.size
+        for stored_name, (content, _) in self.entries.items():
+            if room >= size:
+                break
+            if self.sketch.estimate(stored_name) >= frequency:
+                return False
+            room += len(content)
+        return room >= size
+    
+    def prefetch(self, stored_name, size):
+        try:
+            fd = os.open(storage.path(stored_name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+            with self.lock:
+                self.stats['prefetched'] += 1
+        except (AttributeError, OSError):
+            # No posix_fadvise on this platform, or the file is gone
+            pass
+    
+    def discard(self, stored_name):
+        with self.lock:
+            entry = self.entries.pop(stored_name, None)
+            if entry:
+                self.size -= len(entry[0])
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+    
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_ratio': round(self.stats['hits'] / lookups, 3) if lookups else 0.0,
+                'files': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes
+            }
+
+hot_files = HotFileCache(HOT_CACHE_MAX_BYTES, HOT_FILE_MAX_BYTES)
+
+# ===== SHARE CODE CACHE =====
+# What share_page, download_file and media_preview need from a files row and its
+# media results; expires_at is parsed once
+FileRecord = namedtuple('FileRecord', [
+    'id', 'original_name', 'stored_name', 'file_type', 'file_size', 'mime_type', 'password',
+    'download_limit', 'download_count', 'expires_at', 'description', 'checksum',
+    'preview_key', 'width', 'height', 'duration', 'media_pending', 'codec'
+])
+
+def load_file_record(share_code):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT f.id, f.original_name, f.stored_name, f.file_type, f.file_size, f.mime_type, f.password,
+               f.download_limit, f.download_count, f.expires_at, f.description, f.checksum,
+               m.preview_key, m.width, m.height, m.duration, j.stored_name IS NOT NULL, b.codec
+        FROM files f
+        LEFT JOIN media_info m ON m.stored_name = f.stored_name
+        LEFT JOIN media_jobs j ON j.stored_name = f.stored_name
+        LEFT JOIN blobs b ON b.hash = f.checksum
+        WHERE f.share_code = ?
+    ''', (share_code,))
+    row = cursor.fetchone()
+    conn.close()
+    
+    if not row:
+        return None
+    
+    expires_at = row[9]
+    if expires_at:
+        expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+    return FileRecord(*row[:9], expires_at, *row[10:])
+
+class ShareCodeCache:
+    """FileRecords by share code, so repeated views and downloads skip SQLite.
+
+    A record is reused until its file expires, for at most SHARE_CODE_CACHE_TTL
+    seconds. Unknown codes are remembered for SHARE_CODE_NEGATIVE_TTL in a
+    separate LRU, so bots probing random codes neither reach the database nor
+    evict real records. Uploads, cleanup, clear-all and committed downloads
+    invalidate entries in this process; other workers' changes show up when
+    the entry times out.
+    """
+    
+    def __init__(self, max_items, negative_items):
+        self.lock = threading.Lock()
+        self.entries = LRUCache(max_items)  # share_code -> (deadline, FileRecord)
+        self.missing = LRUCache(negative_items)  # share_code -> deadline
+        self.codes_by_id = {}  # file id -> share_code, to invalidate by file
+        self.max_items = max_items
+        self.generation = 0
+        self.stats = dict.fromkeys(['hits', 'negative_hits', 'misses'], 0)
+    
+    def get(self, share_code):
+        """The FileRecord for share_code, or None when there is no such file"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(share_code)
+            if entry and entry[0] > now:
+                self.stats['hits'] += 1
+                return entry[1]
+            deadline = self.missing.get(share_code)
+            if deadline and deadline > now:
+                self.stats['negative_hits'] += 1
+                return None
+            
+            self.stats['misses'] += 1
+            generation = self.generation
+        record = load_file_record(share_code)
+        
+        with self.lock:
+            # Invalidated while loading - the row may already be stale, don't keep it
+            if generation != self.generation:
+                return record
+            
+            if record is None:
+                self.missing.put(share_code, now + SHARE_CODE_NEGATIVE_TTL)
+                return None
+            
+            ttl = SHARE_CODE_CACHE_TTL
+            if record.expires_at:
+                remaining = (record.expires_at - datetime.now(timezone.utc)).total_seconds()
+                if remaining > 0:
+                    ttl = min(ttl, remaining)
+            if record.media_pending:
+                # Pick up the preview soon after it is made
+                ttl = min(ttl, MEDIA_PENDING_CACHE_TTL)
+            self.entries.put(share_code, (now + ttl, record))
+            self.codes_by_id[record.id] = share_code
+            if len(self.codes_by_id) > 2 * self.max_items:
+                self.codes_by_id = {entry[1].id: code for code, entry in self.entries.entries.items()}
+        return record
+    
+    def invalidate(self, share_code=None):
+        with self.lock:
+            self.generation += 1
+            if share_code is None:
+                self.codes_by_id.clear()
+            self.entries.invalidate(share_code)
+            self.missing.invalidate(share_code)
+    
+    def invalidate_files(self, file_ids):
+        with self.lock:
+            self.generation += 1
+            for file_id in file_ids:
+                share_code = self.codes_by_id.pop(file_id, None)
+                if share_code:
+                    self.entries.invalidate(share_code)
+    
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = sum(stats.values())
+        return {
+            **stats,
+            'hit_ratio': round((stats['hits'] + stats['negative_hits']) / lookups, 3) if lookups else 0.0,
+            'records': len(self.entries.entries),
+            'unknown_codes': len(self.missing.entries)
+        }
+
+share_code_cache = ShareCodeCache(SHARE_CODE_CACHE_ITEMS, SHARE_CODE_NEGATIVE_ITEMS)
+
+# ===== JOB SCHEDULER =====
+class JobScheduler:
+    """One scheduler thread per process for all periodic background work.
+
+    Jobs sit in a heap keyed by next run time and the thread sleeps until the
+    earliest one is due. Before running, a process takes the job's lease row
+    in job_leases; the row also records when the job last ran anywhere, so
+    with several workers each job runs once per interval for the whole cluster
+    and the other processes just push their next run back.
+    """
+    
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.heap = []
+        self.thread = None
+    
+    def add_job(self, name, func, interval, lease_seconds=600):
+        """interval is seconds, or a callable returning seconds (None = disabled)"""
+        with self.condition:
+            self.jobs[name] = {
+                'func': func,
+                'interval': interval,
+                'lease_seconds': lease_seconds,
+                'next_run': None,
+                'last_result': None
+            }
+            self.schedule(name, time.time() + JOB_STARTUP_DELAY)
+    
+    def schedule(self, name, next_run):
+        # Caller holds self.condition; superseded heap entries are skipped when popped
+        self.jobs[name]['next_run'] = next_run
+        heapq.heappush(self.heap, (next_run, name))
+        self.condition.notify()
+    
+    def wake(self, name=None):
+        """Re-evaluate a job (or all jobs) now, e.g. after its settings changed"""
+        with self.condition:
+            for job_name in ([name] if name else list(self.jobs)):
+                self.schedule(job_name, time.time())
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        due, name = heapq.heappop(self.heap)
+                        if self.jobs[name]['next_run'] == due:
+                            break
+                        continue
+                    self.condition.wait(timeout=self.heap[0][0] - now if self.heap else None)
+            
+            try:
+                next_run = self.run_job(name)
+            except Exception as e:
+                logger.error(f"Scheduler error in {name}: {e}")
+                next_run = time.time() + JOB_DISABLED_RECHECK_SECONDS
+            
+            with self.condition:
+                # A wake() while the job ran already queued a fresh evaluation
+                if self.jobs[name]['next_run'] == due:
+                    self.schedule(name, next_run)
+    
+    def get_interval(self, job):
+        interval = job['interval']
+        return interval() if callable(interval) else interval
+    
+    def run_job(self, name):
+        """Run the job if this process wins its lease; returns the next run time"""
+        job = self.jobs[name]
+        interval = self.get_interval(job)
+        now = time.time()
+        if not interval:
+            return now + JOB_DISABLED_RECHECK_SECONDS
+        
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            cursor.execute('INSERT OR IGNORE INTO job_leases (name) VALUES (?)', (name,))
+            cursor.execute('SELECT owner, lease_until, last_run_at FROM job_leases WHERE name = ?', (name,))
+            owner, lease_until, last_run_at = cursor.fetchone()
+            
+            if last_run_at + interval > now:
+                # Already ran elsewhere in this interval
+                conn.commit()
+                return last_run_at + interval
+            if lease_until > now and owner != self.owner:
+                # Another process is running it right now
+                conn.commit()
+                return min(lease_until, now + interval)
+            
+            cursor.execute('UPDATE job_leases SET owner = ?, lease_until = ? WHERE name = ?',
+                          (self.owner, now + job['lease_seconds'], name))
+            conn.commit()
+        finally:
+            conn.close()
+        
+        try:
+            job['last_result'] = job['func']()
+        finally:
+            finished = time.time()
+            conn = get_db_connection()
+            conn.execute('UPDATE job_leases SET lease_until = 0, last_run_at = ? WHERE name = ? AND owner = ?',
+                        (finished, name, self.owner))
+            conn.commit()
+            conn.close()
+        
+        return finished + interval
+    
+    def get_status(self):
+        with self.condition:
+            return {
+                name: {
+                    'next_run': datetime.fromtimestamp(job['next_run'], timezone.utc).isoformat(),
+                    'last_result': job['last_result']
+                }
+                for name, job in self.jobs.items()
+            }
+
+job_scheduler = JobScheduler()
+
+# ===== VISITOR TRACKING =====
+def count_active_visitors(cursor):
+    cutoff_time = datetime.now(timezone.utc) - timedelta(minutes=5)
+    cursor.execute('SELECT COUNT(*) FROM visitors WHERE is_active = 1 AND last_activity > ?', (cutoff_time,))
+    return cursor.fetchone()[0]
+
+class VisitorTracker:
+    """Visitor events are queued by the request and written by a background
+    thread as batched upserts, so page views never wait on an SQLite commit"""
+    
+    def __init__(self):
+        self.active_visitors = {}
+        self.events = queue.Queue(maxsize=VISITOR_QUEUE_SIZE)
+        self.dropped_events = 0
+        self.published_active = None
+        self.stop_event = threading.Event()
+        self.writer_thread = None
+    
+    def start(self):
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self.run_writer, daemon=True)
+            self.writer_thread.start()
+            atexit.register(self.shutdown)
+    
+    def track_visitor(self, request):
+        session_id = session.get('session_id')
+        if not session_id:
+            session_id = str(uuid.uuid4())
+            session['session_id'] = session_id
+        
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent', '')
+        current_time = datetime.now(timezone.utc)
+        
+        self.active_visitors[session_id] = current_time
+        
+        try:
+            self.events.put_nowait((session_id, ip_address, user_agent, current_time))
+        except queue.Full:
+            # Never block a request on tracking - count it and move on
+            self.dropped_events += 1
+        
+        return session_id
+    
+    def run_writer(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = self.collect_batch()
+                if batch:
+                    self.write_batch(batch)
+            except Exception as e:
+                logger.error(f"Visitor writer error: {e}")
+    
+    def collect_batch(self):
+        try:
+            batch = [self.events.get(timeout=VISITOR_FLUSH_INTERVAL_MS / 1000)]
+        except queue.Empty:
+            return []
+        
+        deadline = time.monotonic() + VISITOR_FLUSH_INTERVAL_MS / 1000
+        while len(batch) < VISITOR_FLUSH_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.events.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def write_batch(self, batch):
+        # Collapse repeated hits from one session into a single upsert
+        visits = {}
+        for session_id, ip_address, user_agent, event_time in batch:
+            if session_id in visits:
+                visit = visits[session_id]
+                visit['last_activity'] = event_time
+                visit['page_views'] += 1
+            else:
+                visits[session_id] = {
+                    'ip_address': ip_address,
+                    'user_agent': user_agent,
+                    'first_visit': event_time,
+                    'last_activity': event_time,
+                    'page_views': 1
+                }
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO visitors (session_id, ip_address, user_agent, first_visit, last_activity, page_views)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                last_activity = excluded.last_activity,
+                page_views = page_views + excluded.page_views,
+                is_active = 1
+        ''', [
+            (session_id, v['ip_address'], v['user_agent'], v['first_visit'], v['last_activity'], v['page_views'])
+            for session_id, v in visits.items()
+        ])
+        conn.commit()
+        
+        # At most one count per flush, and only while a dashboard is watching
+        if event_bus.has_subscribers():
+            active_now = count_active_visitors(cursor)
+            if active_now != self.published_active:
+                self.published_active = active_now
+                event_bus.publish('visitors', {'active_now': active_now})
+        conn.close()
+    
+    def flush(self):
+        """Write everything queued so far (used on shutdown)"""
+        batch = []
+        while True:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.write_batch(batch)
+    
+    def shutdown(self):
+        self.stop_event.set()
+        if self.writer_thread:
+            self.writer_thread.join(timeout=(VISITOR_FLUSH_INTERVAL_MS / 1000) * 2 + 1)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Visitor flush on shutdown failed: {e}")
+    
+    def get_stats(self):
+        return {'queued': self.events.qsize(), 'dropped': self.dropped_events}
+    
+    def get_active_count(self):
+        current_time = datetime.now(timezone.utc)
+        cutoff_time = current_time - timedelta(minutes=5)
+        
+        self.active_visitors = {
+            sid: last_activity for sid, last_activity in self.active_visitors.items()
+            if last_activity > cutoff_time
+        }
+        
+        return len(self.active_visitors)
+    
+    def deactivate_inactive_visitors(self):
+        current_time = datetime.now(timezone.utc)
+        cutoff_time = current_time - timedelta(minutes=10)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE visitors SET is_active = 0 WHERE is_active = 1 AND last_activity < ?', (cutoff_time,))
+        deactivated = cursor.rowcount
+        conn.commit()
+        conn.close()
+        
+        return deactivated
+
+visitor_tracker = VisitorTracker()
+
+# ===== DOWNLOAD ACCOUNTING =====
+class DownloadLog:
+    """Download accounting without a SQLite write per download.
+
+    download_limit holds across worker processes through leases: a worker
+    claims a block of downloads from files.download_count in one UPDATE and
+    reserve() hands them out from memory. A file's block starts at one
+    download and doubles while it stays busy, up to DOWNLOAD_LEASE_MAX and
+    never more than half of what is left; whatever is unused goes back once
+    the file has been idle for DOWNLOAD_LEASE_IDLE_SECONDS, or on shutdown.
+    The stored count therefore includes claimed downloads not served yet,
+    and a worker that dies forfeits its unused ones (the limit errs strict).
+
+    The events themselves are buffered and a background thread rolls them up
+    into download_stats and the rollups in one transaction.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.claim_lock = threading.Lock()  # serializes the SQLite side of leasing
+        self.events = []
+        self.leases = {}  # file_id -> [claimed downloads left, next block size, last used]
+        self.sessions = {}  # (file_id, content key, client) -> [bytes served, downloads charged, last request]
+        self.touched = {}  # file_id -> share page viewed at, for files.last_accessed
+        self.stop_event = threading.Event()
+        self.writer_thread = None
+    
+    def start(self):
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self.run_writer, daemon=True)
+            self.writer_thread.start()
+            atexit.register(self.shutdown)
+    
+    def limit_reached(self, record):
+        """Whether a (possibly cached) file record has no downloads left for this
+        worker. The stored count also holds other workers' unused leases, so
+        this can only err strict; reserve() has the last word."""
+        with self.lock:
+            lease = self.leases.get(record.id)
+            if lease and lease[0] > 0:
+                return False
+        return record.download_limit is not None and record.download_count >= record.download_limit
+    
+    def account(self, file_id, content_key, file_size, bytes_sent, ip_address, user_agent):
+        """Bill a response against download_limit by the bytes it delivers: a
+        client is charged one download for every started file size it fetches
+        within DOWNLOAD_SESSION_SECONDS, whatever the ranges - resumed or
+        segmented downloads cost one, repeated partial fetches add up. Small
+        overlaps (probes, retried segments) are forgiven up to the slack.
+        Returns the downloads charged (0 or 1), None if none were left."""
+        key = (file_id, content_key, ip_address)
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(key)
+        if session is None or session[2] < now - DOWNLOAD_SESSION_SECONDS:
+            session = [0, 0, now]
+        
+        # An empty file still costs a download per request
+        served = session[0] + max(bytes_sent, 1)
+        slack = min(DOWNLOAD_SESSION_SLACK, file_size // 10)
+        due = max(1, -(-(served - slack) // max(file_size, 1)))
+        charged = int(due > session[1])
+        if charged and not self.reserve(file_id, bytes_sent, ip_address, user_agent):
+            return None
+        with self.lock:
+            self.sessions[key] = [served, due, now]
+        return charged
+    
+    def reserve(self, file_id, bytes_sent, ip_address, user_agent):
+        """Take one download from the file's allowance; False if none is left"""
+        if not self.take(file_id):
+            return False
+        with self.lock:
+            self.events.append((file_id, bytes_sent, ip_address, user_agent, datetime.now(timezone.utc)))
+        return True
+    
+    def take_leased(self, file_id):
+        with self.lock:
+            lease = self.leases.get(file_id)
+            if lease and lease[0] > 0:
+                lease[0] -= 1
+                lease[2] = time.monotonic()
+                return True
+            return False
+    
+    def take(self, file_id):
+        if self.take_leased(file_id):
+            return True
+        
+        with self.claim_lock:
+            # Another thread may have claimed a block while we waited
+            if self.take_leased(file_id):
+                return True
+            with self.lock:
+                lease = self.leases.get(file_id)
+                block = lease[1] if lease else 1
+            
+            granted = self.claim(file_id, block)
+            if not granted:
+                return False
+            with self.lock:
+                lease = self.leases.setdefault(file_id, [0, 1, 0])
+                lease[0] += granted - 1
+                lease[1] = min(block * 2, DOWNLOAD_LEASE_MAX)
+                lease[2] = time.monotonic()
+            return True
+    
+    def claim(self, file_id, block):
+        """Move up to `block` downloads from the file's allowance to this worker"""
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            cursor.execute('SELECT download_count, download_limit FROM files WHERE id = ?', (file_id,))
+            row = cursor.fetchone()
+            if not row:
+                conn.rollback()
+                return 0
+            download_count, download_limit = row
+            granted = block
+            if download_limit is not None:
+                # Leave the other workers a share of what is left
+                remaining = download_limit - download_count
+                granted = min(block, max(1, remaining // 2)) if remaining > 0 else 0
+            if granted:
+                cursor.execute('UPDATE files SET download_count = download_count + ? WHERE id = ?',
+                              (granted, file_id))
+            conn.commit()
+            return granted
+        finally:
+            conn.close()
+    
+    def touch(self, file_id):
+        """Note a share page view; last_accessed is written with the next rollup"""
+        with self.lock:
+            self.touched[file_id] = datetime.now(timezone.utc)
+    
+    def run_writer(self):
+        while not self.stop_event.wait(DOWNLOAD_FLUSH_INTERVAL_MS / 1000):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Download log writer error: {e}")
+    
+    def flush(self, release_all=False):
+        """Roll up the buffered events and hand back idle leases (all of them
+        with release_all); returns the number of events written"""
+        with self.claim_lock:
+            cutoff = float('inf') if release_all else time.monotonic() - DOWNLOAD_LEASE_IDLE_SECONDS
+            with self.lock:
+                batch, self.events = self.events, []
+                touched, self.touched = self.touched, {}
+                released = {}
+                for file_id in [f for f, lease in self.leases.items() if lease[2] < cutoff]:
+                    unused = self.leases.pop(file_id)[0]
+                    if unused:
+                        released[file_id] = unused
+                session_cutoff = time.monotonic() - DOWNLOAD_SESSION_SECONDS
+                for key in [k for k, session in self.sessions.items() if session[2] < session_cutoff]:
+                    del self.sessions[key]
+            if not batch and not touched and not released:
+                return 0
+            
+            try:
+                self.write_batch(batch, touched, released)
+            except Exception:
+                # Keep the events for the next attempt, ahead of anything newer
+                with self.lock:
+                    self.events[:0] = batch
+                    self.touched = {**touched, **self.touched}
+                    for file_id, unused in released.items():
+                        self.leases.setdefault(file_id, [0, 1, 0])[0] += unused
+                raise
+        
+        # Cached records of these files have a stale download_count
+        share_code_cache.invalidate_files({event[0] for event in batch} | released.keys())
+        return len(batch)
+    
+    def write_batch(self, batch, touched=None, released=None):
+        last_download = {}
+        buckets = {}
+        for file_id, bytes_sent, ip_address, _, event_time in batch:
+            last_download[file_id] = event_time
+            for period, bucket_format in DOWNLOAD_ROLLUP_PERIODS.items():
+                bucket = buckets.setdefault((period, event_time.strftime(bucket_format), file_id), [0, 0, set()])
+                bucket[0] += 1
+                bucket[1] += bytes_sent
+                bucket[2].add(ip_address)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        conn.execute('BEGIN IMMEDIATE')
+        if touched:
+            cursor.executemany('UPDATE files SET last_accessed = ? WHERE id = ?',
+                              [(viewed_at, file_id) for file_id, viewed_at in touched.items()])
+        cursor.executemany('UPDATE files SET last_accessed = ? WHERE id = ?',
+                          [(event_time, file_id) for file_id, event_time in last_download.items()])
+        if released:
+            cursor.executemany('UPDATE files SET download_count = download_count - ? WHERE id = ?',
+                              [(unused, file_id) for file_id, unused in released.items()])
+        
+        user_agent_ids = {}
+        for user_agent in {event[3] for event in batch}:
+            cursor.execute('INSERT OR IGNORE INTO user_agents (user_agent) VALUES (?)', (user_agent,))
+            cursor.execute('SELECT id FROM user_agents WHERE user_agent = ?', (user_agent,))
+            user_agent_ids[user_agent] = cursor.fetchone()[0]
+        
+        # Files deleted since the download was served get no stats rows
+        cursor.executemany('''
+            INSERT INTO download_stats (file_id, download_ip, user_agent_id, bytes_sent, download_time)
+            SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM files WHERE id = ?)
+        ''', [
+            (file_id, ip_address, user_agent_ids[user_agent], bytes_sent,
+             event_time.strftime('%Y-%m-%d %H:%M:%S'), file_id)
+            for file_id, bytes_sent, ip_address, user_agent, event_time in batch
+        ])
+        
+        for (period, bucket_start, file_id), (downloads, bytes_sent, ips) in buckets.items():
+            cursor.executemany('''
+                INSERT OR IGNORE INTO download_rollup_ips (period, bucket_start, file_id, ip)
+                VALUES (?, ?, ?, ?)
+            ''', [(period, bucket_start, file_id, ip) for ip in ips])
+            new_ips = cursor.rowcount
+            cursor.execute('''
+                INSERT INTO download_rollups (period, bucket_start, file_id, downloads, bytes, unique_ips)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(period, bucket_start, file_id) DO UPDATE SET
+                    downloads = downloads + excluded.downloads,
+                    bytes = bytes + excluded.bytes,
+                    unique_ips = unique_ips + excluded.unique_ips
+            ''', (period, bucket_start, file_id, downloads, bytes_sent, new_ips))
+        
+        conn.commit()
+        conn.close()
+    
+    def shutdown(self):
+        self.stop_event.set()
+        if self.writer_thread:
+            self.writer_thread.join(timeout=(DOWNLOAD_FLUSH_INTERVAL_MS / 1000) * 2 + 1)
+        try:
+            self.flush(release_all=True)
+        except Exception as e:
+            logger.error(f"Download log flush on shutdown failed: {e}")
+    
+    def get_stats(self):
+        with self.lock:
+            return {'pending': len(self.events), 'leases': len(self.leases), 'sessions': len(self.sessions),
+                    'leased_downloads': sum(lease[0] for lease in self.leases.values())}
+
+download_log = DownloadLog()
+
+def prune_download_stats():
+    """Apply the retention windows: raw events after download_stats_retention_days,
+    hourly/daily aggregates after DOWNLOAD_HOURLY/DAILY_ROLLUP_DAYS"""
+    now = datetime.now(timezone.utc)
+    deleted = 0
+    
+    retention_days = settings_cache.get('download_stats_retention_days')
+    if retention_days > 0:
+        cutoff = (now - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+        while True:
+            # Short batches so downloads being rolled up never wait long for the lock
+            conn = get_db_connection()
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute('''
+                DELETE FROM download_stats WHERE id IN (
+                    SELECT id FROM download_stats WHERE download_time < ? LIMIT ?
+                )
+            ''', (cutoff, DOWNLOAD_RETENTION_BATCH))
+            batch_deleted = cursor.rowcount
+            conn.commit()
+            conn.close()
+            deleted += batch_deleted
+            if batch_deleted < DOWNLOAD_RETENTION_BATCH:
+                break
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
+    for period, keep_days in (('hour', DOWNLOAD_HOURLY_ROLLUP_DAYS), ('day', DOWNLOAD_DAILY_ROLLUP_DAYS)):
+        cursor.execute('DELETE FROM download_rollups WHERE period = ? AND bucket_start < ?',
+                       (period, (now - timedelta(days=keep_days)).strftime('%Y-%m-%d %H:%M:%S')))
+    # Buckets older than two days are closed - their IP sets are no longer needed
+    ip_cutoff = (now - timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute('DELETE FROM download_rollup_ips WHERE period = ? AND bucket_start < ?', ('hour', ip_cutoff))
+    cursor.execute('DELETE FROM download_rollup_ips WHERE period = ? AND bucket_start < ?', ('day', ip_cutoff))
+    cursor.execute('''
+        DELETE FROM user_agents WHERE NOT EXISTS (
+            SELECT 1 FROM download_stats WHERE user_agent_id = user_agents.id
+        )
+    ''')
+    conn.commit()
+    conn.close()
+    
+    return deleted
+
+# ===== RATE LIMITING =====
+# Limits key on the client address - behind a proxy, the one it forwarded
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS,
+                            x_host=TRUSTED_PROXY_HOPS)
+
+def get_client_ip(environ):
+    """Client address as ProxyFix resolves it, for checks made before Flask runs"""
+    forwarded = [ip.strip() for ip in environ.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+    if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+        return forwarded[-TRUSTED_PROXY_HOPS]
+    return environ.get('REMOTE_ADDR')
+
+# Request-rate scopes and the setting holding each one's per-IP limit
+RATE_LIMIT_SETTINGS = {
+    'download': 'rate_limit_download_per_minute',
+    'upload': 'rate_limit_upload_per_minute',
+    'login': 'rate_limit_login_per_minute',
+}
+RATE_LIMITED_ENDPOINTS = {
+    'download_file': 'download',
+    'upload_file': 'upload',
+    'upload_init': 'upload',
+    'admin_login': 'login',
+}
+
+class RateLimiter:
+    """Per-IP token buckets and per-share-code transfer counts.
+
+    Checks only touch memory. A background thread exchanges state with the
+    other workers every RATE_LIMIT_SYNC_MS: it adds the tokens taken here to
+    rate_limit_usage, debits what the other workers took from the local
+    buckets, and publishes the transfers in progress. Limits therefore hold
+    across workers to within one sync interval.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.buckets = {}  # 'scope:client' -> [tokens, updated (monotonic), capacity]
+        self.consumed = {}  # 'scope:client' -> tokens taken here since the last sync
+        self.remote_seen = {}  # (bucket key, worker) -> [their running total, seen at]
+        self.transfers = {}  # share_code -> downloads this worker is sending
+        self.remote_transfers = {}  # share_code -> downloads the other workers are sending
+        self.rejected = dict.fromkeys([*RATE_LIMIT_SETTINGS, 'transfers'], 0)
+        self.synced_at = 0
+        self.pruned_at = 0
+        self.stop_event = threading.Event()
+        self.sync_thread = None
+    
+    def start(self):
+        if self.sync_thread is None:
+            self.sync_thread = threading.Thread(target=self.run_sync, daemon=True)
+            self.sync_thread.start()
+    
+    def refill(self, key, capacity, now):
+        """The bucket for key, topped up for the time elapsed (lock held).
+        A bucket holds one minute's worth of requests and refills over a minute."""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [capacity, now, capacity]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / 60)
+            bucket[1], bucket[2] = now, capacity
+        return bucket
+    
+    def allow(self, scope, client):
+        """Take a token from the client's bucket; returns (allowed, retry_after_seconds)"""
+        per_minute = settings_cache.get(RATE_LIMIT_SETTINGS[scope])
+        if per_minute <= 0:
+            return True, 0
+        
+        key = f'{scope}:{client}'
+        with self.lock:
+            bucket = self.refill(key, per_minute, time.monotonic())
+            if bucket[0] < 1:
+                self.rejected[scope] += 1
+                return False, int((1 - bucket[0]) * 60 / per_minute) + 1
+            bucket[0] -= 1
+            self.consumed[key] = self.consumed.get(key, 0) + 1
+        return True, 0
+    
+    def acquire_transfer(self, share_code):
+        """Claim a transfer slot for share_code; False when the cap is reached"""
+        limit = settings_cache.get('download_max_concurrent_per_share')
+        with self.lock:
+            active = self.transfers.get(share_code, 0)
+            if limit > 0 and active + self.remote_transfers.get(share_code, 0) >= limit:
+                self.rejected['transfers'] += 1
+                return False
+            self.transfers[share_code] = active + 1
+        return True
+    
+    def release_transfer(self, share_code):
+        with self.lock:
+            active = self.transfers.get(share_code, 0) - 1
+            if active > 0:
+                self.transfers[share_code] = active
+            else:
+                self.transfers.pop(share_code, None)
+    
+    def run_sync(self):
+        while not self.stop_event.wait(RATE_LIMIT_SYNC_MS / 1000):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Rate limit sync error: {e}")
+    
+    def sync(self):
+        capacities = {scope: settings_cache.get(setting) for scope, setting in RATE_LIMIT_SETTINGS.items()}
+        share_transfers = settings_cache.get('download_max_concurrent_per_share') > 0
+        with self.lock:
+            consumed, self.consumed = self.consumed, {}
+            transfers = dict(self.transfers)
+        
+        now = time.time()
+        prune = now - self.pruned_at > RATE_LIMIT_STATE_TTL / 10
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            if consumed or share_transfers or prune:
+                conn.execute('BEGIN IMMEDIATE')
+                cursor.executemany('''
+                    INSERT INTO rate_limit_usage (bucket_key, worker_id, consumed, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(bucket_key, worker_id) DO UPDATE SET
+                        consumed = consumed + excluded.consumed,
+                        updated_at = excluded.updated_at
+                ''', [(key, self.worker_id, count, now) for key, count in consumed.items()])
+                if share_transfers:
+                    # Rewritten every sync - the timestamps show this worker is alive
+                    cursor.execute('DELETE FROM active_transfers WHERE worker_id = ?', (self.worker_id,))
+                    cursor.executemany(
+                        'INSERT INTO active_transfers (share_code, worker_id, active, updated_at) VALUES (?, ?, ?, ?)',
+                        [(share_code, self.worker_id, active, now) for share_code, active in transfers.items()])
+                if prune:
+                    cursor.execute('DELETE FROM rate_limit_usage WHERE updated_at < ?', (now - RATE_LIMIT_STATE_TTL,))
+                    cursor.execute('DELETE FROM active_transfers WHERE updated_at < ?', (now - RATE_LIMIT_TRANSFER_STALE,))
+                conn.commit()
+            
+            # Rows are diffed against what was seen before, so overlapping reads are harmless
+            cursor.execute('SELECT bucket_key, worker_id, consumed FROM rate_limit_usage WHERE updated_at > ? AND worker_id != ?',
+                          (self.synced_at - 2 * RATE_LIMIT_SYNC_MS / 1000, self.worker_id))
+            usage = cursor.fetchall()
+            remote_transfers = {}
+            if share_transfers:
+                cursor.execute('''
+                    SELECT share_code, SUM(active) FROM active_transfers
+                    WHERE worker_id != ? AND updated_at > ? GROUP BY share_code
+                ''', (self.worker_id, now - RATE_LIMIT_TRANSFER_STALE))
+                remote_transfers = dict(cursor.fetchall())
+        except Exception:
+            # Keep the usage for the next attempt
+            with self.lock:
+                for key, count in consumed.items():
+                    self.consumed[key] = self.consumed.get(key, 0) + count
+            raise
+        finally:
+            conn.close()
+        
+        if prune:
+            self.pruned_at = now
+        self.synced_at = now
+        
+        with self.lock:
+            mono = time.monotonic()
+            for key, worker_id, total in usage:
+                seen = self.remote_seen.get((key, worker_id))
+                taken = total - seen[0] if seen else total
+                self.remote_seen[(key, worker_id)] = [total, now]
+                capacity = capacities.get(key.split(':', 1)[0], 0)
+                if taken > 0 and capacity > 0:
+                    bucket = self.refill(key, capacity, mono)
+                    # A burst on other workers leaves the bucket at most a minute in debt
+                    bucket[0] = max(bucket[0] - taken, -capacity)
+            self.remote_transfers = remote_transfers
+            
+            # A full bucket carries no state, and old totals are pruned from the table
+            for key in [k for k, b in self.buckets.items() if b[0] + (mono - b[1]) * b[2] / 60 >= b[2]]:
+                del self.buckets[key]
+            for seen_key in [k for k, s in self.remote_seen.items() if s[1] < now - 2 * RATE_LIMIT_STATE_TTL]:
+                del self.remote_seen[seen_key]
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                'tracked_clients': len(self.buckets),
+                'active_transfers': sum(self.transfers.values()),
+                'rejected': dict(self.rejected)
+            }
+
+class Throttle:
+    """Paces one connection to `rate` bytes per second, with up to a second of burst"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.updated = time.monotonic()
+    
+    def delay(self, size):
+        """Seconds to wait to stay within the rate after `size` more bytes"""
+        now = time.monotonic()
+        self.allowance = min(self.rate, self.allowance + (now - self.updated) * self.rate)
+        self.updated = now
+        self.allowance -= size
+        return -self.allowance / self.rate if self.allowance < 0 else 0
+    
+    def iter(self, iterable):
+        try:
+            for buffer in iterable:
+                wait = self.delay(len(buffer))
+                if wait:
+                    time.sleep(wait)
+                yield buffer
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    
+    def reader(self, stream):
+        return ThrottledReader(stream, self)
+
+class ThrottledReader:
+    """File-like wrapper that slows reads down; the client is held back by TCP backpressure"""
+    
+    def __init__(self, stream, throttle):
+        self.stream = stream
+        self.throttle = throttle
+    
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        wait = self.throttle.delay(len(data))
+        if wait:
+            time.sleep(wait)
+        return data
+
+def get_upload_throttle():
+    rate = settings_cache.get('upload_bandwidth_kb_per_second') * 1024
+    return Throttle(rate) if rate > 0 else None
+
+def get_upload_stream():
+    """request.stream, paced to upload_bandwidth_kb_per_second (under ASGI the
+    body is paced on the event loop as it arrives instead)"""
+    throttle = None if request.environ.get('filestore.asgi') else get_upload_throttle()
+    return throttle.reader(request.stream) if throttle else request.stream
+
+def pace_response(response, rate):
+    throttle = Throttle(rate)
+    if request.environ.get('filestore.asgi'):
+        # Paced on the event loop, so no thread sleeps through the transfer
+        request.environ['filestore.throttle'] = throttle
+    else:
+        response.response = throttle.iter(response.response)
+
+rate_limiter = RateLimiter()
+
+# ===== MEDIA PROCESSING =====
+def get_media_kind(mime_type):
+    """'image', 'video' or 'audio' when an upload of this type gets a preview or
+    probe and the tools for it are installed, otherwise None"""
+    kind = (mime_type or '').split('/')[0]
+    if kind == 'image':
+        return kind if Image is not None and mime_type != 'image/svg+xml' else None
+    if kind == 'video':
+        return kind if FFPROBE_PATH or FFMPEG_PATH else None
+    if kind == 'audio':
+        return kind if FFPROBE_PATH else None
+    return None
+
+def queue_media_job(cursor, stored_name, kind, file_size):
+    """Queue post-upload processing in the caller's transaction, unless the
+    content already has results (a duplicate upload)"""
+    cursor.execute('''
+        INSERT OR IGNORE INTO media_jobs (stored_name, kind, file_size, run_after)
+        SELECT ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM media_info WHERE stored_name = ?)
+    ''', (stored_name, kind, file_size, time.time(), stored_name))
+
+def release_media(cursor, stored_name):
+    """Drop a released object's media job and results in the caller's
+    transaction; returns the preview's key for the caller to retire, if any"""
+    cursor.execute('DELETE FROM media_jobs WHERE stored_name = ?', (stored_name,))
+    cursor.execute('SELECT preview_key FROM media_info WHERE stored_name = ?', (stored_name,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    cursor.execute('DELETE FROM media_info WHERE stored_name = ?', (stored_name,))
+    return row[0]
+
+class MediaProcessor:
+    """Post-upload processing: image thumbnails, video posters and durations.
+
+    Jobs are rows in media_jobs, inserted in the same transaction as the
+    upload's files row, so the upload response never waits for them and none
+    are lost if a process dies. Every server process runs a dispatcher thread
+    that claims due jobs and hands the decoding to a small process pool -
+    a huge or malformed file costs a worker process, never a request thread.
+    Previews are stored next to the stored object and recorded in media_info.
+    """
+    
+    def __init__(self, workers):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(workers)
+        self.threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media')
+        self.stats = dict.fromkeys(['processed', 'previews', 'errors', 'retries'], 0)
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.dispatcher_thread = None
+    
+    def start(self):
+        if self.dispatcher_thread is None:
+            self.dispatcher_thread = threading.Thread(target=self.run_dispatcher, daemon=True)
+            self.dispatcher_thread.start()
+            atexit.register(self.shutdown)
+    
+    def wake(self):
+        """A job was queued here - claim it now instead of at the next poll"""
+        self.wake_event.set()
+    
+    def run_dispatcher(self):
+        while not self.stop_event.is_set():
+            self.slots.acquire()
+            self.wake_event.clear()
+            try:
+                job = self.claim()
+            except Exception as e:
+                logger.error(f"Media dispatcher error: {e}")
+                job = None
+            
+            if job is None:
+                self.slots.release()
+                self.wake_event.wait(MEDIA_POLL_INTERVAL)
+                continue
+            self.threads.submit(self.process, job)
+    
+    def claim(self):
+        """Lease the next due job: (stored_name, kind, file_size, attempt) or None"""
+        now = time.time()
+        conn = get_db_connection()
+        try:
+            # Read first, so an idle queue never takes the write lock
+            cursor = conn.cursor()
+            cursor.execute('SELECT stored_name, kind, file_size, attempts FROM media_jobs '
+                           'WHERE run_after <= ? ORDER BY run_after LIMIT 1', (now,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            
+            conn.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                UPDATE media_jobs SET run_after = ?, attempts = attempts + 1, owner = ?
+                WHERE stored_name = ? AND run_after <= ?
+            ''', (now + MEDIA_JOB_LEASE, self.owner, row[0], now))
+            claimed = cursor.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        
+        # Another process got there first - look again right away
+        if not claimed:
+            self.wake_event.set()
+            return None
+        stored_name, kind, file_size, attempts = row
+        return stored_name, kind, file_size, attempts + 1
+    
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # Never fork: this process runs threads (scheduler, writers, sync) and
+                # a forked child could inherit a lock one of them held. Workers
+                # import media_worker, which has no import-time side effects.
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload(['media_worker'])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self.pool
+    
+    def render(self, kind, source, preview_path):
+        pool = self.get_pool()
+        try:
+            return pool.submit(render_media_preview, kind, source, preview_path).result()
+        except BrokenProcessPool:
+            # A decoder crashed (or the OOM killer took) a worker - the next job gets a fresh pool
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = None
+            pool.shutdown(wait=False)
+            raise
+    
+    def process(self, job):
+        stored_name, kind, file_size, attempt = job
+        preview_key = f"{stored_name}.preview.jpg"
+        work_dir = tempfile.mkdtemp(prefix='media-')
+        try:
+            if kind == 'image' and file_size > MEDIA_IMAGE_MAX_BYTES:
+                result = {'preview': False, 'width': None, 'height': None, 'duration': None,
+                          'error': 'too large for a thumbnail'}
+            else:
+                preview_path = os.path.join(work_dir, 'preview.jpg')
+                result = self.render(kind, self.fetch_source(stored_name, kind, file_size, work_dir), preview_path)
+                if result['preview']:
+                    self.store_preview(preview_path, preview_key)
+            
+            self.record(stored_name, result, preview_key if result['preview'] else None)
+        except Exception as e:
+            logger.error(f"Media processing error for {stored_name}: {e}")
+            try:
+                self.retry_later(stored_name, attempt, str(e))
+            except Exception as e:
+                logger.error(f"Media job update error for {stored_name}: {e}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            self.slots.release()
+    
+    def fetch_source(self, stored_name, kind, file_size, work_dir):
+        """A local path or URL the worker process can read the content from"""
+        if storage.is_local or kind != 'image':
+            return storage.media_source(stored_name)
+        
+        # Pillow needs a file: bring remote images over (they are size-capped)
+        path = os.path.join(work_dir, 'source')
+        with open(path, 'wb') as f:
+            for buffer in storage.iter_range(stored_name, 0, file_size):
+                f.write(buffer)
+        return path
+    
+    def store_preview(self, path, preview_key):
+        writer = storage.open_writer(preview_key)
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    buffer = f.read(STREAM_BUFFER_SIZE)
+                    if not buffer:
+                        break
+                    writer.write(buffer)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+    
+    def record(self, stored_name, result, preview_key):
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM media_jobs WHERE stored_name = ? AND owner = ?', (stored_name, self.owner))
+            if cursor.rowcount:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO media_info (stored_name, preview_key, width, height, duration, error, processed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (stored_name, preview_key, result['width'], result['height'], result['duration'],
+                      result['error'], time.time()))
+                orphaned = False
+            else:
+                # The content was released meanwhile, unless the lease ran out and
+                # the job (or a new upload of the same content) went elsewhere
+                cursor.execute('''
+                    SELECT EXISTS (SELECT 1 FROM media_jobs WHERE stored_name = ?)
+                        OR EXISTS (SELECT 1 FROM media_info WHERE stored_name = ?)
+                ''', (stored_name, stored_name))
+                orphaned = not cursor.fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
+        
+        if orphaned and preview_key:
+            storage.delete(preview_key)
+        
+        with self.lock:
+            self.stats['processed'] += 1
+            self.stats['previews'] += bool(preview_key)
+            self.stats['errors'] += bool(result['error'])
+    
+    def retry_later(self, stored_name, attempt, error):
+        """Back off a job that failed for reasons outside the content; give up after
+        MEDIA_JOB_MAX_ATTEMPTS and record it without a preview"""
+        if attempt >= MEDIA_JOB_MAX_ATTEMPTS:
+            self.record(stored_name, {'width': None, 'height': None, 'duration': None, 'error': error[:500]}, None)
+            return
+        
+        conn = get_db_connection()
+        conn.execute('''
+            UPDATE media_jobs SET run_after = ?, owner = NULL, last_error = ?
+            WHERE stored_name = ? AND owner = ?
+        ''', (time.time() + MEDIA_RETRY_DELAY * attempt, error[:500], stored_name, self.owner))
+        conn.commit()
+        conn.close()
+        with self.lock:
+            self.stats['retries'] += 1
+    
+    def shutdown(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    def get_stats(self):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*), COUNT(owner) FROM media_jobs')
+        queued, claimed = cursor.fetchone()
+        conn.close()
+        
+        with self.lock:
+            return {
+                **self.stats,
+                'queued': queued,
+                'claimed': claimed,
+                'workers': self.workers,
+                'tools': {'pillow': Image is not None, 'ffprobe': bool(FFPROBE_PATH), 'ffmpeg': bool(FFMPEG_PATH)}
+            }
 
-visitor_tracker = VisitorTracker()
+media_processor = MediaProcessor(MEDIA_WORKERS)
 
 # ===== CACHE SCHEDULER =====
 class CacheScheduler:
     def __init__(self):
-        self.scheduler_thread = threading.Thread(target=self.run_scheduler, daemon=True)
-        self.scheduler_thread.start()
+        self.cleanup_lock = threading.Lock()
+        self.cleanup_progress = {'running': False}
+        self.unlink_pool = ThreadPoolExecutor(max_workers=CLEANUP_UNLINK_WORKERS, thread_name_prefix='unlink')
+    
+    def cleanup_interval_seconds(self):
+        if not settings_cache.get('auto_cleanup_enabled'):
+            return None
+        return settings_cache.get('cleanup_interval_minutes') * 60
+    
+    def run_scheduled_cleanup(self):
+        logger.info("Running scheduled cache cleanup...")
+        deleted_count = self.cleanup_expired_files()
+        logger.info(f"Scheduled cleanup completed: {deleted_count} files deleted")
+        return deleted_count
+    
+    def cleanup_expired_files(self):
+        """Delete expired files in bounded batches, oldest expiry first.
+
+        Each batch is one short write transaction driven by the expires_at
+        index; the physical deletes happen afterwards on a worker pool and
+        CLEANUP_MAX_FILES_PER_SECOND paces the batches, so uploads and
+        downloads never wait long for the write lock."""
+        if not self.cleanup_lock.acquire(blocking=False):
+            logger.info("Cleanup already running, skipping")
+            return 0
         
-    def run_scheduler(self):
-        while True:
-            try:
-                time.sleep(60)  # Check every minute
+        started = time.monotonic()
+        try:
+            current_time = datetime.now(timezone.utc)
+            deleted_count = 0
+            self.cleanup_progress.update({
+                'running': True,
+                'started_at': current_time.isoformat(),
+                'batches': 0,
+                'deleted': 0,
+                'bytes_freed': 0,
+                'files_unlinked': 0
+            })
+            
+            while True:
+                pending_unlinks = []
                 
-                # Get auto cleanup settings
-                conn = sqlite3.connect('file_storage.db')
+                conn = get_db_connection()
                 cursor = conn.cursor()
+                conn.execute('BEGIN IMMEDIATE')
+                cursor.execute('''
+                    SELECT id, stored_name, checksum, file_size, share_code FROM files
+                    WHERE expires_at < ? ORDER BY expires_at LIMIT ?
+                ''', (current_time, CLEANUP_BATCH_SIZE))
+                expired_files = cursor.fetchall()
                 
-                cursor.execute('SELECT value FROM settings WHERE key = ?', ('auto_cleanup_enabled',))
-                enabled = cursor.fetchone()
-                enabled = enabled and enabled[0] == 'true'
-                
-                if not enabled:
+                if not expired_files:
                     conn.close()
-                    continue
+                    break
+                
+                batch_ids = []
+                batch_codes = []
+                bytes_freed = 0
+                for file_id, stored_name, checksum, file_size, share_code in expired_files:
+                    # A file whose release fails keeps its row, so it must keep its
+                    # blob reference too - otherwise the next pass releases it again
+                    cursor.execute('SAVEPOINT release_file')
+                    try:
+                        # Delete physical file once no other upload shares it
+                        released_keys = release_stored_rows(cursor, stored_name, checksum)
+                        cursor.execute('RELEASE SAVEPOINT release_file')
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO SAVEPOINT release_file')
+                        cursor.execute('RELEASE SAVEPOINT release_file')
+                        logger.error(f"Error deleting file {file_id}: {e}")
+                        continue
+                    
+                    # Objects are only touched once the rows are released for good;
+                    # one that cannot be retired is left for reconcile to report
+                    for key in released_keys:
+                        try:
+                            storage.retire(key, pending_unlinks)
+                        except Exception as e:
+                            logger.error(f"Error deleting {key}: {e}")
+                    if released_keys:
+                        bytes_freed += file_size or 0
+                    batch_ids.append(file_id)
+                    batch_codes.append(share_code)
                 
-                cursor.execute('SELECT value FROM settings WHERE key = ?', ('cleanup_interval_minutes',))
-                interval = cursor.fetchone()
-                interval = int(interval[0]) if interval else 60
+                if not batch_ids:
+                    # Nothing in this batch could be released - don't spin on it
+                    conn.commit()
+                    conn.close()
+                    break
                 
+                # Delete database records
+                placeholders = ','.join('?' * len(batch_ids))
+                cursor.execute(f'DELETE FROM files WHERE id IN ({placeholders})', batch_ids)
+                cursor.execute(f'DELETE FROM download_stats WHERE file_id IN ({placeholders})', batch_ids)
+                conn.commit()
                 conn.close()
                 
-                # Simple interval-based cleanup
-                if hasattr(self, 'last_cleanup'):
-                    time_since_last = (datetime.now(timezone.utc) - self.last_cleanup).total_seconds() / 60
-                    if time_since_last < interval:
-                        continue
+                unlinked = sum(self.unlink_pool.map(self.unlink_quietly, pending_unlinks))
+                purge_qr_cache(batch_codes)
+                for share_code in batch_codes:
+                    share_code_cache.invalidate(share_code)
                 
-                logger.info("Running scheduled cache cleanup...")
-                deleted_count = self.cleanup_expired_files()
-                logger.info(f"Scheduled cleanup completed: {deleted_count} files deleted")
-                self.last_cleanup = datetime.now(timezone.utc)
+                deleted_count += len(batch_ids)
+                self.cleanup_progress['batches'] += 1
+                self.cleanup_progress['deleted'] = deleted_count
+                self.cleanup_progress['bytes_freed'] += bytes_freed
+                self.cleanup_progress['files_unlinked'] += unlinked
                 
-            except Exception as e:
-                logger.error(f"Scheduler error: {e}")
+                # Rate limit: never go faster than CLEANUP_MAX_FILES_PER_SECOND
+                if CLEANUP_MAX_FILES_PER_SECOND:
+                    ahead = deleted_count / CLEANUP_MAX_FILES_PER_SECOND - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            
+            if deleted_count:
+                invalidate_file_caches()
+                publish_cleanup(deleted_count, self.cleanup_progress['bytes_freed'])
+            
+            return deleted_count
+            
+        except Exception as e:
+            logger.error(f"Cleanup error: {e}")
+            return self.cleanup_progress.get('deleted', 0)
+        finally:
+            self.cleanup_progress['running'] = False
+            self.cleanup_progress['last_run_seconds'] = round(time.monotonic() - started, 2)
+            self.cleanup_progress['last_finished_at'] = datetime.now(timezone.utc).isoformat()
+            self.cleanup_lock.release()
     
-    def cleanup_expired_files(self):
+    @staticmethod
+    def unlink_quietly(key):
         try:
-            current_time = datetime.now(timezone.utc)
+            storage.delete(key)
+            return 1
+        except Exception as e:
+            logger.error(f"Error deleting {key}: {e}")
+            return 0
+    
+    def reconcile_interval_seconds(self):
+        hours = settings_cache.get('storage_reconcile_interval_hours')
+        return hours * 3600 if hours > 0 else None
+    
+    def reconcile_storage(self):
+        """Check the usage ledger and the stored objects against the database.
+
+        Ledger drift is corrected in place. Stored objects nothing refers to are
+        reported, except leftover tombstones, which are deleted; rows whose
+        object is missing are reported. Walks every object - run it rarely."""
+        started = time.monotonic()
+        
+        # Drift: recount the ledger in one write transaction and compare
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute(LEDGER_TOTALS_QUERY)
+        ledger_totals = cursor.fetchone()
+        cursor.execute('SELECT file_type, file_count, total_bytes FROM storage_usage WHERE file_count != 0 OR total_bytes != 0')
+        ledger_by_type = set(cursor.fetchall())
+        
+        cursor.execute(STORAGE_TOTALS_RECOUNT)
+        cursor.execute(COMPRESSION_TOTALS_RECOUNT)
+        cursor.execute(DOWNLOAD_TOTAL_RECOUNT)
+        cursor.execute('DELETE FROM storage_usage')
+        cursor.execute('''
+            INSERT INTO storage_usage (file_type, file_count, total_bytes)
+            SELECT COALESCE(file_type, 'other'), COUNT(*), COALESCE(SUM(file_size), 0) FROM files
+            GROUP BY COALESCE(file_type, 'other')
+        ''')
+        cursor.execute(LEDGER_TOTALS_QUERY)
+        drifted = cursor.fetchone() != ledger_totals
+        cursor.execute('SELECT file_type, file_count, total_bytes FROM storage_usage')
+        drifted = drifted or set(cursor.fetchall()) != ledger_by_type
+        conn.commit()
+        
+        # Everything the database refers to, including chunked uploads in progress
+        cursor.execute('''
+            SELECT stored_name FROM files UNION SELECT stored_name FROM blobs
+            UNION SELECT preview_key FROM media_info WHERE preview_key IS NOT NULL
+        ''')
+        referenced = {row[0] for row in cursor.fetchall()}
+        cursor.execute('SELECT stored_name FROM upload_sessions')
+        staging = {get_staging_key(row[0]) for row in cursor.fetchall()}
+        conn.close()
+        
+        orphans = []
+        orphan_bytes = 0
+        tombstones_removed = 0
+        found = set()
+        cutoff = time.time() - RECONCILE_ORPHAN_GRACE
+        for key, size, mtime in storage.iter_objects():
+            if key in referenced:
+                found.add(key)
+                continue
+            if key in staging or mtime > cutoff:
+                continue
+            if '.deleted-' in key and storage.delete(key):
+                tombstones_removed += 1
+                continue
+            orphans.append(key)
+            orphan_bytes += size
+        
+        # A flat stored_name may already resolve to its shard path
+        missing = [key for key in referenced - found if storage.stat(key) is None]
+        
+        result = {
+            'ledger_drift': drifted,
+            'orphans': len(orphans),
+            'orphan_bytes': orphan_bytes,
+            'orphan_keys': orphans[:RECONCILE_REPORT_LIMIT],
+            'missing': len(missing),
+            'missing_keys': missing[:RECONCILE_REPORT_LIMIT],
+            'tombstones_removed': tombstones_removed,
+            'seconds': round(time.monotonic() - started, 2)
+        }
+        if drifted or orphans or missing:
+            logger.warning(f"Storage reconciliation: {result}")
+        return result
+    
+    def cleanup_stale_uploads(self):
+        try:
+            cutoff_time = datetime.now(timezone.utc) - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
             deleted_count = 0
             
-            conn = sqlite3.connect('file_storage.db')
+            conn = get_db_connection()
             cursor = conn.cursor()
             
-            # Get expired files
-            cursor.execute('SELECT id, stored_name FROM files WHERE expires_at < ?', (current_time,))
-            expired_files = cursor.fetchall()
+            cursor.execute('SELECT id, stored_name FROM upload_sessions WHERE updated_at < ?', (cutoff_time,))
+            stale_uploads = cursor.fetchall()
             
-            for file_id, stored_name in expired_files:
+            for upload_id, stored_name in stale_uploads:
+                staging_key = get_staging_key(stored_name)
+                pending_deletes = []
                 try:
-                    # Delete physical file
-                    file_path = os.path.join(STORAGE_FOLDER, stored_name)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
+                    conn.execute('BEGIN IMMEDIATE')
+                    # Re-read under the write lock - the client may have resumed or completed it
+                    cursor.execute('''
+                        SELECT storage_upload_id, checksum, blob_name FROM upload_sessions
+                        WHERE id = ? AND updated_at < ?
+                    ''', (upload_id, cutoff_time))
+                    row = cursor.fetchone()
+                    if not row:
+                        conn.rollback()
+                        continue
+                    storage_upload_id, checksum, blob_name = row
+                    
+                    if blob_name:
+                        # Stored but never recorded: give back the session's blob reference
+                        release_stored_file(cursor, blob_name, checksum, pending_deletes)
+                        staging_key = None
+                    else:
+                        # On S3 the staging object becomes the blob itself - never delete a live one
+                        cursor.execute('SELECT 1 FROM blobs WHERE stored_name = ?', (staging_key,))
+                        if cursor.fetchone():
+                            staging_key = None
                     
-                    # Delete database record
-                    cursor.execute('DELETE FROM files WHERE id = ?', (file_id,))
-                    cursor.execute('DELETE FROM download_stats WHERE file_id = ?', (file_id,))
+                    cursor.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+                    cursor.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+                    conn.commit()
                     deleted_count += 1
                     
                 except Exception as e:
-                    logger.error(f"Error deleting file {file_id}: {e}")
+                    conn.rollback()
+                    logger.error(f"Error deleting partial upload {upload_id}: {e}")
+                    continue
+                
+                try:
+                    if staging_key:
+                        storage.abort_parts(staging_key, storage_upload_id)
+                    for key in pending_deletes:
+                        storage.delete(key)
+                except Exception as e:
+                    logger.error(f"Error deleting partial upload {upload_id}: {e}")
             
-            conn.commit()
             conn.close()
             
             return deleted_count
             
         except Exception as e:
-            logger.error(f"Cleanup error: {e}")
+            logger.error(f"Stale upload cleanup error: {e}")
             return 0
 
 cache_scheduler = CacheScheduler()
 
+job_scheduler.add_job('visitor_cleanup', visitor_tracker.deactivate_inactive_visitors, VISITOR_CLEANUP_INTERVAL)
+# Abandoned resumable uploads are always reclaimed
+job_scheduler.add_job('stale_uploads', cache_scheduler.cleanup_stale_uploads, STALE_UPLOAD_CLEANUP_INTERVAL)
+job_scheduler.add_job('expired_files', cache_scheduler.run_scheduled_cleanup,
+                      cache_scheduler.cleanup_interval_seconds, lease_seconds=3600)
+job_scheduler.add_job('storage_reconcile', cache_scheduler.reconcile_storage,
+                      cache_scheduler.reconcile_interval_seconds, lease_seconds=6 * 3600)
+job_scheduler.add_job('download_retention', prune_download_stats, DOWNLOAD_RETENTION_INTERVAL, lease_seconds=3600)
+
+# ===== BACKGROUND SERVICES =====
+background_lock = threading.Lock()
+background_started = False
+
+def start_background_services():
+    """Start this process's writer, sync, media and scheduler threads. Called on
+    the first request (or ASGI startup) instead of at import, so the CLI
+    commands and media worker processes that import this module start none."""
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        visitor_tracker.start()
+        download_log.start()
+        rate_limiter.start()
+        media_processor.start()
+        job_scheduler.start()
+        background_started = True
+
+@app.before_request
+def ensure_background_services():
+    if not background_started:
+        start_background_services()
+
 # ===== ADMIN AUTHENTICATION =====
 def admin_required(f):
     @wraps(f)
@@ -305,25 +3819,17 @@ def admin_required(f):
 def get_admin_settings():
     """Get admin-controlled settings"""
     try:
-        conn = sqlite3.connect('file_storage.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT key, value FROM settings WHERE key IN (?, ?, ?)', 
-                      ('default_expire_days', 'max_file_size_gb', 'max_download_limit'))
-        settings = dict(cursor.fetchall())
-        conn.close()
-        
         return {
-            'expire_days': int(settings.get('default_expire_days', 30)),
-            'max_size_gb': int(settings.get('max_file_size_gb', 15)),
-            'download_limit': int(settings.get('max_download_limit', 100))
+            'expire_days': settings_cache.get('default_expire_days'),
+            'max_size_gb': settings_cache.get('max_file_size_gb'),
+            'download_limit': settings_cache.get('max_download_limit')
         }
     except:
         return {'expire_days': 30, 'max_size_gb': 15, 'download_limit': 100}
 
 def get_banners(position=None):
     try:
-        conn = sqlite3.connect('file_storage.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         if position:
@@ -389,21 +3895,405 @@ def format_file_size(size_bytes):
     
     return f"{size_bytes:.1f}{size_names[i]}"
 
-def generate_qr_code(url):
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+QR_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml'
+}
+
+# share_code -> {fmt: image bytes}
+qr_memory_cache = LRUCache(QR_MEMORY_CACHE_ITEMS)
+
+def render_qr_code(url, fmt):
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(url)
+    qr.make(fit=True)
+    
+    img_buffer = io.BytesIO()
+    if fmt == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(img_buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(img_buffer, format='PNG')
+    return img_buffer.getvalue()
+
+def get_qr_cache_dir(share_code):
+    return os.path.join(QR_CACHE_FOLDER, share_code)
+
+def get_share_url(share_code):
+    base_url = PUBLIC_BASE_URL or request.url_root
+    return f"{base_url.rstrip('/')}/f/{share_code}"
+
+def get_qr_image(share_code, fmt):
+    """Memory cache, then the on-disk cache, then render and fill both.
+    Without PUBLIC_BASE_URL the encoded URL depends on the request, so nothing is cached."""
+    share_url = get_share_url(share_code)
+    if not PUBLIC_BASE_URL:
+        return render_qr_code(share_url, fmt)
+    
+    variants = qr_memory_cache.get(share_code, {})
+    data = variants.get(fmt)
+    if data is not None:
+        return data
+    
+    cache_path = os.path.join(get_qr_cache_dir(share_code), f"qr.{fmt}")
     try:
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='PNG')
-        img_buffer.seek(0)
-        
-        return base64.b64encode(img_buffer.getvalue()).decode()
-    except:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = render_qr_code(share_url, fmt)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, cache_path)
+    
+    qr_memory_cache.put(share_code, {**variants, fmt: data})
+    return data
+
+def purge_qr_cache(share_codes=None):
+    """Drop cached QR images for deleted share codes (None = all of them)"""
+    if share_codes is None:
+        qr_memory_cache.invalidate()
+        for entry in os.listdir(QR_CACHE_FOLDER):
+            shutil.rmtree(os.path.join(QR_CACHE_FOLDER, entry), ignore_errors=True)
+        return
+    
+    for share_code in share_codes:
+        qr_memory_cache.invalidate(share_code)
+        shutil.rmtree(get_qr_cache_dir(share_code), ignore_errors=True)
+
+def build_stored_name(file_id, original_name):
+    file_ext = original_name.rsplit('.', 1)[1].lower() if '.' in original_name else ''
+    return f"{file_id}.{file_ext}" if file_ext else file_id
+
+def get_staging_key(stored_name):
+    return storage.staging_key(stored_name)
+
+def hash_file_password(password):
+    return hashlib.sha256(password.encode()).hexdigest() if password else None
+
+def create_file_record(file_id, original_name, stored_name, file_size, mime_type, hashed_password,
+                       description, is_public, admin_settings, uploader_ip, checksum=None, upload=None):
+    """Insert the `files` row for a fully stored upload; returns (share_code, expires_at).
+
+    upload is (upload_id, completion_owner) of a chunked upload session: it is
+    deleted in the same transaction, and as the session holds the blob
+    reference it is not given back when this fails."""
+    # Use admin-controlled expiration
+    expire_days = admin_settings['expire_days']
+    download_limit = admin_settings['download_limit']
+    
+    file_type = get_file_type(original_name)
+    share_code = generate_share_code()
+    expires_at = datetime.now(timezone.utc) + timedelta(days=expire_days)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO files (
+                id, original_name, stored_name, file_type, file_size, 
+                mime_type, share_code, password, download_limit, expires_at, 
+                uploader_ip, description, is_public, checksum
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            file_id, original_name, stored_name, file_type, file_size,
+            mime_type, share_code, hashed_password, download_limit, expires_at,
+            uploader_ip, description, is_public, checksum
+        ))
+        if upload:
+            cursor.execute('DELETE FROM upload_sessions WHERE id = ? AND completion_owner = ?', upload)
+            if cursor.rowcount != 1:
+                raise RuntimeError('upload session was taken over by another completion')
+            cursor.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload[0],))
+        # Previews are made in the background; queued atomically with the file
+        media_kind = get_media_kind(mime_type)
+        if media_kind:
+            queue_media_job(cursor, stored_name, media_kind, file_size)
+        conn.commit()
+    except Exception:
+        # Give the blob reference back so the content is not leaked
+        conn.rollback()
+        if checksum and not upload:
+            conn.execute('BEGIN IMMEDIATE')
+            release_stored_file(cursor, stored_name, checksum)
+            conn.commit()
+        conn.close()
+        raise
+    
+    conn.close()
+    
+    # Forget a lookup of this code made before it existed
+    share_code_cache.invalidate(share_code)
+    if media_kind:
+        media_processor.wake()
+    site_stats.record_upload(file_size)
+    if is_public:
+        homepage_cache.invalidate('recent_files')
+    
+    return share_code, expires_at
+
+def build_upload_result(file_id, share_code, expires_at):
+    """Upload response for a created file record"""
+    # QR image is rendered on first request to /qr/<share_code>.png
+    return {
+        'success': True,
+        'file_id': file_id,
+        'share_code': share_code,
+        'share_url': get_share_url(share_code),
+        'qr_url': url_for('qr_code_image', share_code=share_code, fmt='png'),
+        'expires_at': expires_at.isoformat(),
+        'expire_days': max(0, round((expires_at - datetime.now(timezone.utc)).total_seconds() / 86400))
+    }
+
+# ===== FILE DELIVERY =====
+def get_file_etag(stored_name, stat, checksum=None):
+    """Strong ETag: the content SHA-256 when known, otherwise derived from the
+    immutable stored object (stored names are never rewritten in place)"""
+    if checksum:
+        return checksum
+    file_size, mtime = stat
+    return hashlib.sha256(f"{stored_name}:{file_size}:{mtime}".encode()).hexdigest()[:32]
+
+def parse_byte_ranges(range_header, file_size):
+    """Return a list of (start, end_exclusive) ranges, [] for no/ignored Range,
+    or None when the Range header cannot be satisfied"""
+    parsed = parse_range_header(range_header)
+    if parsed is None or parsed.units != 'bytes':
+        return []
+    
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:  # Suffix range: last N bytes
+            start = max(file_size + start, 0)
+            stop = file_size
+        else:
+            stop = file_size if stop is None else min(stop, file_size)
+        if start < stop:
+            ranges.append((start, stop))
+    
+    if not ranges:
+        return None
+    
+    # Merge overlapping/adjacent ranges so segments are never sent twice
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, stop in ranges[1:]:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+# checksum -> (frame_size, compressed frame sizes); blobs never change in place
+frame_index_cache = LRUCache(COMPRESSION_INDEX_CACHE_ITEMS)
+
+def get_frame_index(checksum):
+    index = frame_index_cache.get(checksum)
+    if index is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT frame_size, frame_index FROM blobs WHERE hash = ?', (checksum,))
+        frame_size, data = cursor.fetchone()
+        conn.close()
+        index = (frame_size, unpack_frame_index(data))
+        frame_index_cache.put(checksum, index)
+    return index
+
+def accepts_encoding(codec):
+    # Only an explicit mention counts - '*' also comes from clients that cannot decode zstd
+    return any(value == codec and quality > 0 for value, quality in request.accept_encodings)
+
+def iter_file_range(stored_name, start, stop, content=None):
+    """Body bytes from the hot-file cache's copy when there is one, else from storage"""
+    if content is None:
+        yield from storage.iter_range(stored_name, start, stop)
+        return
+    for offset in range(start, stop, STREAM_BUFFER_SIZE):
+        yield content[offset:min(offset + STREAM_BUFFER_SIZE, stop)]
+
+def iter_decompressed_range(stored_name, start, stop, frame_index, content=None):
+    """Original bytes [start, stop) of a compressed object: only the frames
+    overlapping the range are read, in one pass, and each is decompressed whole"""
+    frame_size, frame_sizes = frame_index
+    first, last = start // frame_size, (stop - 1) // frame_size
+    offset = sum(frame_sizes[:first])
+    decompressor = zstandard.ZstdDecompressor()
+    pending = bytearray()
+    index = first
+    for buffer in iter_file_range(stored_name, offset, offset + sum(frame_sizes[first:last + 1]), content):
+        pending += buffer
+        while index <= last and len(pending) >= frame_sizes[index]:
+            data = decompressor.decompress(bytes(pending[:frame_sizes[index]]))
+            del pending[:frame_sizes[index]]
+            frame_start = index * frame_size
+            yield data[max(start - frame_start, 0):stop - frame_start]
+            index += 1
+
+def iter_multipart_ranges(read_range, ranges, file_size, mime_type, boundary):
+    for start, stop in ranges:
+        yield (f"--{boundary}\r\nContent-Type: {mime_type}\r\n"
+               f"Content-Range: bytes {start}-{stop - 1}/{file_size}\r\n\r\n").encode()
+        yield from read_range(start, stop)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+def content_disposition(download_name):
+    ascii_name = download_name.encode('ascii', 'ignore').decode() or 'download'
+    return f'attachment; filename="{ascii_name}"; filename*=UTF-8\'\'{quote(download_name)}'
+
+def plan_file_response(stat, etag):
+    """Evaluate conditional and Range headers for a stored file.
+
+    Returns (status, ranges): 304 when the client copy is current, 416 when the
+    Range is unsatisfiable, 206 with the ranges to send, or 200 for the full body.
+    """
+    file_size, mtime = stat
+    last_modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+    
+    if_none_match = request.if_none_match
+    if if_none_match:
+        if if_none_match.contains(etag) or if_none_match.star_tag:
+            return 304, []
+    elif request.if_modified_since and last_modified <= request.if_modified_since:
+        return 304, []
+    
+    range_header = request.headers.get('Range')
+    if not range_header:
+        return 200, []
+    
+    # If-Range: only honour the Range when the client's copy is still current
+    if_range = parse_if_range_header(request.headers.get('If-Range'))
+    if if_range.etag is not None and if_range.etag != etag:
+        return 200, []
+    if if_range.date is not None and last_modified > if_range.date:
+        return 200, []
+    
+    ranges = parse_byte_ranges(range_header, file_size)
+    if ranges is None:
+        return 416, []
+    if not ranges:
+        return 200, []
+    return 206, ranges
+
+def get_delivery_mode(rate=0, codec=None, encoded=False):
+    """How build_file_response sends a body. Front-server and sendfile delivery
+    need the file on this machine's disk, and a throttled transfer has to pass
+    through Python unless nginx does the pacing. Compressed content is
+    decompressed here unless it goes out with its Content-Encoding (encoded)."""
+    if not storage.is_local or (codec and not encoded):
+        return 'stream'
+    delivery_mode = DOWNLOAD_DELIVERY_MODE
+    if codec and delivery_mode in ('x-accel', 'x-sendfile'):
+        # nginx drops the Content-Encoding header on X-Accel-Redirect
+        delivery_mode = 'sendfile'
+    if rate > 0 and delivery_mode in ('sendfile', 'x-sendfile'):
+        return 'stream'
+    return delivery_mode
+
+class TransferFile(io.FileIO):
+    """A file that runs on_close once the server closes it; sendfile() still works on it"""
+    
+    def __init__(self, path, on_close):
+        super().__init__(path, 'rb')
+        self.on_close = on_close
+    
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.on_close()
+
+def build_file_response(stored_name, stat, download_name, mime_type, etag, status, ranges, rate=0, on_close=None,
+                        content=None, codec=None, encoded=False, frame_index=None):
+    """rate paces the body (bytes/second); on_close runs when the server is done
+    sending it - call_on_close() is skipped for direct_passthrough bodies.
+    content is the hot-file cache's copy of the file, served instead of storage.
+    For a compressed object (codec), stat and ranges refer to the stored bytes
+    sent with Content-Encoding when encoded, else to the original content,
+    decompressed on the way out using frame_index."""
+    file_size, mtime = stat
+    mime_type = mime_type or mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    delivery_mode = get_delivery_mode(rate, codec, encoded)
+    streamed = False
+    
+    def read_range(start, stop):
+        if codec and not encoded:
+            return iter_decompressed_range(stored_name, start, stop, frame_index, content)
+        return iter_file_range(stored_name, start, stop, content)
+    
+    if status in (200, 206) and delivery_mode in ('x-accel', 'x-sendfile'):
+        # The front server does the transfer (including Range handling) from its own location
+        response = app.response_class(mimetype=mime_type)
+        file_path = storage.path(stored_name)
+        if delivery_mode == 'x-accel':
+            relative_path = os.path.relpath(file_path, storage.root).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = X_ACCEL_LOCATION + quote(relative_path)
+            if rate > 0:
+                response.headers['X-Accel-Limit-Rate'] = str(rate)
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(file_path)
+        response.headers['Content-Disposition'] = content_disposition(download_name)
+    elif status == 200 and delivery_mode == 'sendfile' and content is None:
+        # Absolute, or send_file() resolves it against the app root instead of the working directory
+        file_path = os.path.abspath(storage.path(stored_name))
+        body = TransferFile(file_path, on_close) if on_close else file_path
+        response = send_file(body, mimetype=mime_type, as_attachment=True,
+                             download_name=download_name, conditional=False, etag=False)
+        response.content_length = file_size
+    elif status == 200:
+        response = app.response_class(read_range(0, file_size), mimetype=mime_type, direct_passthrough=True)
+        response.content_length = file_size
+        response.headers['Content-Disposition'] = content_disposition(download_name)
+        streamed = True
+    elif status == 206 and len(ranges) == 1:
+        start, stop = ranges[0]
+        response = app.response_class(read_range(start, stop), status=206,
+                                      mimetype=mime_type, direct_passthrough=True)
+        streamed = True
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{file_size}'
+        response.content_length = stop - start
+        response.headers['Content-Disposition'] = content_disposition(download_name)
+    elif status == 206:
+        boundary = secrets.token_hex(16)
+        response = app.response_class(
+            iter_multipart_ranges(read_range, ranges, file_size, mime_type, boundary), status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+        response.headers['Content-Disposition'] = content_disposition(download_name)
+        streamed = True
+    elif status == 416:
+        response = app.response_class(status=416)
+        response.headers['Content-Range'] = f'bytes */{file_size}'
+    else:
+        response = app.response_class(status=304)
+    
+    if streamed:
+        if rate > 0:
+            pace_response(response, rate)
+        if on_close:
+            response.response = ClosingIterator(response.response, on_close)
+    
+    if codec:
+        # Stored frames or decompressed content, depending on Accept-Encoding
+        response.vary.add('Accept-Encoding')
+        if encoded and status == 200:
+            response.headers['Content-Encoding'] = codec
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['ETag'] = quote_etag(etag)
+    response.headers['Last-Modified'] = http_date(mtime)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def get_download_bytes(status, ranges, file_size):
+    """Bytes of the file a response delivers, for DownloadLog.account(); None
+    for responses that deliver none (HEAD, 304, 416)"""
+    if request.method == 'HEAD' or status not in (200, 206):
         return None
+    return sum(stop - start for start, stop in ranges) if status == 206 else file_size
 
 # ===== MIDDLEWARE =====
 @app.before_request
@@ -411,54 +4301,64 @@ def track_visitors():
     if request.endpoint and not request.endpoint.startswith('static'):
         visitor_tracker.track_visitor(request)
 
+@app.before_request
+def enforce_rate_limits():
+    scope = RATE_LIMITED_ENDPOINTS.get(request.endpoint)
+    if scope is None or (scope == 'login' and request.method != 'POST'):
+        return None
+    if request.environ.get('filestore.rate_checked'):
+        # Already counted by the ASGI layer before it read the upload body
+        return None
+    
+    allowed, retry_after = rate_limiter.allow(scope, request.remote_addr)
+    if allowed:
+        return None
+    
+    if scope == 'login':
+        response = app.make_response(
+            (render_template('admin_login.html', error='Quá nhiều lần đăng nhập, vui lòng thử lại sau'), 429))
+    else:
+        response = jsonify({'success': False, 'error': 'Quá nhiều yêu cầu, vui lòng thử lại sau'})
+        response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
 # ===== MAIN ROUTES =====
+def get_recent_files():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, original_name, file_type, file_size, share_code, download_count, uploaded_at
+        FROM files 
+        WHERE is_public = 1 AND expires_at > ? 
+        ORDER BY uploaded_at DESC 
+        LIMIT 10
+    ''', (datetime.now(timezone.utc),))
+    
+    recent_files = []
+    for row in cursor.fetchall():
+        recent_files.append({
+            'id': row[0],
+            'name': row[1],
+            'type': row[2],
+            'size': format_file_size(row[3]),
+            'share_code': row[4],
+            'downloads': row[5],
+            'uploaded_at': row[6]
+        })
+    
+    conn.close()
+    return recent_files
+
 @app.route('/')
 def index():
     try:
-        left_banners = get_banners('left')
-        right_banners = get_banners('right')
+        left_banners = homepage_cache.get('banners_left', lambda: get_banners('left'))
+        right_banners = homepage_cache.get('banners_right', lambda: get_banners('right'))
         admin_settings = get_admin_settings()
         
-        # Get recent public files
-        conn = sqlite3.connect('file_storage.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, original_name, file_type, file_size, share_code, download_count, uploaded_at
-            FROM files 
-            WHERE is_public = 1 AND expires_at > ? 
-            ORDER BY uploaded_at DESC 
-            LIMIT 10
-        ''', (datetime.now(timezone.utc),))
-        
-        recent_files = []
-        for row in cursor.fetchall():
-            recent_files.append({
-                'id': row[0],
-                'name': row[1],
-                'type': row[2],
-                'size': format_file_size(row[3]),
-                'share_code': row[4],
-                'downloads': row[5],
-                'uploaded_at': row[6]
-            })
-        
-        # Get stats
-        cursor.execute('SELECT COUNT(*) FROM files WHERE expires_at > ?', (datetime.now(timezone.utc),))
-        total_files = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT SUM(file_size) FROM files WHERE expires_at > ?', (datetime.now(timezone.utc),))
-        total_size = cursor.fetchone()[0] or 0
-        
-        cursor.execute('SELECT SUM(download_count) FROM files')
-        total_downloads = cursor.fetchone()[0] or 0
-        
-        conn.close()
-        
-        stats = {
-            'total_files': total_files,
-            'total_size': total_size,
-            'total_downloads': total_downloads
-        }
+        recent_files = homepage_cache.get('recent_files', get_recent_files)
+        stats = site_stats.get()
         
         return render_template('index.html', 
                              left_banners=left_banners, 
@@ -478,208 +4378,581 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    writer = None
     try:
+        # Get admin settings
+        admin_settings = get_admin_settings()
+        
+        # Check request size before reading the body (Flask MAX_CONTENT_LENGTH is the hard cap)
+        max_size = admin_settings['max_size_gb'] * 1024 * 1024 * 1024
+        too_large = jsonify({'success': False, 'error': f'File quá lớn. Tối đa {admin_settings["max_size_gb"]}GB'}), 413
+        if request.content_length and request.content_length > max_size:
+            return too_large
+        
+        # Stream the body straight into storage - size, checksum and MIME type in one pass.
+        # Under ASGI the body has already been ingested without holding a thread.
+        file_id = str(uuid.uuid4())
+        ingested = request.environ.get('filestore.ingested')
+        if ingested:
+            writer, filename, declared_mime_type, form = ingested
+        else:
+            try:
+                writer, filename, declared_mime_type, form = ingest_multipart_upload(get_staging_key(file_id),
+                                                                                     max_size=max_size)
+            except UploadTooLarge:
+                return too_large
+        
         # Check if file is in request
-        if 'file' not in request.files:
+        if writer is None or not filename:
+            if writer:
+                writer.discard()
             return jsonify({'success': False, 'error': 'Không có file được chọn'}), 400
         
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'success': False, 'error': 'Không có file được chọn'}), 400
+        # Get form data - Note: expire_days is now admin-controlled
+        description = form.get('description', '')
+        password = form.get('password', '')
+        is_public = form.get('is_public') == 'true'
         
-        # Get admin settings
-        admin_settings = get_admin_settings()
+        original_name = secure_filename(filename)
+        mime_type = sniff_mime_type(writer.head, original_name, declared_mime_type)
         
-        # Check file size (this is automatically handled by Flask MAX_CONTENT_LENGTH, but let's be explicit)
-        if hasattr(file, 'content_length') and file.content_length:
-            max_size = admin_settings['max_size_gb'] * 1024 * 1024 * 1024
-            if file.content_length > max_size:
-                return jsonify({'success': False, 'error': f'File quá lớn. Tối đa {admin_settings["max_size_gb"]}GB'}), 400
+        # Save file into the blob store
+        stored_name = store_blob(writer.staging_key, writer.checksum, writer.size, writer.encoding)
         
-        # Get form data - Note: expire_days is now admin-controlled
-        description = request.form.get('description', '')
-        password = request.form.get('password', '')
-        is_public = request.form.get('is_public') == 'true'
+        share_code, expires_at = create_file_record(
+            file_id, original_name, stored_name, writer.size, mime_type, hash_file_password(password),
+            description, is_public, admin_settings, request.remote_addr, writer.checksum
+        )
+        return jsonify(build_upload_result(file_id, share_code, expires_at))
+        
+    except Exception as e:
+        if writer:
+            writer.discard()
+        logger.error(f"Upload error: {e}")
+        return jsonify({'success': False, 'error': f'Lỗi tải lên: {str(e)}'}), 500
+
+# ===== CHUNKED UPLOAD ROUTES =====
+def get_upload_session(cursor, upload_id):
+    cursor.execute('''
+        SELECT id, original_name, stored_name, total_size, chunk_size, mime_type,
+               password, description, is_public, status, storage_upload_id,
+               uploader_ip, checksum, blob_name, last_error
+        FROM upload_sessions WHERE id = ?
+    ''', (upload_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    
+    return {
+        'id': row[0],
+        'original_name': row[1],
+        'stored_name': row[2],
+        'total_size': row[3],
+        'chunk_size': row[4],
+        'mime_type': row[5],
+        'password': row[6],
+        'description': row[7],
+        'is_public': bool(row[8]),
+        'status': row[9],
+        'storage_upload_id': row[10],
+        'uploader_ip': row[11],
+        'checksum': row[12],
+        'blob_name': row[13],
+        'last_error': row[14],
+        'total_chunks': (row[3] + row[4] - 1) // row[4]
+    }
+
+def get_upload_progress(cursor, upload):
+    cursor.execute('SELECT chunk_index FROM upload_chunks WHERE upload_id = ?', (upload['id'],))
+    received = {row[0] for row in cursor.fetchall()}
+    missing = [i for i in range(upload['total_chunks']) if i not in received]
+    
+    received_bytes = upload['total_size'] - sum(
+        min(upload['chunk_size'], upload['total_size'] - i * upload['chunk_size']) for i in missing
+    )
+    
+    return {
+        'upload_id': upload['id'],
+        'total_size': upload['total_size'],
+        'chunk_size': upload['chunk_size'],
+        'total_chunks': upload['total_chunks'],
+        'received_chunks': len(received),
+        'received_bytes': received_bytes,
+        'missing_chunks': missing,
+        'status': upload['status'],
+        'last_error': upload['last_error']
+    }
+
+def get_completed_upload(cursor, upload_id):
+    """Upload response of a chunked upload whose file record exists (the file
+    takes the upload's id), or None"""
+    cursor.execute('SELECT share_code, expires_at FROM files WHERE id = ?', (upload_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return build_upload_result(upload_id, row[0], datetime.fromisoformat(row[1].replace('Z', '+00:00')))
+
+def complete_upload(upload_id, owner):
+    """Assemble, hash and store a chunked upload, then create its file record.
+    Runs on upload_completion_pool under the session's completion claim; a
+    failure puts the session back so that /complete can be retried."""
+    conn = get_db_connection()
+    upload = get_upload_session(conn.cursor(), upload_id)
+    conn.close()
+    if not upload:
+        return
+    
+    def update_session(assignments, params):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'UPDATE upload_sessions SET {assignments} WHERE id = ? AND completion_owner = ?',
+                      (*params, upload_id, owner))
+        conn.commit()
+        conn.close()
+        return cursor.rowcount == 1
+    
+    staging_key = get_staging_key(upload['stored_name'])
+    stored_name = upload['blob_name']
+    checksum = upload['checksum']
+    mime_type = upload['mime_type']
+    try:
+        if stored_name is None:
+            if upload['storage_upload_id'] is not None:
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                cursor.execute('SELECT chunk_index, etag FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+                parts = [(chunk_index + 1, etag) for chunk_index, etag in cursor.fetchall()]
+                conn.close()
+                storage.finish_parts(staging_key, upload['storage_upload_id'], parts)
+                # The backend handle is spent, a retry must not finish the parts again
+                update_session('storage_upload_id = NULL', ())
+            
+            # Chunks arrive out of order, so the content is hashed once when complete
+            checksum = hash_stored_file(staging_key, upload['total_size'])
+            head = b''.join(storage.iter_range(staging_key, 0, min(MIME_SNIFF_BYTES, upload['total_size'])))
+            mime_type = sniff_mime_type(head, upload['original_name'], upload['mime_type'])
+            
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM blobs WHERE hash = ?', (checksum,))
+            duplicate = cursor.fetchone() is not None
+            conn.close()
+            
+            # A duplicate is dropped by store_blob anyway, no point compressing it
+            compressed = None if duplicate else compress_staged_object(
+                staging_key, upload['total_size'], mime_type, upload['original_name'])
+            if compressed:
+                compressed_key, encoding = compressed
+                try:
+                    stored_name = store_blob(compressed_key, checksum, upload['total_size'], encoding)
+                except Exception:
+                    storage.delete(compressed_key)
+                    raise
+                # The raw assembly is only needed until the compressed copy is stored
+                try:
+                    storage.delete(staging_key)
+                except Exception as e:
+                    logger.warning(f"Upload complete: could not delete {staging_key}: {e}")
+            else:
+                stored_name = store_blob(staging_key, checksum, upload['total_size'])
+            
+            # From here the session holds the blob reference
+            if not update_session('checksum = ?, blob_name = ?, mime_type = ?', (checksum, stored_name, mime_type)):
+                conn = get_db_connection()
+                conn.execute('BEGIN IMMEDIATE')
+                release_stored_file(conn.cursor(), stored_name, checksum)
+                conn.commit()
+                conn.close()
+                return
+        
+        create_file_record(
+            upload_id, upload['original_name'], stored_name, upload['total_size'], mime_type,
+            upload['password'], upload['description'], upload['is_public'], get_admin_settings(),
+            upload['uploader_ip'], checksum, upload=(upload_id, owner)
+        )
+    except Exception as e:
+        logger.error(f"Upload complete error ({upload_id}): {e}")
+        try:
+            # Stored content stays with the session: a retry only creates the record
+            update_session("status = ?, completion_owner = NULL, last_error = ?, updated_at = ?",
+                           ('stored' if stored_name else 'uploading', str(e), datetime.now(timezone.utc)))
+        except Exception as update_error:
+            logger.error(f"Upload complete error ({upload_id}): {update_error}")
+
+upload_completion_pool = ThreadPoolExecutor(max_workers=UPLOAD_COMPLETE_WORKERS, thread_name_prefix='upload-complete')
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    try:
+        data = request.get_json(silent=True) or {}
+        original_name = secure_filename(data.get('filename') or '')
+        if not original_name:
+            return jsonify({'success': False, 'error': 'Không có file được chọn'}), 400
         
-        # Use admin-controlled expiration
-        expire_days = admin_settings['expire_days']
-        download_limit = admin_settings['download_limit']
+        try:
+            total_size = int(data.get('size', -1))
+            chunk_size = int(data.get('chunk_size') or UPLOAD_CHUNK_SIZE)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Kích thước không hợp lệ'}), 400
         
-        # Generate unique filename
-        file_id = str(uuid.uuid4())
-        original_name = secure_filename(file.filename)
-        file_ext = original_name.rsplit('.', 1)[1].lower() if '.' in original_name else ''
-        stored_name = f"{file_id}.{file_ext}" if file_ext else file_id
-        file_path = os.path.join(STORAGE_FOLDER, stored_name)
+        if total_size < 0 or not 0 < chunk_size <= MAX_UPLOAD_CHUNK_SIZE:
+            return jsonify({'success': False, 'error': 'Kích thước không hợp lệ'}), 400
         
-        # Save file
-        file.save(file_path)
-        file_size = os.path.getsize(file_path)
-        file_type = get_file_type(original_name)
+        # Chunks map to backend parts (S3: at least 5MB each, at most 10000 of them)
+        chunk_size = max(chunk_size, storage.min_part_size)
+        if storage.max_parts:
+            chunk_size = max(chunk_size, -(-total_size // storage.max_parts))
+        if chunk_size > MAX_UPLOAD_CHUNK_SIZE:
+            return jsonify({'success': False, 'error': 'Kích thước không hợp lệ'}), 400
+        
+        admin_settings = get_admin_settings()
+        max_size = admin_settings['max_size_gb'] * 1024 * 1024 * 1024
+        if total_size > max_size:
+            return jsonify({'success': False, 'error': f'File quá lớn. Tối đa {admin_settings["max_size_gb"]}GB'}), 400
         
-        # Create database record
-        share_code = generate_share_code()
-        expires_at = datetime.now(timezone.utc) + timedelta(days=expire_days)
+        upload_id = str(uuid.uuid4())
+        stored_name = build_stored_name(upload_id, original_name)
+        storage_upload_id = storage.begin_parts(get_staging_key(stored_name), total_size)
         
-        # Hash password if provided
-        hashed_password = None
-        if password:
-            hashed_password = hashlib.sha256(password.encode()).hexdigest()
+        current_time = datetime.now(timezone.utc)
+        mime_type = data.get('mime_type') or mimetypes.guess_type(original_name)[0] or 'application/octet-stream'
         
-        conn = sqlite3.connect('file_storage.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
-        
         cursor.execute('''
-            INSERT INTO files (
-                id, original_name, stored_name, file_type, file_size, 
-                mime_type, share_code, password, download_limit, expires_at, 
-                uploader_ip, description, is_public
+            INSERT INTO upload_sessions (
+                id, original_name, stored_name, total_size, chunk_size, mime_type,
+                password, description, is_public, uploader_ip, created_at, updated_at,
+                storage_upload_id
             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
-            file_id, original_name, stored_name, file_type, file_size,
-            file.mimetype, share_code, hashed_password, download_limit, expires_at,
-            request.remote_addr, description, is_public
+            upload_id, original_name, stored_name, total_size, chunk_size, mime_type,
+            hash_file_password(data.get('password', '')), data.get('description', ''),
+            bool(data.get('is_public', True)), request.remote_addr, current_time, current_time,
+            storage_upload_id
         ))
-        
         conn.commit()
         conn.close()
         
-        # Generate share URL and QR code
-        share_url = request.url_root + f"f/{share_code}"
-        qr_code = generate_qr_code(share_url)
-        
         return jsonify({
             'success': True,
-            'file_id': file_id,
-            'share_code': share_code,
-            'share_url': share_url,
-            'qr_code': qr_code,
-            'expires_at': expires_at.isoformat(),
-            'expire_days': expire_days
+            'upload_id': upload_id,
+            'chunk_size': chunk_size,
+            'total_chunks': (total_size + chunk_size - 1) // chunk_size
         })
         
     except Exception as e:
-        logger.error(f"Upload error: {e}")
+        logger.error(f"Upload init error: {e}")
         return jsonify({'success': False, 'error': f'Lỗi tải lên: {str(e)}'}), 500
 
-@app.route('/f/<share_code>')
-def share_page(share_code):
+@app.route('/upload/<upload_id>/chunk', methods=['PUT'])
+def upload_chunk(upload_id):
     try:
-        conn = sqlite3.connect('file_storage.db')
+        try:
+            offset = int(request.args.get('offset', -1))
+        except ValueError:
+            offset = -1
+        
+        conn = get_db_connection()
         cursor = conn.cursor()
+        upload = get_upload_session(cursor, upload_id)
+        conn.close()
         
-        cursor.execute('SELECT * FROM files WHERE share_code = ?', (share_code,))
-        result = cursor.fetchone()
+        if not upload or upload['status'] != 'uploading':
+            return jsonify({'success': False, 'error': 'Phiên tải lên không tồn tại'}), 404
         
-        if not result:
+        if offset < 0 or offset >= upload['total_size'] or offset % upload['chunk_size']:
+            return jsonify({'success': False, 'error': 'Offset không hợp lệ'}), 400
+        
+        expected_size = min(upload['chunk_size'], upload['total_size'] - offset)
+        if request.content_length != expected_size:
+            return jsonify({'success': False, 'error': f'Chunk phải có đúng {expected_size} bytes'}), 400
+        
+        # Each chunk is written independently, so chunks can arrive concurrently
+        chunk_index = offset // upload['chunk_size']
+        written, etag = storage.write_part(get_staging_key(upload['stored_name']), upload['storage_upload_id'],
+                                           chunk_index + 1, offset, get_upload_stream(), expected_size)
+        
+        if written != expected_size:
+            return jsonify({'success': False, 'error': 'Chunk bị gián đoạn, vui lòng gửi lại'}), 400
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO upload_chunks (upload_id, chunk_index, etag) VALUES (?, ?, ?)
+            ON CONFLICT(upload_id, chunk_index) DO UPDATE SET etag = excluded.etag
+        ''', (upload_id, chunk_index, etag))
+        cursor.execute('UPDATE upload_sessions SET updated_at = ? WHERE id = ?',
+                      (datetime.now(timezone.utc), upload_id))
+        conn.commit()
+        conn.close()
+        
+        return jsonify({'success': True, 'offset': offset, 'size': written})
+        
+    except Exception as e:
+        logger.error(f"Upload chunk error: {e}")
+        return jsonify({'success': False, 'error': f'Lỗi tải lên: {str(e)}'}), 500
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        upload = get_upload_session(cursor, upload_id)
+        if not upload:
+            result = get_completed_upload(cursor, upload_id)
             conn.close()
-            abort(404)
+            if result:
+                return jsonify({**result, 'upload_id': upload_id, 'status': 'complete'})
+            return jsonify({'success': False, 'error': 'Phiên tải lên không tồn tại'}), 404
         
-        file_data = {
-            'id': result[0],
-            'original_name': result[1],
-            'file_type': result[3],
-            'file_size': format_file_size(result[4]),
-            'share_code': result[6],
-            'has_password': bool(result[7]),
-            'download_limit': result[8],
-            'download_count': result[9],
-            'expires_at': result[11],
-            'description': result[14]
-        }
+        progress = get_upload_progress(cursor, upload)
+        conn.close()
         
-        # Check if expired
-        if file_data['expires_at']:
-            expires_at = datetime.fromisoformat(file_data['expires_at'].replace('Z', '+00:00'))
-            if datetime.now(timezone.utc) > expires_at:
-                conn.close()
-                return render_template('index.html', error='File đã hết hạn')
+        return jsonify({'success': True, **progress})
+        
+    except Exception as e:
+        logger.error(f"Upload status error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    """Start (or restart) completing a chunked upload. Assembling and hashing a
+    large upload outlasts proxy timeouts, so it runs in the background: this
+    answers 202 and the client polls GET /upload/<upload_id> until the status
+    is 'complete'. Calling it again once complete returns the same result."""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        upload = get_upload_session(cursor, upload_id)
+        if not upload:
+            result = get_completed_upload(cursor, upload_id)
+            conn.close()
+            if result:
+                return jsonify({**result, 'upload_id': upload_id, 'status': 'complete'})
+            return jsonify({'success': False, 'error': 'Phiên tải lên không tồn tại'}), 404
         
-        # Check download limit
-        if file_data['download_count'] >= file_data['download_limit']:
+        progress = get_upload_progress(cursor, upload)
+        if upload['status'] == 'uploading' and progress['missing_chunks']:
             conn.close()
-            return render_template('index.html', error='File đã đạt giới hạn tải xuống')
+            return jsonify({'success': False, 'error': 'Chưa nhận đủ dữ liệu', **progress}), 409
         
-        # Update last accessed
-        cursor.execute('UPDATE files SET last_accessed = ? WHERE share_code = ?', 
-                      (datetime.now(timezone.utc), share_code))
+        # Claim the session so a concurrent complete call cannot finish it twice. A
+        # completion whose worker died comes back after the lease.
+        owner = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        cursor.execute('''
+            UPDATE upload_sessions SET status = 'completing', completion_owner = ?, last_error = NULL, updated_at = ?
+            WHERE id = ? AND (status IN ('uploading', 'stored') OR (status = 'completing' AND updated_at < ?))
+        ''', (owner, now, upload_id, now - timedelta(seconds=UPLOAD_COMPLETE_LEASE)))
         conn.commit()
+        claimed = cursor.rowcount == 1
         conn.close()
         
+        if claimed:
+            upload_completion_pool.submit(complete_upload, upload_id, owner)
+        
+        return jsonify({**progress, 'success': True, 'status': 'completing', 'last_error': None}), 202
+        
+    except Exception as e:
+        logger.error(f"Upload complete error: {e}")
+        return jsonify({'success': False, 'error': f'Lỗi tải lên: {str(e)}'}), 500
+
+@app.route('/f/<share_code>')
+def share_page(share_code):
+    try:
+        record = share_code_cache.get(share_code)
+        if not record:
+            # Returned, not raised - the handler below would turn abort(404) into a 500
+            return not_found(None)
+        
+        # Check if expired
+        if record.expires_at and datetime.now(timezone.utc) > record.expires_at:
+            return render_template('index.html', error='File đã hết hạn')
+        
+        # Check download limit (the cached count errs strict, reserve() has the last word)
+        download_count = record.download_count
+        if download_log.limit_reached(record):
+            return render_template('index.html', error='File đã đạt giới hạn tải xuống')
+        
+        # Last accessed is written with the next download rollup
+        download_log.touch(record.id)
+        
+        file_data = {
+            'id': record.id,
+            'original_name': record.original_name,
+            'file_type': record.file_type,
+            'file_size': format_file_size(record.file_size),
+            'share_code': share_code,
+            'has_password': bool(record.password),
+            'download_limit': record.download_limit,
+            'download_count': download_count,
+            'expires_at': record.expires_at.isoformat() if record.expires_at else None,
+            'description': record.description,
+            # A preview would give away the content of a password-protected file
+            'preview_url': url_for('media_preview', share_code=share_code)
+                           if record.preview_key and not record.password else None,
+            'dimensions': f"{record.width}×{record.height}" if record.width and record.height else None,
+            'duration': format_duration(record.duration) if record.duration else None
+        }
+        
         return render_template('index.html', shared_file=file_data, show_download=True)
         
     except Exception as e:
         logger.error(f"Share page error: {e}")
         abort(500)
 
+@app.route('/qr/<share_code>.<fmt>')
+def qr_code_image(share_code, fmt):
+    if fmt not in QR_FORMATS:
+        abort(404)
+    
+    # Same checks as the share page: no QR codes for unknown or expired files
+    record = share_code_cache.get(share_code)
+    if not record:
+        abort(404)
+    if record.expires_at and datetime.now(timezone.utc) > record.expires_at:
+        abort(404)
+    
+    try:
+        data = get_qr_image(share_code, fmt)
+    except Exception as e:
+        logger.error(f"QR code error: {e}")
+        abort(500)
+    
+    response = app.response_class(data, mimetype=QR_FORMATS[fmt])
+    url_key = hashlib.sha256(get_share_url(share_code).encode()).hexdigest()[:16]
+    response.set_etag(f"{url_key}-{fmt}")
+    response.cache_control.public = True
+    response.cache_control.max_age = QR_MAX_AGE
+    return response.make_conditional(request)
+
+@app.route('/preview/<share_code>.jpg')
+def media_preview(share_code):
+    record = share_code_cache.get(share_code)
+    if not record or not record.preview_key or record.password:
+        abort(404)
+    if record.expires_at and datetime.now(timezone.utc) > record.expires_at:
+        abort(404)
+    
+    try:
+        data = b''.join(storage.iter_range(record.preview_key, 0, PREVIEW_MAX_BYTES))
+    except Exception as e:
+        logger.error(f"Preview error: {e}")
+        abort(500)
+    
+    # Previews are made once per stored object and never change
+    response = app.response_class(data, mimetype='image/jpeg')
+    response.set_etag(hashlib.sha256(record.preview_key.encode()).hexdigest()[:16])
+    response.cache_control.public = True
+    response.cache_control.max_age = PREVIEW_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
 @app.route('/download/<share_code>')
 def download_file(share_code):
     try:
         password = request.args.get('password', '')
         
-        conn = sqlite3.connect('file_storage.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM files WHERE share_code = ?', (share_code,))
-        result = cursor.fetchone()
-        
-        if not result:
-            conn.close()
-            abort(404)
-        
-        file_data = {
-            'id': result[0],
-            'original_name': result[1],
-            'stored_name': result[2],
-            'password': result[7],
-            'download_limit': result[8],
-            'download_count': result[9],
-            'expires_at': result[11]
-        }
+        record = share_code_cache.get(share_code)
+        if not record:
+            return jsonify({'error': 'File không tồn tại'}), 404
         
         # Check if expired
-        if file_data['expires_at']:
-            expires_at = datetime.fromisoformat(file_data['expires_at'].replace('Z', '+00:00'))
-            if datetime.now(timezone.utc) > expires_at:
-                conn.close()
-                return jsonify({'error': 'File đã hết hạn'}), 410
+        if record.expires_at and datetime.now(timezone.utc) > record.expires_at:
+            return jsonify({'error': 'File đã hết hạn'}), 410
         
-        # Check download limit
-        if file_data['download_count'] >= file_data['download_limit']:
-            conn.close()
+        # Check download limit (the cached count errs strict, reserve() has the last word)
+        if download_log.limit_reached(record):
             return jsonify({'error': 'File đã đạt giới hạn tải xuống'}), 403
         
         # Check password
-        if file_data['password']:
+        if record.password:
             if not password:
-                conn.close()
                 return jsonify({'error': 'Cần mật khẩu'}), 401
             
-            hashed_password = hashlib.sha256(password.encode()).hexdigest()
-            if hashed_password != file_data['password']:
-                conn.close()
+            if hash_file_password(password) != record.password:
                 return jsonify({'error': 'Mật khẩu sai'}), 401
         
-        # Check if file exists
-        file_path = os.path.join(STORAGE_FOLDER, file_data['stored_name'])
-        if not os.path.exists(file_path):
-            conn.close()
-            return jsonify({'error': 'File không tồn tại'}), 404
+        # S3 with presigned URLs: the client fetches the object from the bucket
+        # directly, which also handles conditional and Range requests. Compressed
+        # objects are always sent from here - the bucket would hand out the frames.
+        download_url = None if record.codec else storage.download_url(
+            record.stored_name, record.original_name, record.mime_type or 'application/octet-stream')
+        if download_url:
+            ranges = parse_byte_ranges(request.headers.get('Range', ''), record.file_size)
+            status = 416 if ranges is None else (206 if ranges else 200)
+            bytes_sent = get_download_bytes(status, ranges, record.file_size)
+            if bytes_sent is not None:
+                charged = download_log.account(record.id, record.stored_name, record.file_size, bytes_sent,
+                                               request.remote_addr, request.headers.get('User-Agent', ''))
+                if charged is None:
+                    return jsonify({'error': 'File đã đạt giới hạn tải xuống'}), 403
+                if charged:
+                    site_stats.record_download()
+            response = redirect(download_url)
+            response.headers['Cache-Control'] = 'private, no-store'
+            return response
         
-        # Update download count and log
-        cursor.execute('UPDATE files SET download_count = download_count + 1, last_accessed = ? WHERE share_code = ?', 
-                      (datetime.now(timezone.utc), share_code))
+        rate = settings_cache.get('download_bandwidth_kb_per_second') * 1024
+        # Compressed content goes out as stored to clients that accept its encoding
+        # (whole-file requests only), everyone else gets it decompressed
+        encoded = bool(record.codec) and not request.headers.get('Range') and accepts_encoding(record.codec)
+        in_process = get_delivery_mode(rate, record.codec, encoded) in ('stream', 'sendfile')
         
-        cursor.execute('''
-            INSERT INTO download_stats (file_id, file_name, download_ip, user_agent)
-            VALUES (?, ?, ?, ?)
-        ''', (file_data['id'], file_data['original_name'], 
-              request.remote_addr, request.headers.get('User-Agent', '')))
+        # Popular files are served from memory; stored objects never change in place
+        hot = hot_files.lookup(record.stored_name)
+        if hot is None:
+            # Check if file exists
+            stat = storage.stat(record.stored_name)
+            if stat is None:
+                return jsonify({'error': 'File không tồn tại'}), 404
+            hot = hot_files.admit(record.stored_name, stat, in_memory=in_process)
+        if hot:
+            content, stat = hot
+        else:
+            content = None
         
-        conn.commit()
-        conn.close()
+        etag = get_file_etag(record.stored_name, stat, record.checksum)
+        frame_index = None
+        if encoded:
+            etag = f"{etag}-{record.codec}"
+        elif record.codec:
+            # Sizes and ranges refer to the original content
+            stat = (record.file_size, stat[1])
+            frame_index = get_frame_index(record.checksum)
+        status, ranges = plan_file_response(stat, etag)
         
-        return send_file(file_path, as_attachment=True, download_name=file_data['original_name'])
+        # A body sent by this process holds one of the share code's transfer slots until it is done
+        holds_slot = status in (200, 206) and in_process
+        if holds_slot and not rate_limiter.acquire_transfer(share_code):
+            response = jsonify({'error': 'File đang có quá nhiều lượt tải cùng lúc, vui lòng thử lại sau'})
+            response.status_code = 429
+            response.headers['Retry-After'] = '5'
+            return response
+        
+        try:
+            # Bill the response before sending - the stats are rolled up later. Sizes
+            # are those of the original content, also for an encoded response.
+            bytes_sent = get_download_bytes(status, ranges, record.file_size)
+            if bytes_sent is not None:
+                charged = download_log.account(record.id, record.stored_name, record.file_size, bytes_sent,
+                                               request.remote_addr, request.headers.get('User-Agent', ''))
+                if charged is None:
+                    if holds_slot:
+                        rate_limiter.release_transfer(share_code)
+                    return jsonify({'error': 'File đã đạt giới hạn tải xuống'}), 403
+                if charged:
+                    site_stats.record_download()
+            
+            return build_file_response(record.stored_name, stat, record.original_name,
+                                       record.mime_type, etag, status, ranges, rate,
+                                       on_close=(lambda: rate_limiter.release_transfer(share_code)) if holds_slot else None,
+                                       content=content, codec=record.codec, encoded=encoded, frame_index=frame_index)
+        except Exception:
+            if holds_slot:
+                rate_limiter.release_transfer(share_code)
+            raise
         
     except Exception as e:
         logger.error(f"Download error: {e}")
@@ -689,7 +4962,7 @@ def download_file(share_code):
 @app.route('/banner/click/<int:banner_id>')
 def banner_click(banner_id):
     try:
-        conn = sqlite3.connect('file_storage.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         cursor.execute('UPDATE banners SET clicks = clicks + 1 WHERE id = ?', (banner_id,))
@@ -715,13 +4988,8 @@ def admin_login():
         username = request.form.get('username')
         password = request.form.get('password')
         
-        conn = sqlite3.connect('file_storage.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT value FROM settings WHERE key = ?', ('admin_username',))
-        db_username = cursor.fetchone()[0]
-        cursor.execute('SELECT value FROM settings WHERE key = ?', ('admin_password_hash',))
-        db_password_hash = cursor.fetchone()[0]
-        conn.close()
+        db_username = settings_cache.get('admin_username')
+        db_password_hash = settings_cache.get('admin_password_hash')
         
         if username == db_username and check_password_hash(db_password_hash, password):
             session['admin_logged_in'] = True
@@ -744,45 +5012,93 @@ def admin_dashboard():
     return render_template('admin.html')
 
 # ===== ADMIN API ROUTES =====
+def get_dashboard_stats():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    # Active visitors
+    active_visitors = count_active_visitors(cursor)
+    
+    # Total files and downloads
+    totals = site_stats.get()
+    
+    # Active banners
+    cursor.execute('SELECT COUNT(*) FROM banners WHERE status = 1')
+    active_banners = cursor.fetchone()[0]
+    
+    conn.close()
+    
+    return {
+        'visitors': {'active_now': active_visitors},
+        'files': {'total_files': totals['total_files'], 'total_downloads': totals['total_downloads']},
+        'banners': {'active_banners': active_banners}
+    }
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.route('/admin/api/stats')
 @admin_required
 def admin_stats():
     try:
-        conn = sqlite3.connect('file_storage.db')
-        cursor = conn.cursor()
-        
-        # Active visitors
-        cutoff_time = datetime.now(timezone.utc) - timedelta(minutes=5)
-        cursor.execute('SELECT COUNT(*) FROM visitors WHERE is_active = 1 AND last_activity > ?', (cutoff_time,))
-        active_visitors = cursor.fetchone()[0]
-        
-        # Total files
-        cursor.execute('SELECT COUNT(*) FROM files WHERE expires_at > ?', (datetime.now(timezone.utc),))
-        total_files = cursor.fetchone()[0]
-        
-        # Total downloads
-        cursor.execute('SELECT SUM(download_count) FROM files')
-        total_downloads = cursor.fetchone()[0] or 0
-        
-        # Active banners
-        cursor.execute('SELECT COUNT(*) FROM banners WHERE status = 1')
-        active_banners = cursor.fetchone()[0]
-        
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'stats': {
-                'visitors': {'active_now': active_visitors},
-                'files': {'total_files': total_files, 'total_downloads': total_downloads},
-                'banners': {'active_banners': active_banners}
-            }
-        })
+        return jsonify({'success': True, 'stats': get_dashboard_stats()})
         
     except Exception as e:
         logger.error(f"Stats API error: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+admin_stream_slots = threading.BoundedSemaphore(ADMIN_STREAM_WSGI_MAX)
+
+@app.route('/admin/api/stream')
+@admin_required
+def admin_stream():
+    """Server-sent events for the dashboard: one snapshot of the stats, then
+    deltas as uploads, downloads, visitors and cleanups happen. A fresh
+    snapshot follows whenever the stream fell behind and every
+    STATS_RESYNC_SECONDS, which also picks up other workers' changes.
+
+    Served natively by asgi_app() under ASGI. Under WSGI every open stream
+    pins a request thread, so past ADMIN_STREAM_WSGI_MAX a dashboard gets
+    one snapshot and is told to reconnect later - it polls instead."""
+    if not admin_stream_slots.acquire(blocking=False):
+        response = app.response_class(
+            f"retry: {ADMIN_STREAM_POLL_RETRY_MS}\n{format_sse('snapshot', get_dashboard_stats())}",
+            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    def generate():
+        subscriber = event_bus.subscribe()
+        try:
+            yield f"retry: 5000\n{format_sse('snapshot', get_dashboard_stats())}"
+            synced_at = time.monotonic()
+            
+            while True:
+                try:
+                    event, data = subscriber.get(timeout=ADMIN_STREAM_HEARTBEAT)
+                except queue.Empty:
+                    event = data = None
+                
+                if event_bus.take_overflow(subscriber) or time.monotonic() - synced_at > STATS_RESYNC_SECONDS:
+                    yield format_sse('snapshot', get_dashboard_stats())
+                    synced_at = time.monotonic()
+                elif event:
+                    yield format_sse(event, data)
+                else:
+                    # Keeps proxies from timing out the idle connection
+                    yield ': keepalive\n\n'
+        except Exception as e:
+            logger.error(f"Admin stream error: {e}")
+        finally:
+            event_bus.unsubscribe(subscriber)
+    
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    # Also runs when the client is gone before the first chunk, unlike the finally above
+    response.call_on_close(admin_stream_slots.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 # Continue with the rest of the admin API routes...
 # (Banner management, cache management, settings, etc.)
 # [Previous admin routes remain the same]
@@ -806,19 +5122,29 @@ def internal_error(error):
 def admin_cache():
     try:
         if request.method == 'GET':
-            # Get cache info
-            total_files = 0
-            total_size = 0
-            
-            for filename in os.listdir(STORAGE_FOLDER):
-                file_path = os.path.join(STORAGE_FOLDER, filename)
-                if os.path.isfile(file_path):
-                    total_files += 1
-                    total_size += os.path.getsize(file_path)
+            # Get cache info - all from the usage ledger, no directory walk
+            conn = get_db_connection()
+            usage = get_storage_usage(conn.cursor())
+            dedup = get_dedup_stats(conn.cursor())
+            compression = get_compression_stats(conn.cursor())
+            conn.close()
             
             cache_info = {
-                'total_files': total_files,
-                'total_size_mb': round(total_size / (1024 * 1024), 2)
+                'total_files': usage['stored_files'],
+                'total_size_mb': round(usage['stored_bytes'] / (1024 * 1024), 2),
+                'by_type': usage['by_type'],
+                'dedup_ratio': dedup['dedup_ratio'],
+                'bytes_saved': dedup['bytes_saved'],
+                'saved_mb': round(dedup['bytes_saved'] / (1024 * 1024), 2),
+                'compression': compression,
+                'cleanup': dict(cache_scheduler.cleanup_progress),
+                'download_log': download_log.get_stats(),
+                'event_bus': event_bus.get_stats(),
+                'rate_limits': rate_limiter.get_stats(),
+                'hot_files': hot_files.get_stats(),
+                'share_code_cache': share_code_cache.get_stats(),
+                'media': media_processor.get_stats(),
+                'jobs': job_scheduler.get_status()
             }
             
             return jsonify({'success': True, 'cache_info': cache_info})
@@ -833,25 +5159,40 @@ def admin_cache():
                 
             elif action == 'clear_all':
                 # Clear all files (dangerous!)
-                deleted_count = 0
                 try:
-                    conn = sqlite3.connect('file_storage.db')
+                    conn = get_db_connection()
                     cursor = conn.cursor()
                     
-                    cursor.execute('SELECT stored_name FROM files')
+                    conn.execute('BEGIN IMMEDIATE')
+                    # Freed bytes are what the removed blobs took up in storage
+                    cursor.execute('''
+                        SELECT f.stored_name, f.checksum, COALESCE(b.stored_size, b.size, f.file_size)
+                        FROM files f LEFT JOIN blobs b ON b.hash = f.checksum
+                    ''')
                     all_files = cursor.fetchall()
                     
-                    for (stored_name,) in all_files:
-                        file_path = os.path.join(STORAGE_FOLDER, stored_name)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            deleted_count += 1
+                    bytes_freed = 0
+                    pending_deletes = []
+                    for stored_name, checksum, stored_size in all_files:
+                        if release_stored_file(cursor, stored_name, checksum, pending_deletes):
+                            bytes_freed += stored_size or 0
                     
                     cursor.execute('DELETE FROM files')
                     cursor.execute('DELETE FROM download_stats')
+                    cursor.execute('DELETE FROM download_rollups')
+                    cursor.execute('DELETE FROM download_rollup_ips')
+                    cursor.execute('DELETE FROM user_agents')
                     
                     conn.commit()
                     conn.close()
+                    # Deleted after the commit, outside the write lock, as in cleanup_expired_files
+                    list(cache_scheduler.unlink_pool.map(cache_scheduler.unlink_quietly, pending_deletes))
+                    invalidate_file_caches()
+                    purge_qr_cache()
+                    share_code_cache.invalidate()
+                    hot_files.clear()
+                    deleted_count = len(all_files)
+                    publish_cleanup(deleted_count, bytes_freed)
                     
                     message = f'Đã xóa tất cả {deleted_count} file'
                     
@@ -876,7 +5217,7 @@ def admin_cache():
 @admin_required
 def admin_banners():
     try:
-        conn = sqlite3.connect('file_storage.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         if request.method == 'GET':
@@ -919,6 +5260,7 @@ def admin_banners():
             banner_id = cursor.lastrowid
             conn.commit()
             conn.close()
+            homepage_cache.invalidate()
             
             return jsonify({
                 'success': True, 
@@ -950,6 +5292,7 @@ def admin_banners():
             
             conn.commit()
             conn.close()
+            homepage_cache.invalidate()
             
             return jsonify({
                 'success': True, 
@@ -979,6 +5322,7 @@ def admin_banners():
             cursor.execute('DELETE FROM banners WHERE id = ?', (banner_id,))
             conn.commit()
             conn.close()
+            homepage_cache.invalidate()
             
             return jsonify({
                 'success': True, 
@@ -1031,7 +5375,7 @@ def admin_upload():
 @admin_required
 def admin_visitors():
     try:
-        conn = sqlite3.connect('file_storage.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -1059,7 +5403,8 @@ def admin_visitors():
         return jsonify({
             'success': True,
             'visitors': visitors,
-            'active_count': visitor_tracker.get_active_count()
+            'active_count': visitor_tracker.get_active_count(),
+            'tracking': visitor_tracker.get_stats()
         })
         
     except Exception as e:
@@ -1070,14 +5415,14 @@ def admin_visitors():
 @admin_required
 def admin_files():
     try:
-        conn = sqlite3.connect('file_storage.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT id, original_name, file_type, file_size, 
-                   download_count, uploaded_at, expires_at, uploader_ip
-            FROM files 
-            ORDER BY uploaded_at DESC 
+            SELECT f.id, f.original_name, f.file_type, f.file_size,
+                   f.download_count, f.uploaded_at, f.expires_at, f.uploader_ip, b.codec, b.stored_size
+            FROM files f LEFT JOIN blobs b ON b.hash = f.checksum
+            ORDER BY f.uploaded_at DESC 
             LIMIT 50
         ''')
         
@@ -1091,7 +5436,12 @@ def admin_files():
                 'downloads': row[4],
                 'uploaded_at': row[5],
                 'expires_at': row[6],
-                'uploader_ip': row[7]
+                'uploader_ip': row[7],
+                'compression': {
+                    'codec': row[8],
+                    'stored_size': format_file_size(row[9]),
+                    'ratio': round(row[3] / row[9], 2) if row[9] else None
+                } if row[8] else None
             })
         
         conn.close()
@@ -1102,11 +5452,76 @@ def admin_files():
         logger.error(f"Files API error: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/admin/api/downloads')
+@admin_required
+def admin_downloads():
+    """Download analytics from the hourly/daily aggregates, never the raw events"""
+    try:
+        period = request.args.get('period', 'day')
+        if period not in DOWNLOAD_ROLLUP_PERIODS:
+            return jsonify({'success': False, 'error': 'Invalid period'})
+        
+        max_days = DOWNLOAD_HOURLY_ROLLUP_DAYS if period == 'hour' else DOWNLOAD_DAILY_ROLLUP_DAYS
+        days = min(max(request.args.get('days', 7, type=int), 1), max_days)
+        since = (datetime.now(timezone.utc) - timedelta(days=days)).strftime(DOWNLOAD_ROLLUP_PERIODS[period])
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        # unique_ips is counted per file and bucket, then summed
+        cursor.execute('''
+            SELECT bucket_start, SUM(downloads), SUM(bytes), SUM(unique_ips)
+            FROM download_rollups
+            WHERE period = ? AND bucket_start >= ?
+            GROUP BY bucket_start
+            ORDER BY bucket_start
+        ''', (period, since))
+        timeline = [{
+            'bucket_start': row[0],
+            'downloads': row[1],
+            'bytes': row[2],
+            'unique_ips': row[3]
+        } for row in cursor.fetchall()]
+        
+        cursor.execute('''
+            SELECT r.file_id, f.original_name, SUM(r.downloads), SUM(r.bytes), SUM(r.unique_ips)
+            FROM download_rollups r LEFT JOIN files f ON f.id = r.file_id
+            WHERE r.period = ? AND r.bucket_start >= ?
+            GROUP BY r.file_id
+            ORDER BY 3 DESC
+            LIMIT 10
+        ''', (period, since))
+        top_files = [{
+            'id': row[0][:8] + '...',
+            'name': row[1],
+            'deleted': row[1] is None,
+            'downloads': row[2],
+            'size': format_file_size(row[3]),
+            'unique_ips': row[4]
+        } for row in cursor.fetchall()]
+        
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'period': period,
+            'days': days,
+            'total_downloads': sum(bucket['downloads'] for bucket in timeline),
+            'total_bytes': sum(bucket['bytes'] for bucket in timeline),
+            'timeline': timeline,
+            'top_files': top_files,
+            'retention_days': settings_cache.get('download_stats_retention_days')
+        })
+        
+    except Exception as e:
+        logger.error(f"Downloads API error: {e}")
+        return jsonify({'success': False, 'error': str(e)})
+
 @app.route('/admin/api/settings', methods=['GET', 'POST'])
 @admin_required
 def admin_settings():
     try:
-        conn = sqlite3.connect('file_storage.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         if request.method == 'GET':
@@ -1143,6 +5558,8 @@ def admin_settings():
             
             conn.commit()
             conn.close()
+            settings_cache.reload()
+            job_scheduler.wake('expired_files')
             
             return jsonify({'success': True, 'message': 'Cài đặt đã được cập nhật'})
             
@@ -1150,15 +5567,666 @@ def admin_settings():
         logger.error(f"Settings API error: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+# ===== ASGI SERVING MODE =====
+# Run with an ASGI server, e.g. `uvicorn server:asgi_app --workers 4`.
+# Flask views still do the work (auth, checks, accounting) on a thread pool,
+# but request bodies are received and response bodies sent on the event loop:
+# a thread is only borrowed to read or write the next buffer, so thousands of
+# slow uploads/downloads can be in flight on one process.
+asgi_io_pool = ThreadPoolExecutor(max_workers=ASGI_IO_THREADS, thread_name_prefix='asgi-io')
+
+def asgi_file_wrapper(file, buffer_size=STREAM_BUFFER_SIZE):
+    # Larger reads than werkzeug's 8KB default mean fewer thread-pool round trips
+    return FileWrapper(file, max(buffer_size, STREAM_BUFFER_SIZE))
+
+def build_wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('127.0.0.1', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': asgi_file_wrapper,
+        'filestore.asgi': True,
+    }
+    
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').lower()
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    
+    return environ
+
+async def send_json_response(send, status, payload, headers=()):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def receive_body_chunks(receive):
+    """Yield request body buffers of about STREAM_BUFFER_SIZE"""
+    buffer = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('Client disconnected during upload')
+        buffer += message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if len(buffer) >= STREAM_BUFFER_SIZE or (buffer and not more_body):
+            yield bytes(buffer)
+            buffer.clear()
+        if not more_body:
+            return
+
+async def spool_request_body(receive, throttle=None):
+    body = tempfile.SpooledTemporaryFile(max_size=ASGI_BODY_SPOOL_SIZE)
+    loop = asyncio.get_running_loop()
+    received = 0
+    async for chunk in receive_body_chunks(receive):
+        received += len(chunk)
+        if received > MAX_CONTENT_LENGTH:
+            raise ValueError('Request body too large')
+        await loop.run_in_executor(asgi_io_pool, body.write, chunk)
+        if throttle:
+            await asyncio.sleep(throttle.delay(len(chunk)))
+    body.seek(0)
+    return body
+
+async def ingest_upload_async(receive, boundary, throttle=None, max_size=None):
+    """The /upload body, parsed and written to storage as it arrives"""
+    loop = asyncio.get_running_loop()
+    ingest = MultipartIngest(boundary, get_staging_key(str(uuid.uuid4())), max_size=max_size)
+    received = 0
+    try:
+        async for chunk in receive_body_chunks(receive):
+            received += len(chunk)
+            if received > MAX_CONTENT_LENGTH:
+                raise ValueError('Request body too large')
+            await loop.run_in_executor(asgi_io_pool, ingest.feed, chunk)
+            if throttle:
+                await asyncio.sleep(throttle.delay(len(chunk)))
+        if not ingest.finished:
+            await loop.run_in_executor(asgi_io_pool, ingest.feed, None)
+    except BaseException:
+        await loop.run_in_executor(asgi_io_pool, ingest.discard)
+        raise
+    return ingest.result()
+
+async def run_wsgi_app_async(environ, receive, send):
+    loop = asyncio.get_running_loop()
+    response_start = {}
+    
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = int(status.split(' ', 1)[0])
+        response_start['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        return lambda data: (_ for _ in ()).throw(RuntimeError('write() is not supported'))
+    
+    disconnected = asyncio.Event()
+    
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+    
+    watcher = asyncio.ensure_future(watch_disconnect())
+    iterable = await loop.run_in_executor(asgi_io_pool, app, environ, start_response)
+    try:
+        iterator = iter(iterable)
+        chunk = await loop.run_in_executor(asgi_io_pool, next, iterator, None)
+        await send({'type': 'http.response.start', **response_start})
+        
+        throttle = environ.get('filestore.throttle')
+        while chunk is not None and not disconnected.is_set():
+            if chunk:
+                if throttle:
+                    await asyncio.sleep(throttle.delay(len(chunk)))
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(asgi_io_pool, next, iterator, None)
+        
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        watcher.cancel()
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(asgi_io_pool, iterable.close)
+
+def is_admin_environ(environ):
+    with app.request_context(environ):
+        return bool(session.get('admin_logged_in'))
+
+async def stream_admin_events_async(environ, receive, send):
+    """/admin/api/stream on the event loop (see admin_stream()): an open
+    dashboard only borrows a thread to build a snapshot, never to wait"""
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(asgi_io_pool, is_admin_environ, environ):
+        # The view answers with its login redirect
+        await run_wsgi_app_async(environ, receive, send)
+        return
+    
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    
+    subscriber = event_bus.subscribe(AsyncSubscriber(ADMIN_STREAM_QUEUE_SIZE))
+    disconnected = asyncio.ensure_future(wait_for_disconnect())
+    getter = None
+    try:
+        snapshot = await loop.run_in_executor(asgi_io_pool, get_dashboard_stats)
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]
+        })
+        await send({'type': 'http.response.body', 'more_body': True,
+                    'body': f"retry: 5000\n{format_sse('snapshot', snapshot)}".encode()})
+        synced_at = time.monotonic()
+        
+        while True:
+            getter = getter or asyncio.ensure_future(subscriber.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=ADMIN_STREAM_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                return
+            event = data = None
+            if getter in done:
+                event, data = getter.result()
+                getter = None
+            
+            if event_bus.take_overflow(subscriber) or time.monotonic() - synced_at > STATS_RESYNC_SECONDS:
+                chunk = format_sse('snapshot', await loop.run_in_executor(asgi_io_pool, get_dashboard_stats))
+                synced_at = time.monotonic()
+            elif event:
+                chunk = format_sse(event, data)
+            else:
+                # Keeps proxies from timing out the idle connection
+                chunk = ': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    except Exception as e:
+        logger.error(f"Admin stream error: {e}")
+    finally:
+        event_bus.unsubscribe(subscriber)
+        disconnected.cancel()
+        if getter:
+            getter.cancel()
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_background_services()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(asgi_io_pool, visitor_tracker.shutdown)
+                await loop.run_in_executor(asgi_io_pool, download_log.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    if scope['type'] != 'http':
+        return
+    
+    environ = build_wsgi_environ(scope, io.BytesIO())
+    if scope['method'] == 'GET' and scope['path'] == '/admin/api/stream':
+        await stream_admin_events_async(environ, receive, send)
+        return
+    
+    try:
+        content_type = environ.get('CONTENT_TYPE', '')
+        is_multipart_upload = (scope['method'] == 'POST' and scope['path'] == '/upload'
+                               and content_type.startswith('multipart/form-data'))
+        is_upload_chunk = (scope['method'] == 'PUT' and scope['path'].startswith('/upload/')
+                           and scope['path'].endswith('/chunk'))
+        
+        if is_multipart_upload:
+            boundary = parse_options_header(content_type)[1].get('boundary')
+            
+            # Rate-limited and oversized uploads are refused before any byte is read
+            allowed, retry_after = rate_limiter.allow('upload', get_client_ip(environ))
+            if not allowed:
+                await send_json_response(send, 429, {'success': False, 'error': 'Quá nhiều yêu cầu, vui lòng thử lại sau'},
+                                         [(b'retry-after', str(retry_after).encode())])
+                return
+            environ['filestore.rate_checked'] = True
+            
+            max_size = get_admin_settings()['max_size_gb'] * 1024 * 1024 * 1024
+            declared_size = int(environ.get('CONTENT_LENGTH') or 0)
+            if declared_size > max_size:
+                raise UploadTooLarge(f'Declared size {declared_size} is larger than {max_size} bytes')
+            if boundary:
+                environ['filestore.ingested'] = await ingest_upload_async(receive, boundary, get_upload_throttle(),
+                                                                          max_size)
+        elif scope['method'] not in ('GET', 'HEAD'):
+            throttle = get_upload_throttle() if is_upload_chunk else None
+            environ['wsgi.input'] = await spool_request_body(receive, throttle)
+    except ValueError:
+        await send_json_response(send, 413, {'success': False,
+                                             'error': f'File quá lớn. Tối đa {get_admin_settings()["max_size_gb"]}GB'})
+        return
+    except ConnectionError:
+        return
+    
+    await run_wsgi_app_async(environ, receive, send)
+
+# ===== BENCHMARKS =====
+# `python server.py benchmark-...` commands. They run against this deployment's
+# database and storage: a scratch file is stored for the run and removed after.
+def create_benchmark_file(size, name='benchmark.bin'):
+    """Store `size` bytes as a private file without a download limit; returns (file_id, share_code)"""
+    staging_key = get_staging_key(f'benchmark-{uuid.uuid4().hex}')
+    block = os.urandom(STREAM_BUFFER_SIZE)
+    sha256 = hashlib.sha256()
+    writer = storage.open_writer(staging_key)
+    written = 0
+    try:
+        while written < size:
+            piece = block[:size - written]
+            writer.write(piece)
+            sha256.update(piece)
+            written += len(piece)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    
+    checksum = sha256.hexdigest()
+    stored_name = store_blob(staging_key, checksum, size)
+    file_id = str(uuid.uuid4())
+    share_code, _ = create_file_record(file_id, name, stored_name, size, 'application/octet-stream', None,
+                                       'benchmark', False, get_admin_settings(), '127.0.0.1', checksum)
+    conn = get_db_connection()
+    conn.execute('UPDATE files SET download_limit = NULL WHERE id = ?', (file_id,))
+    conn.commit()
+    conn.close()
+    share_code_cache.invalidate(share_code)
+    return file_id, share_code
+
+def remove_benchmark_file(file_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
+    cursor.execute('SELECT stored_name, checksum, share_code FROM files WHERE id = ?', (file_id,))
+    row = cursor.fetchone()
+    if not row:
+        conn.rollback()
+        conn.close()
+        return
+    stored_name, checksum, share_code = row
+    pending_deletes = []
+    release_stored_file(cursor, stored_name, checksum, pending_deletes)
+    cursor.execute('DELETE FROM files WHERE id = ?', (file_id,))
+    cursor.execute('DELETE FROM download_stats WHERE file_id = ?', (file_id,))
+    conn.commit()
+    conn.close()
+    
+    for key in pending_deletes:
+        storage.delete(key)
+    share_code_cache.invalidate(share_code)
+    invalidate_file_caches()
+    site_stats.invalidate()
+
+def open_benchmark_listener(backlog):
+    """Loopback listening socket; accepted sockets inherit its small send buffer"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BENCHMARK_SOCKET_BUFFER)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(backlog)
+    return listener
+
+class PooledWSGIServer(BaseWSGIServer):
+    """werkzeug's WSGI server with a fixed pool of request threads, like
+    gunicorn's gthread worker - the WSGI side of benchmark-slow-clients"""
+    
+    def __init__(self, listener, wsgi_app, threads):
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='benchmark-wsgi')
+        host, port = listener.getsockname()
+        super().__init__(host, port, wsgi_app, fd=listener.fileno())
+    
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+async def slow_download(port, path, rate):
+    """GET path reading at most `rate` bytes/second; returns the bytes received"""
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BENCHMARK_SOCKET_BUFFER)
+    sock.setblocking(False)
+    writer = None
+    try:
+        await loop.sock_connect(sock, ('127.0.0.1', port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: benchmark\r\nConnection: close\r\n\r\n'.encode())
+        received = 0
+        while True:
+            chunk = await reader.read(16 * 1024)
+            if not chunk:
+                return received
+            received += len(chunk)
+            # No catching up: a client kept waiting does not read faster afterwards
+            await asyncio.sleep(len(chunk) / rate)
+    finally:
+        if writer:
+            writer.close()
+        else:
+            sock.close()
+
+class UnpooledConnectionPool(ConnectionPool):
+    """A fresh connection per borrow, closed on release - how every request
+    connected before the pool, kept for benchmark-requests"""
+    
+    def connect(self):
+        return PooledConnection(self, self._open())
+    
+    def release(self, conn):
+        conn.close()
+
+def benchmark_requests(threads=REQUEST_BENCHMARK_THREADS, seconds=REQUEST_BENCHMARK_SECONDS):
+    """Request `/` and `/f/<code>` through test clients from `threads`
+    threads for `seconds` each, first with the connection pool and then with a
+    new SQLite connection per request. Returns one row per page and setup."""
+    global db_pool
+    file_id, share_code = create_benchmark_file(1024)
+    pooled = db_pool
+    rows = []
+    try:
+        for kind, pool in (('pooled', pooled), ('unpooled', UnpooledConnectionPool(DATABASE_PATH))):
+            db_pool = pool
+            for path in ('/', f'/f/{share_code}'):
+                stop_at = time.monotonic() + seconds
+                counts = []
+                
+                def client():
+                    test_client = app.test_client()
+                    ok = failed = 0
+                    while time.monotonic() < stop_at:
+                        if test_client.get(path).status_code == 200:
+                            ok += 1
+                        else:
+                            failed += 1
+                    counts.append((ok, failed))
+                workers = [threading.Thread(target=client) for _ in range(threads)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                
+                ok = sum(c[0] for c in counts)
+                rows.append({
+                    'connections': kind,
+                    'path': '/f/<code>' if path != '/' else path,
+                    'requests_per_second': round(ok / seconds, 1),
+                    'failed': sum(c[1] for c in counts),
+                })
+    finally:
+        db_pool = pooled
+        remove_benchmark_file(file_id)
+    return rows
+
+def benchmark_slow_clients(clients=SLOW_CLIENT_BENCHMARK_CLIENTS, rate=SLOW_CLIENT_BENCHMARK_RATE,
+                           size=SLOW_CLIENT_BENCHMARK_BYTES, wsgi_threads=SLOW_CLIENT_BENCHMARK_WSGI_THREADS):
+    """Open `clients` downloads of one `size`-byte file at once, each read at
+    `rate` bytes/second, against asgi_app under uvicorn and against the WSGI
+    app under a server with `wsgi_threads` request threads. Each run gets twice
+    the time one transfer takes, plus a few seconds. Returns one row per
+    server: transfers completed in time and the most threads in use."""
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError('benchmark-slow-clients requires uvicorn (pip install uvicorn)')
+    
+    start_background_services()  # so their threads are not counted
+    file_id, share_code = create_benchmark_file(size)
+    deadline = 2 * size / rate + 5
+    
+    async def run_clients(port):
+        async def client():
+            try:
+                return await asyncio.wait_for(slow_download(port, f'/download/{share_code}', rate), deadline)
+            except (asyncio.TimeoutError, OSError):
+                return 0
+        return await asyncio.gather(*(client() for _ in range(clients)))
+    
+    rows = []
+    try:
+        for kind in ('asgi', 'wsgi'):
+            listener = open_benchmark_listener(clients + 16)
+            port = listener.getsockname()[1]
+            if kind == 'asgi':
+                server = uvicorn.Server(uvicorn.Config(asgi_app, lifespan='off', log_level='warning', access_log=False))
+                thread = threading.Thread(target=server.run, kwargs={'sockets': [listener]}, daemon=True)
+                stop = lambda: setattr(server, 'should_exit', True)
+            else:
+                server = PooledWSGIServer(listener, app, wsgi_threads)
+                thread = threading.Thread(target=server.serve_forever, daemon=True)
+                stop = server.shutdown
+            
+            baseline = threading.active_count()
+            thread.start()
+            while kind == 'asgi' and not server.started:
+                time.sleep(0.05)
+            
+            peak = [baseline]
+            sampling = threading.Event()
+            
+            def sample_threads():
+                while not sampling.wait(0.05):
+                    peak[0] = max(peak[0], threading.active_count())
+            sampler = threading.Thread(target=sample_threads, daemon=True)
+            sampler.start()
+            
+            started = time.monotonic()
+            received = asyncio.run(run_clients(port))
+            seconds = time.monotonic() - started
+            sampling.set()
+            sampler.join()
+            stop()
+            thread.join(timeout=10)
+            if kind == 'wsgi':
+                server.server_close()
+                server.pool.shutdown(wait=False, cancel_futures=True)
+            listener.close()
+            
+            rows.append({
+                'server': kind,
+                'clients': clients,
+                'completed': sum(1 for n in received if n >= size),
+                'seconds': round(seconds, 1),
+                # Less the sampler, the server's own thread and what ran before
+                'peak_threads': max(0, peak[0] - baseline - 2),
+                'wsgi_threads': wsgi_threads if kind == 'wsgi' else None,
+            })
+    finally:
+        remove_benchmark_file(file_id)
+    return rows
+
+class CapturingFileWrapper(FileWrapper):
+    """wsgi.file_wrapper that keeps the file, so the benchmark can sendfile()
+    it the way gunicorn does"""
+
+def benchmark_delivery(size=DELIVERY_BENCHMARK_BYTES, modes=('stream', 'sendfile', 'x-accel', 'x-sendfile')):
+    """Send one `size`-byte file over a loopback socket in each delivery mode.
+    build_file_response() makes the response as for a download, then its body
+    goes out the way a server would send it: Python writing each chunk
+    (stream), or sendfile() of the file handed to wsgi.file_wrapper (sendfile).
+    With x-accel/x-sendfile the app only sends headers; the front server's
+    transfer of the named file is stood in for by a sendfile(). Returns one
+    row per mode: throughput, CPU time of the sending thread and the bytes
+    that passed through Python. Local storage only."""
+    global DOWNLOAD_DELIVERY_MODE
+    if not storage.is_local:
+        raise RuntimeError('benchmark-delivery needs local storage (the other modes read files from disk)')
+    
+    file_id, share_code = create_benchmark_file(size)
+    record = share_code_cache.get(share_code)
+    stat = storage.stat(record.stored_name)
+    etag = get_file_etag(record.stored_name, stat, record.checksum)
+    saved_mode = DOWNLOAD_DELIVERY_MODE
+    rows = []
+    try:
+        for mode in modes:
+            DOWNLOAD_DELIVERY_MODE = mode
+            listener = open_benchmark_listener(1)
+            sender = socket.create_connection(listener.getsockname())
+            receiver, _ = listener.accept()
+            listener.close()
+            received = [0]
+            
+            def drain():
+                buffer = bytearray(STREAM_BUFFER_SIZE)
+                while True:
+                    n = receiver.recv_into(buffer)
+                    if not n:
+                        return
+                    received[0] += n
+            drainer = threading.Thread(target=drain, daemon=True)
+            drainer.start()
+            
+            started = time.perf_counter()
+            cpu_started = time.thread_time()
+            python_bytes = 0
+            with app.test_request_context(f'/download/{share_code}',
+                                          environ_base={'wsgi.file_wrapper': CapturingFileWrapper}):
+                response = build_file_response(record.stored_name, stat, record.original_name,
+                                               record.mime_type, etag, 200, None)
+                app_seconds = time.perf_counter() - started
+                try:
+                    if 'X-Accel-Redirect' in response.headers:
+                        relative_path = unquote(response.headers['X-Accel-Redirect'][len(X_ACCEL_LOCATION):])
+                        with open(os.path.join(storage.root, relative_path), 'rb') as f:
+                            sender.sendfile(f)
+                    elif 'X-Sendfile' in response.headers:
+                        with open(response.headers['X-Sendfile'], 'rb') as f:
+                            sender.sendfile(f)
+                    elif isinstance(response.response, CapturingFileWrapper):
+                        sender.sendfile(response.response.file)
+                    else:
+                        for chunk in response.response:
+                            sender.sendall(chunk)
+                            python_bytes += len(chunk)
+                finally:
+                    response.close()
+            sender.shutdown(socket.SHUT_WR)
+            drainer.join()
+            seconds = time.perf_counter() - started
+            cpu_seconds = time.thread_time() - cpu_started
+            sender.close()
+            receiver.close()
+            
+            rows.append({
+                'mode': mode,
+                'bytes': received[0],
+                'seconds': round(seconds, 2),
+                'mb_per_second': round(received[0] / (1024 * 1024) / seconds, 1) if seconds else None,
+                'cpu_seconds': round(cpu_seconds, 2),
+                'python_bytes': python_bytes,
+                'app_ms': round(app_seconds * 1000, 2),
+            })
+    finally:
+        DOWNLOAD_DELIVERY_MODE = saved_mode
+        remove_benchmark_file(file_id)
+    return rows
+
 # ===== RUN SERVER =====
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['migrate-storage']:
+        # Safe to run while the server is up
+        result = migrate_storage_layout()
+        print(f"Storage layout migration: {result['moved']} moved, "
+              f"{result['missing']} missing, {result['skipped']} deleted meanwhile")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['benchmark-compression']:
+        # Usage: python server.py benchmark-compression [file ...]
+        rows = benchmark_compression(sys.argv[2:] or None)
+        if rows and rows[0]['files']:
+            print(f"Sample: {rows[0]['files']} file(s), {format_file_size(rows[0]['original_bytes'])}")
+        print(f"{'level':>5} {'ratio':>7} {'saved':>7} {'compress':>13} {'decompress':>13}")
+        for row in rows:
+            print(f"{row['level']:>5} {row['ratio']:>7} {row['saved_percent']:>6}% "
+                  f"{row['compress_mb_per_second'] or '-':>9} MB/s {row['decompress_mb_per_second'] or '-':>8} MB/s")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['benchmark-requests']:
+        # Usage: python server.py benchmark-requests [threads] [seconds]
+        threads = int(sys.argv[2]) if len(sys.argv) > 2 else REQUEST_BENCHMARK_THREADS
+        seconds = float(sys.argv[3]) if len(sys.argv) > 3 else REQUEST_BENCHMARK_SECONDS
+        rows = benchmark_requests(threads, seconds)
+        print(f"{threads} threads, {seconds:g}s per page")
+        print(f"{'page':>10} {'pooled':>12} {'unpooled':>12}")
+        by_page = {}
+        for row in rows:
+            by_page.setdefault(row['path'], {})[row['connections']] = row
+        for path, result in by_page.items():
+            print(f"{path:>10} {result['pooled']['requests_per_second']:>8} r/s "
+                  f"{result['unpooled']['requests_per_second']:>8} r/s")
+        failed = sum(row['failed'] for row in rows)
+        if failed:
+            print(f"{failed} requests did not return 200")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['benchmark-delivery']:
+        # Usage: python server.py benchmark-delivery [size in MB]
+        size = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) > 2 else DELIVERY_BENCHMARK_BYTES
+        rows = benchmark_delivery(size)
+        print(f"{format_file_size(size)} over loopback (x-accel/x-sendfile: the front server's sendfile stood in)")
+        print(f"{'mode':>10} {'throughput':>13} {'sender CPU':>11} {'through Python':>15} {'app':>9}")
+        for row in rows:
+            print(f"{row['mode']:>10} {row['mb_per_second']:>8} MB/s {row['cpu_seconds']:>10}s "
+                  f"{format_file_size(row['python_bytes']):>15} {row['app_ms']:>6} ms")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['benchmark-slow-clients']:
+        # Usage: python server.py benchmark-slow-clients [clients] [KB/s per client]
+        clients = int(sys.argv[2]) if len(sys.argv) > 2 else SLOW_CLIENT_BENCHMARK_CLIENTS
+        rate = int(sys.argv[3]) * 1024 if len(sys.argv) > 3 else SLOW_CLIENT_BENCHMARK_RATE
+        rows = benchmark_slow_clients(clients, rate)
+        print(f"{clients} clients at {rate // 1024} KB/s, {format_file_size(SLOW_CLIENT_BENCHMARK_BYTES)} each")
+        print(f"{'server':>18} {'completed':>10} {'seconds':>8} {'peak threads':>13}")
+        for row in rows:
+            name = f"wsgi ({row['wsgi_threads']} threads)" if row['server'] == 'wsgi' else 'asgi (uvicorn)'
+            print(f"{name:>18} {row['completed']:>6}/{row['clients']:<3} {row['seconds']:>8} {row['peak_threads']:>13}")
+        sys.exit(0)
+
     print("=" * 70)
     print("🗂️  FILE STORAGE & SHARING SERVICE")
     print("=" * 70)
     print(f"🌐 URL: http://localhost:5000")
     print(f"👤 Admin: http://localhost:5000/admin")
     print(f"🔑 Login: admin / admin123")
-    print(f"📁 Storage: {STORAGE_FOLDER}")
+    print(f"📁 Storage: {STORAGE_FOLDER if storage.is_local else f's3://{S3_BUCKET}/{S3_PREFIX}'}")
+    print(f"⚡ ASGI mode: uvicorn server:asgi_app (for many concurrent transfers)")
     print(f"📊 Max size: 15GB (Admin controlled)")
     print(f"⏰ Expiration: Admin controlled (default 30 days)")
     print("=" * 70)
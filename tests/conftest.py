@@ -0,0 +1,70 @@
+"""Fixtures shared by the test modules."""
+import importlib
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    # The app keeps its database and storage under the working directory and
+    # creates them on import, so import it inside a scratch directory. One
+    # import serves every module: relative paths resolve against the cwd.
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('server'))
+    sys.path.insert(0, ROOT)
+    try:
+        module = importlib.import_module('server')
+        module.init_db()
+        yield module
+    finally:
+        sys.path.remove(ROOT)
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+@pytest.fixture
+def settings(server):
+    """Call with setting=value pairs to change settings for one test"""
+    saved = {}
+
+    def write(values):
+        conn = server.get_db_connection()
+        for key, value in values.items():
+            conn.execute('UPDATE settings SET value = ? WHERE key = ?', (value, key))
+        conn.commit()
+        conn.close()
+        server.settings_cache.reload()
+
+    def change(**values):
+        conn = server.get_db_connection()
+        for key in values:
+            if key not in saved:
+                saved[key] = conn.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()[0]
+        conn.close()
+        write({key: str(value).lower() if isinstance(value, bool) else str(value) for key, value in values.items()})
+
+    yield change
+    if saved:
+        write(saved)
+
+
+@pytest.fixture
+def wait_for_upload(client):
+    """Poll GET /upload/<upload_id> until its completion finished one way or the other"""
+    def wait(upload_id, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            status = client.get(f'/upload/{upload_id}').get_json()
+            if status.get('status') != 'completing' or time.monotonic() > deadline:
+                return status
+            time.sleep(0.02)
+    return wait
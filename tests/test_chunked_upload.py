@@ -0,0 +1,98 @@
+"""Chunked uploads: PUT retries, progress reporting and background completion."""
+import os
+
+import pytest
+
+CHUNK = 1024
+CONTENT = os.urandom(2 * CHUNK + 300)
+
+
+def start_upload(client, content=CONTENT, name='chunked.bin'):
+    response = client.post('/upload/init', json={'filename': name, 'size': len(content), 'chunk_size': CHUNK})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['total_chunks'] == -(-len(content) // CHUNK)
+    return body['upload_id']
+
+
+def put_chunk(client, upload_id, index, content=CONTENT):
+    offset = index * CHUNK
+    return client.put(f'/upload/{upload_id}/chunk?offset={offset}', data=content[offset:offset + CHUNK])
+
+
+def test_chunk_put_retry_is_idempotent(client):
+    upload_id = start_upload(client)
+    assert put_chunk(client, upload_id, 0).status_code == 200
+    assert put_chunk(client, upload_id, 0).status_code == 200
+
+    status = client.get(f'/upload/{upload_id}').get_json()
+    assert status['status'] == 'uploading'
+    assert status['received_chunks'] == 1
+    assert status['received_bytes'] == CHUNK
+    assert status['missing_chunks'] == [1, 2]
+
+
+@pytest.mark.parametrize('query, data', [
+    ('offset=100', b'x' * CHUNK),          # not on a chunk boundary
+    ('offset=99999', b'x' * CHUNK),        # past the end
+    ('offset=0', b'x' * (CHUNK - 1)),      # short chunk
+    ('offset=2048', b'x' * CHUNK),         # the last chunk is only 300 bytes
+])
+def test_chunk_put_rejects_bad_offsets_and_sizes(client, query, data):
+    upload_id = start_upload(client)
+    assert client.put(f'/upload/{upload_id}/chunk?{query}', data=data).status_code == 400
+    assert client.get(f'/upload/{upload_id}').get_json()['received_chunks'] == 0
+
+
+def test_complete_reports_missing_chunks(client):
+    upload_id = start_upload(client)
+    put_chunk(client, upload_id, 0)
+    put_chunk(client, upload_id, 2)
+
+    response = client.post(f'/upload/{upload_id}/complete')
+    assert response.status_code == 409
+    assert response.get_json()['missing_chunks'] == [1]
+    assert client.get(f'/upload/{upload_id}').get_json()['status'] == 'uploading'
+
+
+def test_complete_then_poll_until_complete(client, wait_for_upload):
+    upload_id = start_upload(client)
+    # Chunks may arrive in any order
+    for index in (2, 0, 1):
+        assert put_chunk(client, upload_id, index).status_code == 200
+
+    response = client.post(f'/upload/{upload_id}/complete')
+    assert response.status_code == 202
+    assert response.get_json()['status'] == 'completing'
+
+    status = wait_for_upload(upload_id)
+    assert status['status'] == 'complete'
+    assert client.get(f"/download/{status['share_code']}").data == CONTENT
+
+    # Completing again answers with the same file
+    again = client.post(f'/upload/{upload_id}/complete')
+    assert again.status_code == 200
+    assert again.get_json()['share_code'] == status['share_code']
+
+
+def test_background_failure_is_reported_and_retryable(client, server, monkeypatch, wait_for_upload):
+    upload_id = start_upload(client)
+    for index in range(3):
+        put_chunk(client, upload_id, index)
+
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(server, 'store_blob', fail)
+    assert client.post(f'/upload/{upload_id}/complete').status_code == 202
+    status = wait_for_upload(upload_id)
+    assert status['status'] == 'uploading'
+    assert 'disk full' in status['last_error']
+    assert status['missing_chunks'] == []
+
+    monkeypatch.undo()
+    response = client.post(f'/upload/{upload_id}/complete')
+    assert response.status_code == 202
+    assert response.get_json()['last_error'] is None
+    status = wait_for_upload(upload_id)
+    assert status['status'] == 'complete'
+    assert client.get(f"/download/{status['share_code']}").data == CONTENT
@@ -0,0 +1,104 @@
+"""Compression at rest: uploads stored as zstd frames and served back intact."""
+import hashlib
+import io
+import os
+
+import pytest
+
+zstandard = pytest.importorskip('zstandard')
+
+
+@pytest.fixture
+def frame(server, settings):
+    settings(compression_enabled=True)
+    return server.COMPRESSION_FRAME_SIZE
+
+
+def compressible(size):
+    # Hex text: shrinks by about half, and unique to each test
+    return os.urandom(size // 2).hex().encode()
+
+
+def stored_blob(server, content):
+    conn = server.get_db_connection()
+    row = conn.execute('SELECT codec, size, stored_size FROM blobs WHERE hash = ?',
+                       (hashlib.sha256(content).hexdigest(),)).fetchone()
+    conn.close()
+    return row
+
+
+def upload(client, content, name='log.txt'):
+    response = client.post('/upload', data={'file': (io.BytesIO(content), name)}, content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()['share_code']
+
+
+def test_upload_is_compressed_and_read_back_whole(server, client, frame):
+    content = compressible(3 * frame + 1234)
+    share_code = upload(client, content)
+
+    codec, size, stored_size = stored_blob(server, content)
+    assert codec == 'zstd'
+    assert size == len(content)
+    assert stored_size < len(content) * 0.9
+
+    response = client.get(f'/download/{share_code}')
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == content
+
+    # Clients that ask for zstd get the stored frames
+    response = client.get(f'/download/{share_code}', headers={'Accept-Encoding': 'zstd'})
+    assert response.headers['Content-Encoding'] == 'zstd'
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(response.data), read_across_frames=True)
+    assert reader.read() == content
+
+
+def test_ranges_across_frame_boundaries(server, client, frame):
+    content = compressible(3 * frame + 1234)
+    share_code = upload(client, content)
+    download = lambda value: client.get(f'/download/{share_code}', headers={'Range': value,
+                                                                             'Accept-Encoding': 'zstd'})
+
+    for start, stop in [(frame - 10, frame + 10), (2 * frame - 1, 2 * frame + 1),
+                        (frame - 1, 3 * frame + 1), (0, 1), (3 * frame, len(content))]:
+        response = download(f'bytes={start}-{stop - 1}')
+        assert response.status_code == 206
+        assert 'Content-Encoding' not in response.headers
+        assert response.data == content[start:stop], (start, stop)
+
+    response = download(f'bytes=-{frame + 5}')
+    assert response.data == content[-(frame + 5):]
+
+    response = download(f'bytes={frame - 3}-{frame + 2}, {2 * frame - 3}-{2 * frame + 2}')
+    assert response.status_code == 206
+    assert content[frame - 3:frame + 3] in response.data
+    assert content[2 * frame - 3:2 * frame + 3] in response.data
+
+
+def test_chunked_upload_is_compressed(server, client, frame, wait_for_upload):
+    content = compressible(2 * frame + 500)
+    response = client.post('/upload/init', json={'filename': 'chunked.log', 'size': len(content),
+                                                 'chunk_size': frame // 2})
+    body = response.get_json()
+    for index in range(body['total_chunks']):
+        offset = index * body['chunk_size']
+        piece = content[offset:offset + body['chunk_size']]
+        assert client.put(f"/upload/{body['upload_id']}/chunk?offset={offset}", data=piece).status_code == 200
+    assert client.post(f"/upload/{body['upload_id']}/complete").status_code == 202
+
+    status = wait_for_upload(body['upload_id'])
+    assert status['status'] == 'complete'
+    assert stored_blob(server, content)[0] == 'zstd'
+
+    share_code = status['share_code']
+    assert client.get(f'/download/{share_code}').data == content
+    response = client.get(f'/download/{share_code}', headers={'Range': f'bytes={frame - 5}-{frame + 4}'})
+    assert response.data == content[frame - 5:frame + 5]
+
+
+def test_incompressible_upload_is_stored_as_is(server, client, frame):
+    content = os.urandom(frame + 100)
+    share_code = upload(client, content, 'noise.txt')
+    assert stored_blob(server, content)[0] is None
+    assert client.get(f'/download/{share_code}').data == content
@@ -0,0 +1,132 @@
+"""Range and conditional downloads, and how they are billed."""
+import io
+import os
+import re
+
+import pytest
+
+CONTENT = os.urandom(5000)
+
+
+def upload(client, content):
+    response = client.post('/upload', data={'file': (io.BytesIO(content), 'ranges.bin')},
+                           content_type='multipart/form-data')
+    body = response.get_json()
+    return body['share_code'], body['file_id']
+
+
+@pytest.fixture(scope='module')
+def share_code(server):
+    return upload(server.app.test_client(), CONTENT)[0]
+
+
+@pytest.fixture
+def download(client, share_code):
+    return lambda **headers: client.get(f'/download/{share_code}', headers=headers)
+
+
+def download_count(server, file_id):
+    server.download_log.flush(release_all=True)
+    conn = server.get_db_connection()
+    count = conn.execute('SELECT download_count FROM files WHERE id = ?', (file_id,)).fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_full_download(download):
+    response = download()
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['ETag']
+
+
+def test_single_range(download):
+    response = download(Range='bytes=100-199')
+    assert response.status_code == 206
+    assert response.data == CONTENT[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(CONTENT)}'
+    assert response.content_length == 100
+
+
+def test_open_ended_and_suffix_ranges(download):
+    response = download(Range='bytes=4900-')
+    assert response.status_code == 206
+    assert response.data == CONTENT[4900:]
+
+    response = download(Range='bytes=-300')
+    assert response.status_code == 206
+    assert response.data == CONTENT[-300:]
+    assert response.headers['Content-Range'] == f'bytes 4700-4999/{len(CONTENT)}'
+
+
+def test_multiple_ranges(download):
+    response = download(Range='bytes=0-9, 10-19, 1000-1009')
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary']
+
+    # Adjacent ranges are merged: 0-19 and 1000-1009
+    parts = response.data.split(f'--{boundary}'.encode())[1:-1]
+    assert len(parts) == 2
+    for part, (start, stop) in zip(parts, [(0, 20), (1000, 1010)]):
+        headers, body = part.split(b'\r\n\r\n', 1)
+        assert re.search(rf'Content-Range: bytes {start}-{stop - 1}/{len(CONTENT)}'.encode(), headers)
+        assert body[:-2] == CONTENT[start:stop]
+    assert response.data.endswith(f'--{boundary}--\r\n'.encode())
+
+    # Overlapping or unordered ranges are ignored: the whole file
+    response = download(Range='bytes=1000-1009, 5-14')
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_unsatisfiable_range(download):
+    response = download(Range=f'bytes={len(CONTENT)}-')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(CONTENT)}'
+    assert response.data == b''
+
+
+def test_if_range(download):
+    etag = download().headers['ETag']
+
+    response = download(Range='bytes=0-99', **{'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == CONTENT[:100]
+
+    # The client's copy is stale: the whole current file instead of a range
+    response = download(Range='bytes=0-99', **{'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_if_none_match(download):
+    etag = download().headers['ETag']
+    response = download(**{'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    response = download(**{'If-None-Match': '"other"'})
+    assert response.status_code == 200
+
+
+def test_resumed_download_is_billed_once(server, client):
+    # A file of its own, so earlier downloads in this module are not in its session
+    share_code, file_id = upload(client, os.urandom(5000))
+    download = lambda **headers: client.get(f'/download/{share_code}', headers=headers)
+    before = download_count(server, file_id)
+
+    # A small probe, then the rest in two ranges: one download
+    download(Range='bytes=0-19')
+    download(Range='bytes=20-2999')
+    download(Range='bytes=3000-')
+    assert download_count(server, file_id) == before + 1
+
+    # Not-modified answers deliver nothing
+    download(**{'If-None-Match': download(Range='bytes=-1').headers['ETag']})
+    assert download_count(server, file_id) == before + 1
+
+    # Fetching the whole file again is another download
+    download()
+    assert download_count(server, file_id) == before + 2
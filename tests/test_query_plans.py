@@ -0,0 +1,16 @@
+"""Hot queries must stay index-driven: a full table SCAN in any of their
+plans is a regression (see HOT_QUERIES in server.py)."""
+
+
+def test_fresh_database_is_fully_migrated(server):
+    conn = server.get_db_connection()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    assert version == server.SCHEMA_MIGRATIONS[-1][0]
+
+
+def test_hot_queries_use_indexes(server):
+    conn = server.get_db_connection()
+    scans = server.find_table_scans(conn.cursor())
+    conn.close()
+    assert scans == [], '\n'.join(f'{detail}: {sql}' for sql, detail in scans)
@@ -0,0 +1,114 @@
+"""Per-IP token buckets, bandwidth pacing and which address limits key on."""
+import io
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_bucket_denies_when_empty_and_refills(server, settings):
+    settings(rate_limit_download_per_minute=3)
+    limiter = server.RateLimiter()
+
+    assert [limiter.allow('download', '192.0.2.1')[0] for _ in range(4)] == [True, True, True, False]
+    allowed, retry_after = limiter.allow('download', '192.0.2.1')
+    assert not allowed
+    assert 1 <= retry_after <= 21
+
+    # Other clients and scopes have buckets of their own
+    assert limiter.allow('download', '192.0.2.2') == (True, 0)
+    assert limiter.allow('upload', '192.0.2.1') == (True, 0)
+
+    # A minute refills the whole bucket: 20 seconds bring back one token
+    limiter.buckets['download:192.0.2.1'][1] -= 20
+    assert limiter.allow('download', '192.0.2.1') == (True, 0)
+    assert not limiter.allow('download', '192.0.2.1')[0]
+
+
+def test_zero_means_unlimited(server, settings):
+    settings(rate_limit_download_per_minute=0)
+    limiter = server.RateLimiter()
+    assert all(limiter.allow('download', '192.0.2.1')[0] for _ in range(100))
+
+
+def test_limited_download_answers_429(client, settings):
+    share_code = client.post('/upload', data={'file': (io.BytesIO(b'limited'), 'limited.txt')},
+                             content_type='multipart/form-data').get_json()['share_code']
+    settings(rate_limit_download_per_minute=1)
+    download = lambda: client.get(f'/download/{share_code}', environ_base={'REMOTE_ADDR': '192.0.2.10'})
+
+    assert download().status_code == 200
+    response = download()
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_throttle_allows_a_second_of_burst_then_paces(server):
+    throttle = server.Throttle(1000)
+    assert throttle.delay(1000) == 0
+    assert throttle.delay(500) == pytest.approx(0.5, abs=0.05)
+
+
+def test_throttled_iteration_and_reads_keep_to_the_rate(server):
+    # 600KB at 400KB/s: the first 400KB are the burst, the rest takes half a second
+    started = time.monotonic()
+    assert sum(map(len, server.Throttle(400_000).iter([b'x' * 100_000] * 6))) == 600_000
+    assert 0.4 < time.monotonic() - started < 1.0
+
+    started = time.monotonic()
+    reader = server.Throttle(400_000).reader(io.BytesIO(b'x' * 600_000))
+    while reader.read(100_000):
+        pass
+    assert 0.4 < time.monotonic() - started < 1.0
+
+
+PROXY_CHECK = textwrap.dedent('''
+    import io, json
+    import server
+
+    conn = server.get_db_connection()
+    conn.execute("UPDATE settings SET value = '1' WHERE key = 'rate_limit_upload_per_minute'")
+    conn.commit()
+    conn.close()
+    server.settings_cache.reload()
+
+    client = server.app.test_client()
+    def upload(forwarded_for):
+        return client.post('/upload', data={'file': (io.BytesIO(b'x'), 'a.txt')},
+                           content_type='multipart/form-data', headers={'X-Forwarded-For': forwarded_for},
+                           environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+
+    print(json.dumps({
+        'statuses': [upload('198.51.100.1, 10.0.0.9'), upload('198.51.100.2, 10.0.0.9'),
+                     upload('198.51.100.1, 10.0.0.9')],
+        'client_ip': server.get_client_ip({'REMOTE_ADDR': '10.0.0.1',
+                                           'HTTP_X_FORWARDED_FOR': '198.51.100.1, 10.0.0.9'}),
+        'short_chain': server.get_client_ip({'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '203.0.113.66'}),
+    }))
+''')
+
+
+@pytest.mark.parametrize('hops, statuses, client_ip', [
+    # Direct clients: the forwarded header is ignored, everything comes from 10.0.0.1
+    ('0', [200, 429, 429], '10.0.0.1'),
+    # Behind two proxies: each forwarded client has its own bucket
+    ('2', [200, 200, 429], '198.51.100.1'),
+])
+def test_client_ip_follows_trusted_proxy_hops(tmp_path, hops, statuses, client_ip):
+    # ProxyFix is set up on import, so each setting gets a fresh interpreter
+    env = {**os.environ, 'TRUSTED_PROXY_HOPS': hops, 'PYTHONPATH': ROOT}
+    result = subprocess.run([sys.executable, '-c', PROXY_CHECK], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    checks = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert checks['statuses'] == statuses
+    assert checks['client_ip'] == client_ip
+    # A chain shorter than the trusted hops was not written by our proxies
+    assert checks['short_chain'] == '10.0.0.1'